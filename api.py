@@ -1,19 +1,69 @@
-from flask import Flask, request
-from flask_restplus import Resource, Api, reqparse
+import json
+import time
+start_time = time.time()
 
-from scouter import Scouter
+from flask import Flask, Response, request
+from flask_restplus import Resource, Api, reqparse, fields
+
+from scouter import NOT_FOUND, RESOLUTIONS, RESOLUTION, SIMILAR_CELLS, MAX_SIMILAR_CELLS, GRANULARITY
+from registry import ScouterRegistry, load_datasets
+from metrics import metrics
 
 app = Flask(__name__)
+metrics.set_request_logging(metrics.request_logging)
 api = Api(app, version='1.0', title="Location intelligence API",
     description='REST API that provides location intelligence data',)
 api.namespaces.clear()
 ns = api.namespace('peers-insight', 
                    description='Get insight into peers by your location')
-scouter = Scouter()
+registry = ScouterRegistry(load_datasets())
+registry.preload()
+ready = True # cleared by serve.py while a worker drains
+print(f"Location intelligence API ready in {(time.time() - start_time)} seconds")
+
+@app.route('/health')
+def health():
+    """
+    Liveness - the process is up and answering
+    """
+    return {"status": "ok"}
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """
+    Build stage, cache and request latency metrics of this process in Prometheus text format
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/ready')
+def readiness():
+    """
+    Readiness - data is loaded and the process takes requests
+    """
+    if not ready:
+        return {"status": "draining"}, 503
+    return {"status": "ready", "resolutions": RESOLUTIONS, "granularity": GRANULARITY, "datasets": registry.names, "loaded": {
+        name: {"ground": scouter.ground.key, "model": scouter.model_builder.key} for name, scouter in list(registry.loaded.items())
+    }}
+
+def scouter_at(lon, lat):
+    """
+    Returns Scouter of the city at the location, None outside every city - 503 if the city can not be loaded
+    """
+    try:
+        return registry.scouter_at(lon, lat)
+    except RuntimeError as e:
+        # workers only read the feature store, a city never built is not served
+        api.abort(503, str(e))
 
 peers_parser = reqparse.RequestParser()
 peers_parser.add_argument('lat', type=float, required=True, help='Latitude of your location')
 peers_parser.add_argument('lon', type=float, required=True, help='Longitude of your location')
+peers_parser.add_argument('offset', type=int, default=0, help='Number of top ranked restaurants to skip')
+peers_parser.add_argument('limit', type=int, help='Maximum number of restaurants to return, all if not set')
+peers_parser.add_argument('columns', type=str, help='Comma separated restaurant columns to return, all if not set')
+peers_parser.add_argument('resolution', type=int, default=RESOLUTION, help=f'Cell side in meters, one of {RESOLUTIONS}')
+peers_parser.add_argument('granularity', type=int, default=GRANULARITY, help='Number of clusters similar locations are grouped in')
 
 @ns.route('/peers')
 @ns.expect(peers_parser) 
@@ -22,11 +72,147 @@ class Peers(Resource):
         """
         Returns ranked list of restaurants in similar location
         """
-        args = request.args
-        latitude = float(args['lat'])
-        longitude = float(args['lon'])
-        ret = scouter.similarly_located_restaurants(longitude, latitude)
-        return ret
+        args = peers_parser.parse_args()
+        if args['offset'] < 0 or (args['limit'] is not None and args['limit'] < 0):
+            api.abort(400, 'offset and limit must not be negative')
+        columns = tuple(args['columns'].split(',')) if args['columns'] else None
+
+        scouter = scouter_at(args['lon'], args['lat'])
+        if scouter is None:
+            return NOT_FOUND
+        try:
+            rendered = scouter.similarly_located_restaurants_rendered(args['lon'], args['lat'], args['offset'], args['limit'],
+                columns, args['resolution'], args['granularity'])
+        except ValueError as e:
+            api.abort(400, str(e))
+        if rendered is None:
+            return NOT_FOUND
+
+        body, etag, total = rendered
+        with metrics.phase('peers', 'serialization'):
+            if request.if_none_match.contains(etag):
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype='application/json')
+            response.set_etag(etag)
+            response.headers['X-Total-Count'] = str(total)
+        return response
+
+ranked_parser = reqparse.RequestParser()
+ranked_parser.add_argument('lat', type=float, required=True, help='Latitude of your location')
+ranked_parser.add_argument('lon', type=float, required=True, help='Longitude of your location')
+ranked_parser.add_argument('k', type=int, default=SIMILAR_CELLS, help=f'Number of most similar locations, at most {MAX_SIMILAR_CELLS}')
+ranked_parser.add_argument('radius', type=float, help='Meters around your location the similar locations are searched in, anywhere if not set')
+ranked_parser.add_argument('exclude', type=str, help='Comma separated cell ids to leave out')
+ranked_parser.add_argument('resolution', type=int, default=RESOLUTION, help=f'Cell side in meters, one of {RESOLUTIONS}')
+
+@ns.route('/peers/ranked')
+@ns.expect(ranked_parser)
+class RankedPeers(Resource):
+    def get(self):
+        """
+        Returns the most similar locations by their features, nearest first, and ranked list of restaurants in them
+        """
+        args = ranked_parser.parse_args()
+        if not 0 < args['k'] <= MAX_SIMILAR_CELLS:
+            api.abort(400, f'k must be between 1 and {MAX_SIMILAR_CELLS}')
+        if args['radius'] is not None and args['radius'] <= 0:
+            api.abort(400, 'radius must be positive')
+        scouter = scouter_at(args['lon'], args['lat'])
+        if scouter is None:
+            return NOT_FOUND
+        try:
+            exclude = [int(c) for c in args['exclude'].split(',')] if args['exclude'] else []
+            result = scouter.similar_locations_ranked(args['lon'], args['lat'], args['k'], args['radius'], exclude, args['resolution'])
+        except ValueError as e:
+            api.abort(400, str(e))
+        if result is None:
+            return NOT_FOUND
+
+        with metrics.phase('peers_ranked', 'serialization'):
+            return Response(json.dumps(result), mimetype='application/json')
+
+point_model = ns.model('Point', {
+    'lat': fields.Float(required=True, description='Latitude of the location'),
+    'lon': fields.Float(required=True, description='Longitude of the location'),
+})
+batch_model = ns.model('Points', {
+    'points': fields.List(fields.Nested(point_model), required=True, description='Locations to look up'),
+    'resolution': fields.Integer(default=RESOLUTION, description=f'Cell side in meters, one of {RESOLUTIONS}'),
+    'granularity': fields.Integer(default=GRANULARITY, description='Number of clusters similar locations are grouped in'),
+})
+
+@ns.route('/peers/batch')
+class PeersBatch(Resource):
+    @ns.expect(batch_model, validate=True)
+    def post(self):
+        """
+        Returns city and cluster of every location and ranked list of restaurants in every cluster found by city
+        """
+        body = request.get_json()
+        points = [(float(p['lon']), float(p['lat'])) for p in body['points']]
+
+        # every city looks up its points at once
+        result = {"points": [{"lon": lon, "lat": lat, "dataset": None, "cluster": None} for lon, lat in points], "peers": {}}
+        for name, indices in registry.group([p[0] for p in points], [p[1] for p in points]).items():
+            try:
+                found = registry.get(name).similarly_located_restaurants_batch([points[i] for i in indices], body.get('resolution'),
+                    body.get('granularity'))
+            except ValueError as e:
+                api.abort(400, str(e))
+            except RuntimeError as e:
+                api.abort(503, str(e))
+            for i, point in zip(indices, found['points']):
+                result['points'][i] = dict(point, dataset=name)
+            result['peers'][name] = found['peers']
+        with metrics.phase('peers_batch', 'serialization'):
+            return Response(json.dumps(result), mimetype='application/json')
+
+score_parser = reqparse.RequestParser()
+score_parser.add_argument('lat', type=float, required=True, help='Latitude of your location')
+score_parser.add_argument('lon', type=float, required=True, help='Longitude of your location')
+score_parser.add_argument('resolution', type=int, default=RESOLUTION, help=f'Cell side in meters, one of {RESOLUTIONS}')
+score_model = ns.model('ScorePoints', {
+    'points': fields.List(fields.Nested(point_model), required=True, description='Locations to score'),
+    'resolution': fields.Integer(default=RESOLUTION, description=f'Cell side in meters, one of {RESOLUTIONS}'),
+})
+
+def score(points, resolution):
+    """
+    Returns city, cell and success probability of every point, None for all of them outside every city
+    """
+    scores = [{"lon": lon, "lat": lat, "dataset": None, "cell_id": None, "probability": None} for lon, lat in points]
+    for name, indices in registry.group([p[0] for p in points], [p[1] for p in points]).items():
+        try:
+            found = registry.get(name).success_probabilities([points[i] for i in indices], resolution)
+        except ValueError as e:
+            api.abort(400, str(e))
+        except RuntimeError as e:
+            api.abort(503, str(e))
+        for i, point in zip(indices, found):
+            scores[i] = dict(point, dataset=name)
+    return scores
+
+@ns.route('/score')
+class Score(Resource):
+    @ns.expect(score_parser)
+    def get(self):
+        """
+        Returns probability of a successful restaurant at your location, null outside the scored cells
+        """
+        args = score_parser.parse_args()
+        return score([(args['lon'], args['lat'])], args['resolution'])[0]
+
+    @ns.expect(score_model, validate=True)
+    def post(self):
+        """
+        Returns probability of a successful restaurant at every location, null outside the scored cells
+        """
+        body = request.get_json()
+        points = [(float(p['lon']), float(p['lat'])) for p in body['points']]
+        scores = score(points, body.get('resolution'))
+        with metrics.phase('score', 'serialization'):
+            return Response(json.dumps({"points": scores}), mimetype='application/json')
 
 if __name__ == '__main__':
     app.run(debug=True, use_reloader=False)
\ No newline at end of file
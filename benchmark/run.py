@@ -0,0 +1,246 @@
+"""
+Benchmarks the ground build and query paths on synthetic data and compares them with stored baselines.
+
+    python -m benchmark.run --scale small medium
+    python -m benchmark.run --scale small --update-baselines
+
+Every stage is timed and its peak resident memory recorded. A stage slower or growing memory more than its baseline
+by more than the tolerance, or a populated ground different from the baseline one, fails the run.
+"""
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import contextlib
+import numpy as np
+
+from scouting_ground import ScoutingGround
+from extractors.osm_extractor import OSMExtractor
+from extractors.tripadvisor_extractor import TripAdvisorExtractor
+from extractors.demographic_extractor import DemographicsExtractor
+from extractors.neighbourhood_extractor import NeighbourhoodExtractor
+from ml.model_builder import ModelBuilder
+from ml.clustering import ClusterModel, WARD, MINIBATCH_KMEANS
+from ml.model_builder import N_CLUSTERS
+from feature_store import fingerprint
+from peers_cache import PeersCache
+from metrics import PeakMemory
+from scouter import ID_FEATURE, MODEL_FEATURES, TARGET_FEATURE, ZURICH_LONGITUDE, ZURICH_LATITUDE
+from scouter import NEIGHBOURHOOD_FEATURES, NEIGHBOURHOOD_RADII
+from benchmark import synthetic_data
+
+BASELINES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+DATASET = "benchmark"
+CELL_SIDE = 200
+SEED = 0
+
+# grid dimension, OSM features, restaurants and query locations of every scale
+SCALES = {
+    "small": {"dimension": 50, "features": 20000, "restaurants": 1500, "queries": 1000},
+    "medium": {"dimension": 200, "features": 200000, "restaurants": 15000, "queries": 1000},
+    "large": {"dimension": 500, "features": 2000000, "restaurants": 100000, "queries": 1000}
+}
+
+# feature selection with a linear SVM and ward clustering do not finish on larger grounds,
+# these are clustered with mini-batch k-means only
+MODEL_MAX_CELLS = 10000
+TOLERANCE = 0.5 # allowed relative slowdown and memory growth
+MIN_SECONDS = 0.05 # differences below are noise
+MIN_MB = 16
+
+@contextlib.contextmanager
+def stage(results, name, items = None, quiet = False):
+    """
+    Records wall time and peak resident memory of the block as stage of the results
+    items - number of items processed, seconds per item are recorded too
+    quiet - hide console output of the block
+    """
+    output = contextlib.redirect_stdout(io.StringIO()) if quiet else contextlib.nullcontext()
+    with PeakMemory() as memory, output:
+        start_rss = memory.peak
+        start_time = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start_time
+    results[name] = {
+        "seconds": seconds,
+        "peak_rss_mb": round(memory.peak / 2 ** 20, 1),
+        "rss_growth_mb": round((memory.peak - start_rss) / 2 ** 20, 1)
+    }
+    if items:
+        results[name]["seconds_per_item"] = seconds / items
+    print(f"  {name}: {seconds:.3f} seconds, peak memory {results[name]['peak_rss_mb']} MB (+{results[name]['rss_growth_mb']} MB)")
+
+def run_scale(scale, params, directory):
+    """
+    Generates synthetic inputs of the scale in directory and runs all stages with a fresh feature store there
+
+    returns stage results and checksums of the results
+    """
+    area_side = params["dimension"] * CELL_SIDE
+    area_bounds = synthetic_data.bounds(ZURICH_LONGITUDE, ZURICH_LATITUDE, area_side)
+
+    print(f"Generating {scale} inputs: {params}")
+    start_time = time.time()
+    geojson_file = os.path.join(directory, "osm.geojsonl")
+    zipcode_file = os.path.join(directory, "zipcodes.geojson")
+    demographics_file = os.path.join(directory, "demographics.csv")
+    synthetic_data.write_osm(geojson_file, params["features"], area_bounds, SEED)
+    zipcodes = synthetic_data.write_postal_codes(zipcode_file, area_bounds)
+    synthetic_data.write_demographics(demographics_file, zipcodes, SEED)
+    restaurants = synthetic_data.tripadvisor_frame(params["restaurants"], area_bounds, SEED)
+    lon, lat = synthetic_data.query_points(params["queries"], area_bounds, SEED)
+    print(f"Inputs generated in {(time.time() - start_time)} seconds")
+
+    results = {}
+    checksums = {}
+    quiet = True
+    with stage(results, "grid", quiet = quiet):
+        ground = ScoutingGround(DATASET, ZURICH_LONGITUDE, ZURICH_LATITUDE, area_side, CELL_SIDE, zipcode_file)
+
+    demographics_extractor = DemographicsExtractor(DATASET, demographics_file)
+    osm_extractor = OSMExtractor(DATASET, geojson_file)
+    tripadvisor_extractor = TripAdvisorExtractor(DATASET, osm_extractor)
+    tripadvisor_extractor.df = restaurants
+
+    with stage(results, "demographics", quiet = quiet):
+        ground.df = demographics_extractor.populate_ground(ground.df)
+
+    # apportioned by postal area overlap - the overlay is computed once, applying it again costs the matrix products only
+    apportioning_extractor = DemographicsExtractor(DATASET, demographics_file, zipcode_file)
+    cells_df = ground.df[["id", "area"]]
+    with stage(results, "demographics_overlay", quiet = quiet):
+        apportioning_extractor.populate_ground(cells_df)
+    with stage(results, "demographics_apportioned", quiet = quiet):
+        apportioning_extractor.populate_ground(cells_df)
+    with stage(results, "osm_load", quiet = quiet):
+        osm_extractor.df
+    with stage(results, "osm", quiet = quiet):
+        ground.df = osm_extractor.populate_ground(ground.df)
+    with stage(results, "tripadvisor", quiet = quiet):
+        ground.df = tripadvisor_extractor.populate_ground(ground.df)
+    ground.base_df = ground.df
+    checksums["ground"] = fingerprint(ground.df.drop(columns = ["center", "area"]))
+
+    # timed on its own, the models below are built on the model features only to stay comparable
+    with stage(results, "neighbourhood", quiet = quiet):
+        NeighbourhoodExtractor(NEIGHBOURHOOD_FEATURES, NEIGHBOURHOOD_RADII).populate_ground(ground.df, ground.grid.rows,
+            ground.grid.columns, CELL_SIDE)
+
+    if len(ground.df) <= MODEL_MAX_CELLS:
+        with stage(results, "model", quiet = quiet):
+            model_builder = ModelBuilder(DATASET, ground.df, ID_FEATURE, MODEL_FEATURES, TARGET_FEATURE,
+                WARD, ground.grid.columns)
+            ground.populate_ground_from_model(model_builder, ID_FEATURE)
+    else:
+        with stage(results, f"cluster_{MINIBATCH_KMEANS}", quiet = quiet):
+            X = np.log1p(ground.df[MODEL_FEATURES].fillna(0).values.astype(float))
+            X = (X - X.min(axis = 0)) / np.maximum(X.max(axis = 0) - X.min(axis = 0), 1e-12)
+            ground.df["cluster"] = ClusterModel(N_CLUSTERS, MINIBATCH_KMEANS, SEED).fit_predict(X).astype(float)
+            ground.build_arrays(X, MODEL_FEATURES)
+
+    with stage(results, "peers_cache", quiet = quiet):
+        peers = PeersCache({
+            cluster: tripadvisor_extractor.get_ranked_restaurants_in_locations(ground.get_cluster_locations(cluster))
+            for cluster in ground.cluster_cells
+        })
+
+    with stage(results, "similar_locations", items = len(lon), quiet = quiet):
+        for x, y in zip(lon, lat):
+            ground.get_similar_locations(x, y)
+
+    # the work of GET /peers-insight/peers behind the HTTP layer
+    with stage(results, "query", items = len(lon), quiet = quiet):
+        for x, y in zip(lon, lat):
+            cluster = ground.get_cluster(x, y)
+            if cluster in peers:
+                peers.render(cluster, 0, None, None)
+
+    with stage(results, "batch_query", items = len(lon), quiet = quiet):
+        ground.get_clusters(lon, lat)
+
+    if ground.arrays.probabilities is not None:
+        # the work of POST /peers-insight/score behind the HTTP layer
+        with stage(results, "score", items = len(lon), quiet = quiet):
+            ground.get_probabilities(lon, lat)
+
+    return results, checksums
+
+def compare(scale, results, checksums, baseline, tolerance):
+    """
+    returns list of regressions of the results against the baseline of the scale
+    """
+    regressions = []
+    for name, measured in results.items():
+        expected = baseline["stages"].get(name)
+        if expected is None:
+            continue
+        if measured["seconds"] > expected["seconds"] * (1 + tolerance) and measured["seconds"] - expected["seconds"] > MIN_SECONDS:
+            regressions.append(f"{scale} {name}: {measured['seconds']:.3f} seconds, baseline {expected['seconds']:.3f}")
+        # memory held before the stage depends on the scales run before, growth during the stage does not
+        if measured["rss_growth_mb"] > expected["rss_growth_mb"] * (1 + tolerance) and measured["rss_growth_mb"] - expected["rss_growth_mb"] > MIN_MB:
+            regressions.append(f"{scale} {name}: memory growth {measured['rss_growth_mb']} MB, baseline {expected['rss_growth_mb']}")
+    for name, checksum in checksums.items():
+        if baseline["checksums"].get(name, checksum) != checksum:
+            regressions.append(f"{scale} {name}: result differs from baseline")
+    return regressions
+
+def machine():
+    return {"platform": platform.platform(), "processor": platform.processor(), "cpus": os.cpu_count(),
+        "python": platform.python_version()}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Benchmark ground build and queries on synthetic data")
+    parser.add_argument("--scale", nargs = "+", choices = list(SCALES), default = ["small"])
+    parser.add_argument("--tolerance", type = float, default = TOLERANCE, help = "allowed relative slowdown")
+    parser.add_argument("--update-baselines", action = "store_true", help = "store results as new baselines")
+    parser.add_argument("--output", help = "write results as json to this file")
+    args = parser.parse_args()
+
+    baselines = {"machine": None, "scales": {}}
+    if os.path.exists(BASELINES_FILE):
+        with open(BASELINES_FILE) as f:
+            baselines = json.load(f)
+    if baselines["machine"] and baselines["machine"] != machine() and not args.update_baselines:
+        print(f"Warning: baselines were recorded on {baselines['machine']}, running on {machine()}")
+
+    report = {"machine": machine(), "scales": {}}
+    regressions = []
+    cwd = os.getcwd()
+    for scale in args.scale:
+        directory = tempfile.mkdtemp(prefix = f"benchmark-{scale}-")
+        try:
+            # feature store and legacy pickles resolve relative to the working directory
+            os.chdir(directory)
+            results, checksums = run_scale(scale, SCALES[scale], directory)
+        finally:
+            os.chdir(cwd)
+            shutil.rmtree(directory, ignore_errors = True)
+
+        report["scales"][scale] = {"params": SCALES[scale], "stages": results, "checksums": checksums}
+        if scale in baselines["scales"]:
+            regressions += compare(scale, results, checksums, baselines["scales"][scale], args.tolerance)
+        else:
+            print(f"No baseline for {scale} scale")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent = 2)
+
+    if args.update_baselines:
+        baselines["machine"] = machine()
+        baselines["scales"].update(report["scales"])
+        with open(BASELINES_FILE, "w") as f:
+            json.dump(baselines, f, indent = 2)
+        print(f"Baselines of {args.scale} stored in {BASELINES_FILE}")
+    elif regressions:
+        print("Regressions against baselines:")
+        for regression in regressions:
+            print(f"  {regression}")
+        sys.exit(1)
+    else:
+        print("No regressions against baselines")
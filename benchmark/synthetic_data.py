@@ -0,0 +1,146 @@
+import json
+import numpy as np
+import pandas as pd
+
+from shapely import points
+
+from scouting_ground import meters_per_degree
+
+# values of the OSM properties - the ones counted as ground categories and some that are not
+OSM_VALUES = {
+    "highway": ["motorway", "trunk", "primary", "secondary", "tertiary", "residential",
+        "pedestrian", "footway", "living_street", "service"],
+    "railway": ["rail", "tram"],
+    "public_transport": ["station", "stop_position", "platform"],
+    "amenity": ["school", "university", "college", "parking", "hospital", "arts_centre", "cinema", "theatre",
+        "bar", "nightclub", "pub", "biergarten", "restaurant", "cafe", "fast_food", "bench"],
+    "building": ["public", "residential", "apartments", "house", "yes"],
+    "tourism": ["hotel", "museum", "viewpoint"],
+    "shop": ["supermarket", "bakery", "clothes"],
+    "leisure": ["park", "pitch", "playground"]
+}
+PROPERTY_SHARE = 0.2 # share of features having each property
+
+CLUSTERED_SHARE = 0.7 # share of features and restaurants concentrated around the center like in a city
+POSTAL_AREAS_PER_SIDE = 8
+
+def bounds(longitude, latitude, area_side):
+    """
+    returns west, south, east and north edge of square area around the center point
+    area_side - area side in meters
+    """
+    lon_meters, lat_meters = meters_per_degree(latitude)
+    half_lon = area_side / 2 / lon_meters
+    half_lat = area_side / 2 / lat_meters
+    return longitude - half_lon, latitude - half_lat, longitude + half_lon, latitude + half_lat
+
+def random_points(rng, n, area_bounds):
+    """
+    returns longitudes and latitudes of n points, clustered around the center of the area and spread over it
+    """
+    west, south, east, north = area_bounds
+    clustered = rng.random(n) < CLUSTERED_SHARE
+    lon = np.where(clustered, rng.normal((west + east) / 2, (east - west) / 8, n), rng.uniform(west, east, n))
+    lat = np.where(clustered, rng.normal((south + north) / 2, (north - south) / 8, n), rng.uniform(south, north, n))
+    return np.clip(lon, west, east), np.clip(lat, south, north)
+
+def write_osm(geojson_file, n, area_bounds, seed):
+    """
+    Writes n OSM like points, lines and polygons as newline delimited GeoJSON sequence
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = random_points(rng, n, area_bounds)
+    kinds = rng.integers(3, size = n)
+    # street segments of up to ~300 m and buildings of up to ~150 m side
+    dx = rng.normal(0, 0.002, n)
+    dy = rng.normal(0, 0.0015, n)
+    side = rng.uniform(0.0001, 0.002, n)
+    properties = {
+        prop: np.where(rng.random(n) < PROPERTY_SHARE, rng.choice(values, n), None)
+        for prop, values in OSM_VALUES.items()
+    }
+
+    with open(geojson_file, "w") as f:
+        for i in range(n):
+            x, y = float(lon[i]), float(lat[i])
+            if kinds[i] == 0:
+                geometry = {"type": "Point", "coordinates": [x, y]}
+            elif kinds[i] == 1:
+                geometry = {"type": "LineString", "coordinates": [[x, y], [x + float(dx[i]), y + float(dy[i])]]}
+            else:
+                s = float(side[i])
+                geometry = {"type": "Polygon", "coordinates": [[[x, y], [x + s, y], [x + s, y + s], [x, y + s], [x, y]]]}
+            feature_properties = {prop: values[i] for prop, values in properties.items() if values[i] is not None}
+            feature_properties["name"] = f"feature {i}"
+            f.write(json.dumps({"type": "Feature", "id": f"node/{i}", "properties": feature_properties, "geometry": geometry}))
+            f.write("\n")
+
+def write_postal_codes(geojson_file, area_bounds):
+    """
+    Writes square postal code areas covering the area, returns their zip codes
+    """
+    west, south, east, north = area_bounds
+    lon_edges = np.linspace(west, east, POSTAL_AREAS_PER_SIDE + 1)
+    # slightly wider than the area so cells on its edges are covered
+    lon_edges[0] -= 0.01
+    lon_edges[-1] += 0.01
+    lat_edges = np.linspace(north, south, POSTAL_AREAS_PER_SIDE + 1)
+    lat_edges[0] += 0.01
+    lat_edges[-1] -= 0.01
+
+    features = []
+    zipcodes = []
+    for row in range(POSTAL_AREAS_PER_SIDE):
+        for column in range(POSTAL_AREAS_PER_SIDE):
+            w, e = lon_edges[column], lon_edges[column + 1]
+            n, s = lat_edges[row], lat_edges[row + 1]
+            zipcode = 8000 + row * POSTAL_AREAS_PER_SIDE + column
+            zipcodes.append(zipcode)
+            features.append({
+                "type": "Feature",
+                "properties": {"postal_code": str(zipcode)},
+                "geometry": {"type": "Polygon", "coordinates": [[[w, s], [e, s], [e, n], [w, n], [w, s]]]}
+            })
+
+    with open(geojson_file, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    return zipcodes
+
+def write_demographics(csv_file, zipcodes, seed):
+    """
+    Writes demographics of every zip code like the Statistik Stadt Zürich extract
+    """
+    rng = np.random.default_rng(seed)
+    n = len(zipcodes)
+    pd.DataFrame({
+        "zipcode": zipcodes,
+        "proportion_of_foreigners": rng.uniform(15, 45, n).round(3),
+        "population": rng.integers(1000, 40000, n),
+        "employee": rng.integers(1000, 80000, n),
+        "workplaces": rng.integers(100, 6000, n)
+    }).to_csv(csv_file, index = False)
+
+def tripadvisor_frame(n, area_bounds, seed):
+    """
+    Returns data frame of n restaurants with the columns of the scraped TripAdvisor data
+    """
+    rng = np.random.default_rng(seed)
+    lon, lat = random_points(rng, n, area_bounds)
+    ranking = rng.permutation(n) + 1
+    return pd.DataFrame({
+        "location_id": [str(1000000 + i) for i in range(n)],
+        "name": [f"Restaurant {i}" for i in range(n)],
+        "latitude": lat.astype(str),
+        "longitude": lon.astype(str),
+        "ranking_data.ranking": ranking.astype(str),
+        "ranking_data.ranking_out_of": str(n),
+        "price_level": rng.choice(["$", "$$ - $$$", "$$$$"], n),
+        "point": points(lon, lat),
+        "ranking_percentile": 100 * ranking / n
+    })
+
+def query_points(n, area_bounds, seed):
+    """
+    returns longitudes and latitudes of n query locations
+    """
+    return random_points(np.random.default_rng(seed), n, area_bounds)
@@ -1,29 +1,131 @@
 import os.path
+import time
+import numpy as np
 import pandas as pd
 
+import shapely
+from shapely import STRtree
+
+from extractors.zipcode_resolver import read_postal_areas
+from feature_store import store, fingerprint
+
+# shares and rates are averaged over the postal areas of a cell by area, any other column is a count
+INTENSIVE_COLUMNS = ["proportion_of_foreigners"]
+
 class DemographicsExtractor:
+    """
+    Demographics of postal code areas apportioned to the cells by area when postal code boundaries are given:
+    a cell gets the share of every count of a postal area its overlap with the area is of the postal area,
+    and the area weighted mean of the rates of the postal areas it overlaps. Overlap areas of the cells with
+    the postal areas are computed once per ground and stored as a sparse matrix, every demographics column
+    is then apportioned by a sparse matrix product - new demographics need no geometry work.
+    Without boundaries every cell gets the demographics of its zip code.
+    """
 
-    def __init__(self, dataset, demographics_file):
+    def __init__(self, dataset, demographics_file, zipcode_file = None, intensive_columns = INTENSIVE_COLUMNS):
         """
-        dataset - name of the dataset to identify pickle
+        dataset - name of the dataset to identify feature store entry
         demographics_file - path to .csv file
+        zipcode_file - .geojson file with postal code boundaries to apportion demographics by area, None to merge by zip code
+        intensive_columns - demographics columns averaged by area instead of apportioned
         """
 
-        pickle_file = f"pickle/{dataset}.demo.df.pickle"
+        self.dataset = dataset
+        self.demographics_file = demographics_file
+        self.zipcode_file = zipcode_file if zipcode_file is not None and os.path.exists(zipcode_file) else None
+        self.intensive_columns = intensive_columns
+        self.key = fingerprint(demographics_file) if self.zipcode_file is None else \
+            fingerprint(demographics_file, self.zipcode_file, intensive_columns)
+        self._df = None
+        self.overlays = {} # overlay key to sparse overlap matrix of the ground cells and the postal areas
+
+    @property
+    def df(self):
+        """Demographics data frame - loaded on first access"""
+        if self._df is None:
+            self._df = self.__load()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
 
-        # read from pickle if exists
-        if os.path.exists(pickle_file):
-            print("Yeeh, found demographics pickle - will be loading data from there")
-            self.df = pd.read_pickle(pickle_file)
+    def __load(self):
+        # read from feature store if exists, the legacy pickle is the csv without postal code boundaries
+        df = store.load(self.dataset, "demo", self.key,
+            legacy_key = fingerprint(self.demographics_file), legacy_inputs = [self.demographics_file])
+        if df is not None:
+            print("Yeeh, found demographics in feature store - will be loading data from there")
 
         else:
-            self.df = pd.read_csv(demographics_file)
+            df = pd.read_csv(self.demographics_file)
 
-            # pickle the data frame
-            self.df.to_pickle(pickle_file)
+            # store the data frame
+            store.save(self.dataset, "demo", self.key, df)
+
+        return df
 
     def populate_ground(self, ground_df):
         print(f"Populating scouting ground from demographics data")
-        ground_df = pd.merge(ground_df, self.df, on=['zipcode'], how = "left")
+        if self.zipcode_file is None:
+            return pd.merge(ground_df, self.df, on=['zipcode'], how = "left")
+
+        from scipy import sparse
+
+        overlap, zipcodes, zipcode_areas = self.__overlay(ground_df)
+        demographics = self.df.drop_duplicates("zipcode").set_index("zipcode").reindex(zipcodes)
+        columns = list(demographics.columns)
+        known = demographics.notna().all(axis = 1).values.astype(float)
+
+        # postal areas without demographics are left out, cells overlapping none of the others get none
+        overlap = overlap @ sparse.diags(known)
+        covered = np.asarray(overlap.sum(axis = 1)).ravel()
+        values = demographics.fillna(0).values.astype(float)
+        intensive = [i for i, c in enumerate(columns) if c in self.intensive_columns]
+        extensive = [i for i, c in enumerate(columns) if c not in self.intensive_columns]
 
+        populated = np.full((len(ground_df), len(columns)), np.nan)
+        shares = overlap @ sparse.diags(1 / zipcode_areas)
+        populated[:, extensive] = shares @ values[:, extensive]
+        means = sparse.diags(np.divide(1, covered, out = np.zeros_like(covered), where = covered > 0)) @ overlap
+        populated[:, intensive] = means @ values[:, intensive]
+        populated[covered == 0] = np.nan
+
+        ground_df = ground_df.copy()
+        for i, column in enumerate(columns):
+            ground_df[column] = populated[:, i]
         return ground_df
+
+    def __overlay(self, ground_df):
+        """
+        returns sparse matrix of the overlap areas of the cells with the postal areas, zip codes of its columns
+        and postal area of every zip code - computed once per ground and kept in the feature store
+        """
+        from scipy import sparse
+
+        key = fingerprint(self.zipcode_file, ground_df[["id", "area"]])
+        if key in self.overlays:
+            return self.overlays[key]
+
+        df = store.load(self.dataset, "demo.overlay", key)
+        if df is not None:
+            print("Yeeh, found demographics overlay in feature store - will be loading data from there")
+        else:
+            start_time = time.time()
+            areas, area_zipcodes = read_postal_areas(self.zipcode_file)
+            cells = ground_df["area"].values
+            cell_index, area_index = STRtree(areas).query(cells, predicate = "intersects")
+            overlaps = shapely.area(shapely.intersection(cells[cell_index], areas[area_index]))
+            # postal areas of several polygons share their demographics by their total area
+            zipcode_areas = pd.Series(shapely.area(areas)).groupby(area_zipcodes).sum()
+            df = pd.DataFrame({"cell": cell_index, "zipcode": area_zipcodes[area_index], "overlap": overlaps})
+            df = df[df["overlap"] > 0].groupby(["cell", "zipcode"], as_index = False).sum()
+            df["zipcode_area"] = zipcode_areas.reindex(df["zipcode"]).values
+            store.save(self.dataset, "demo.overlay", key, df)
+            print(f"Overlay of {len(cells)} cells and {len(areas)} postal code areas computed in {(time.time() - start_time)} seconds")
+
+        zipcodes, columns = np.unique(df["zipcode"].values, return_inverse = True)
+        zipcode_areas = df.groupby("zipcode")["zipcode_area"].first().reindex(zipcodes).values
+        overlap = sparse.csr_matrix((df["overlap"].values, (df["cell"].values, columns)), shape = (len(ground_df), len(zipcodes)))
+        self.overlays[key] = overlap, zipcodes, zipcode_areas
+        return self.overlays[key]
@@ -0,0 +1,75 @@
+import json
+import re
+
+# newline delimited GeoJSON - one feature per line, optionally prefixed with record separator (RFC 8142)
+SEQUENCE_SUFFIXES = (".geojsonl", ".geojsons", ".geojsonseq", ".ndjson", ".jsonl")
+RECORD_SEPARATOR = "\x1e"
+SEPARATORS = " \t\r\n," + RECORD_SEPARATOR
+
+READ_SIZE = 1 << 20 # characters read from file at once
+
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+
+def read_features(geojson_file, read_size = READ_SIZE):
+    """
+    Yields features of a GeoJSON FeatureCollection or of a newline delimited GeoJSON sequence one at a time.
+    Only the feature being decoded and the current read are held in memory.
+
+    geojson_file - path to .geojson file or to a GeoJSON sequence file (.geojsonl, .geojsons, .ndjson, ...)
+    read_size - number of characters to read from file at once
+    """
+
+    decoder = json.JSONDecoder()
+
+    with open(geojson_file, "r", encoding = "utf-8") as f:
+        buffer = f.read(read_size)
+        eof = len(buffer) == 0
+        sequence = geojson_file.endswith(SEQUENCE_SUFFIXES) or buffer.lstrip().startswith(RECORD_SEPARATOR)
+
+        position = 0
+        if not sequence:
+            # skip collection members up to the start of the features array
+            match = FEATURES_START.search(buffer)
+            while match is None and not eof:
+                more = f.read(read_size)
+                eof = len(more) == 0
+                buffer = buffer[-64:] + more
+                match = FEATURES_START.search(buffer)
+            if match is None:
+                return
+            position = match.end()
+
+        while True:
+            # skip separators between features
+            while position < len(buffer) and buffer[position] in SEPARATORS:
+                position += 1
+
+            if position == len(buffer):
+                if eof:
+                    return
+                buffer = f.read(read_size)
+                eof = len(buffer) == 0
+                position = 0
+                continue
+
+            if not sequence and buffer[position] == "]":
+                return
+
+            try:
+                feature, position = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                # feature spans beyond current buffer - grow the read with the feature to keep decoding linear
+                more = f.read(max(read_size, len(buffer) - position))
+                eof = len(more) == 0
+                buffer = buffer[position:] + more
+                position = 0
+                continue
+
+            yield feature
+
+            # drop consumed part of the buffer
+            if position > read_size:
+                buffer = buffer[position:]
+                position = 0
@@ -0,0 +1,71 @@
+import numpy as np
+
+# scipy is imported where the features are computed, like scikit-learn where models are built
+
+class NeighbourhoodExtractor:
+    """
+    Spatial lag features of populated cells - the surroundings of a cell, not only what intersects it.
+    Cell features are laid out on the rows x columns grid of the ground and convolved with a kernel per radius:
+    the sum of a feature within the radius and its density weighted by distance, falling linearly to zero at the radius.
+    """
+
+    def __init__(self, features, radii):
+        """
+        features - populated columns to compute the neighbourhood of
+        radii - neighbourhood radii in meters
+        """
+        self.features = features
+        self.radii = radii
+
+    def columns(self, cell_side):
+        """
+        returns names of the neighbourhood columns of a ground with given cell side -
+        radii below the cell side reach no other cell and are left out
+        """
+        return [
+            column
+            for radius in self.radii if radius >= cell_side
+            for feature in self.features
+            for column in [f"{feature}_within_{radius}m", f"{feature}_density_{radius}m"]
+        ]
+
+    def populate_ground(self, ground_df, rows, columns, cell_side):
+        """
+        ground_df - populated ground, cells numbered row by row
+        rows, columns - grid layout of the ground
+        cell_side - cell side in meters
+
+        returns ground data frame with the neighbourhood columns
+        """
+        from scipy import ndimage
+
+        ground_df = ground_df.copy()
+        cells = ground_df["id"].values
+        values = np.zeros((len(self.features), rows * columns))
+        values[:, cells] = ground_df[self.features].values.astype(float).T
+        known = ~np.isnan(values)
+        values = np.where(known, values, 0).reshape(len(self.features), rows, columns)
+        known = known.reshape(len(self.features), rows, columns).astype(float)
+
+        for radius in self.radii:
+            if radius < cell_side:
+                continue
+            within, weights = self.__kernels(radius, cell_side)
+            for i, feature in enumerate(self.features):
+                # cells outside the ground count as nothing, cells without data are left out of the density
+                total = ndimage.convolve(values[i], within, mode = "constant", cval = 0)
+                weighted = ndimage.convolve(values[i], weights, mode = "constant", cval = 0)
+                weight = ndimage.convolve(known[i], weights, mode = "constant", cval = 0)
+                density = np.divide(weighted, weight, out = np.zeros_like(weighted), where = weight > 0) / (cell_side / 1000) ** 2
+                ground_df[f"{feature}_within_{radius}m"] = total.ravel()[cells]
+                ground_df[f"{feature}_density_{radius}m"] = density.ravel()[cells]
+        return ground_df
+
+    def __kernels(self, radius, cell_side):
+        """
+        returns kernel of the cells within the radius and kernel of their distance weights, by cell center distance
+        """
+        reach = int(radius // cell_side)
+        offsets = np.arange(-reach, reach + 1) * cell_side
+        distances = np.hypot(offsets[:, None], offsets[None, :])
+        return (distances <= radius).astype(float), np.clip(1 - distances / radius, 0, None)
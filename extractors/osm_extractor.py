@@ -1,11 +1,67 @@
 import os.path
-import json
+import time
 import pandas as pd
 import numpy as np
 
+import shapely
+from shapely import STRtree
 from shapely.geometry import shape, Point, Polygon, MultiPolygon, LineString, MultiLineString
 from shapely.ops import transform
 
+from extractors.geojson_reader import read_features
+from feature_store import store, fingerprint
+
+def category_labels(df, categories):
+    """
+    Returns matrix of OSM shapes labelled with categories, one row per shape and one column per category
+    df - OSM data frame with property columns
+    categories - list of (category, property, values), values None matches any property value
+    """
+    labels = np.zeros((len(df), len(categories)), dtype = bool)
+    for i, (_, prop, values) in enumerate(categories):
+        labels[:, i] = df[prop].notna() if values is None else df[prop].isin(values)
+    return labels
+
+class OSMCategoryIndex:
+    """
+    Spatial index over OSM shapes for counting ground features per cell.
+    Every shape is labelled with all categories it counts towards in a single pass
+    and indexed once in an STR-tree, so cells are tested against candidate hits only.
+    """
+
+    def __init__(self, df, categories):
+        """
+        df - OSM data frame with shape and property columns
+        categories - list of (category, property, values), values None matches any property value
+        """
+        self.categories = [category for category, _, _ in categories]
+        labels = category_labels(df, categories)
+
+        # only shapes counting towards any category need to be indexed
+        labelled = labels.any(axis = 1)
+        self.labels = labels[labelled]
+        self.shapes = df["shape"].values[labelled]
+        self.tree = STRtree(self.shapes)
+
+    def count(self, areas):
+        """
+        areas - array of cell polygons
+
+        returns matrix of intersecting shape counts, one row per area and one column per category
+        """
+        start_time = time.time()
+        area_index, shape_index = self.tree.query(areas, predicate = "intersects")
+        print(f"Found {len(area_index)} intersecting cell/shape pairs in {(time.time() - start_time)} seconds")
+
+        start_time = time.time()
+        counts = np.zeros((len(areas), len(self.categories)), dtype = np.int64)
+        hits = self.labels[shape_index]
+        for i in range(len(self.categories)):
+            counts[:, i] = np.bincount(area_index[hits[:, i]], minlength = len(areas))
+        print(f"Aggregated {len(self.categories)} category counts in {(time.time() - start_time)} seconds")
+
+        return counts
+
 class OSMExtractor:
 
     GEOMETRY_TYPES = {
@@ -27,136 +83,227 @@ class OSMExtractor:
         "leisure"
     }
 
-    COLUMNS = {
+    # ground feature column, OSM property and matching values - None matches any value
+    CATEGORIES = [
+        ("streets_motorways", "highway", ["motorway"]),
+        ("streets_major", "highway", ["trunk", "primary", "secondary"]),
+        ("streets_minor", "highway", ["tertiary", "residential"]),
+        ("streets_pedestrian", "highway", ["pedestrian", "footway", "living_street"]),
+        ("public_transport_station", "public_transport", ["station"]),
+        ("public_transport_stops", "public_transport", ["stop_position"]),
+        ("public_buildings", "building", ["public"]),
+        ("residential_buildings", "building", ["residential", "apartments", "house"]),
+        ("schools", "amenity", ["school"]),
+        ("universities", "amenity", ["university", "college"]),
+        ("parkings", "amenity", ["parking"]),
+        ("hospitals", "amenity", ["hospital"]),
+        ("entertainments", "amenity", ["arts_centre", "cinema", "theatre"]),
+        ("leisures", "leisure", None),
+        ("bars", "amenity", ["bar", "nightclub", "pub", "biergarten"]),
+        ("foods", "amenity", ["restaurant", "cafe", "fast_food"]),
+        ("supermarkets", "shop", ["supermarket"]),
+        ("shops", "shop", None),
+        ("tourisms", "tourism", None)
+    ]
+
+    COLUMNS = [
         "id",
-        "geometry.type",
-        "geometry.coordinates",
-        "properties.name",
-        "properties.highway",
-        "properties.railway",
-        "properties.public_transport",
-        "properties.amenity",
-        "properties.building",
-        "properties.tourism",
-        "properties.shop",
-        "properties.leisure"
-    }
+        "type",
+        "name",
+        "highway",
+        "railway",
+        "public_transport",
+        "amenity",
+        "building",
+        "tourism",
+        "shop",
+        "leisure",
+        "shape"
+    ]
+
+    CHUNK_SIZE = 50000 # features converted to data frame at once
 
-    class DataFrameFromDict(object):
-            """
-            Temporarily imports data frame columns and deletes them afterwards.
-            """
-            def __init__(self, data):
-                self.df = pd.json_normalize(data)
-                self.columns = list(self.df.columns.values)
-            def __enter__(self):
-                return self.df
-            def __exit__(self, exc_type, exc_val, exc_tb):
-                self.df.drop([c for c in self.columns], axis=1, inplace=True)
+    # change files are GeoJSON with the osmChange action of every feature in this property
+    CHANGE_ACTION_PROPERTY = "action"
+    CHANGE_ACTIONS = {"create", "modify", "delete"}
 
-    def __init__(self, dataset, geojson_file):
+    def __init__(self, dataset, geojson_file, chunk_size = CHUNK_SIZE, change_files = ()):
         """
-        dataset - name of the dataset to identify pickle file
-        geojson_file - path to .geojson file
+        dataset - name of the dataset to identify feature store entry
+        geojson_file - path to .geojson file or newline delimited GeoJSON sequence
+        chunk_size - number of features held in memory before converting them to data frame
+        change_files - GeoJSON change files applied in order on top of geojson_file
         """
         
-        pickle_file = f"pickle/{dataset}.osm.df.pickle"
+        self.dataset = dataset
+        self.geojson_file = geojson_file
+        self.chunk_size = chunk_size
+        self.change_files = list(change_files)
+
+        # key of the base data and of the data after every change file
+        self.keys = [fingerprint(geojson_file, sorted(self.PROPERTIES), sorted(self.GEOMETRY_TYPES))]
+        for change_file in self.change_files:
+            self.keys.append(fingerprint(self.keys[-1], change_file))
+        self.base_key = self.keys[0]
+        self.key = self.keys[-1]
+
+        self.diffs = {} # removed and added features of the changes applied, by state
+        self._df = None
+
+    @property
+    def df(self):
+        """OSM data frame - loaded on first access"""
+        if self._df is None:
+            self._df = self.__load()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
 
-        # read from pickle if exists
-        if os.path.exists(pickle_file):
-            print("Yeeh, found OSM pickle - will be loading data from there")
-            self.df = pd.read_pickle(pickle_file)
+    def __load(self):
+        # read latest stored state from feature store if exists, newer changes are applied on top
+        state = next((i for i in reversed(range(1, len(self.keys))) if store.exists(self.dataset, "osm", self.keys[i])), 0)
+        df = store.load(self.dataset, "osm", self.keys[state], legacy_key = self.base_key, legacy_inputs = [self.geojson_file])
+        if df is not None:
+            print("Yeeh, found OSM data in feature store - will be loading data from there")
         else:
-            print("No pickle found for OSM data - building data from .geojson ...")
-            # read given geojson data
-            with open(geojson_file, "rb") as f:
-                data = json.load(f)
-
-            # drop all features with no interesting properties and uknown geometry type
-            print("Dropping all not interesting properties as well as unknown geometry types")
-            data["features"] = [
-                feat for feat in data["features"]
-                if set(feat["properties"].keys()) & self.PROPERTIES
-                    and feat["geometry"]["type"] in self.GEOMETRY_TYPES
-                ]
-
-            # drop all non-interesting columns
-            with OSMExtractor.DataFrameFromDict(data["features"]) as self.df:
-                for col in self.COLUMNS:
-                    self.df[f".{col}"] = self.df[col] # prefix with dot - workaround to keep only new columns
-
-            # rename columns - id, type, coordinates, highway, railway etc.
-            self.df.columns = self.df.columns.str.split(".")
-            self.df.columns = self.df.columns.str[-1]
-
-            def geometry_to_shapely(geometry):
-                """Creates and returns various shapely shapes depending on given geom_type
-                geometry - geometry dictionary inside geojson feature
-                """
-                shape_obj = shape(geometry)
-                # switch x,y to have latitude, longitude
-                # shape_obj = transform(lambda x, y: (y, x), shape_obj)
-                return shape_obj
-
-            # new column containing shapely shape object
-            print("Converting coordinates to shapely shapes")
-            self.df['shape'] = self.df.apply(lambda row: geometry_to_shapely({"type": row["type"], "coordinates": row["coordinates"]}), axis = 1)
-            del self.df['coordinates']
-
-            # drop invalid shapes
-            self.df = self.df.drop(self.df[self.df["shape"].map(lambda s: not s.is_valid)].index)
-
-            # index shape for performance
-            self.df.set_index("shape")
-
-            # pickle the data frame
-            self.df.to_pickle(pickle_file)
+            print("No OSM data in feature store - streaming data from .geojson ...")
+            start_time = time.time()
+            chunks = []
+            rows = []
+            features_count = 0
+            for feature in read_features(self.geojson_file):
+                features_count += 1
+                row = self.__feature_row(feature)
+                if row is not None:
+                    rows.append(row)
+                if len(rows) == self.chunk_size:
+                    chunks.append(self.__chunk_frame(rows))
+                    rows = []
+            chunks.append(self.__chunk_frame(rows))
+
+            df = pd.concat(chunks, ignore_index = True)
+            print(f"Kept {len(df)} of {features_count} features in {(time.time() - start_time)} seconds")
+
+            # store the data frame
+            store.save(self.dataset, "osm", self.base_key, df)
+
+        for i in range(state + 1, len(self.keys)):
+            df, removed, added = self.__apply_changes(df, self.change_files[i - 1])
+            self.diffs[i] = (removed, added)
+            store.save(self.dataset, "osm", self.keys[i], df)
+
+        return df
+
+    def __apply_changes(self, df, change_file):
+        """
+        Applies created, modified and deleted features of change file to OSM data frame
+        returns updated data frame, removed and added features - modified features are removed and added again
+        """
+        start_time = time.time()
+        changed_ids = set()
+        rows = []
+        for feature in read_features(change_file):
+            action = (feature.get("properties") or {}).get(self.CHANGE_ACTION_PROPERTY)
+            if action not in self.CHANGE_ACTIONS:
+                raise ValueError(f"Unknown change action {action} of feature {feature.get('id')} in {change_file}")
+            changed_ids.add(feature.get("id"))
+            if action != "delete":
+                row = self.__feature_row(feature)
+                if row is not None:
+                    rows.append(row)
+
+        removed = df["id"].isin(changed_ids).values
+        added = self.__chunk_frame(rows)
+        print(f"Applied {len(changed_ids)} changes of {change_file} - {removed.sum()} features removed, {len(added)} added in {(time.time() - start_time)} seconds")
+        return pd.concat([df[~removed], added], ignore_index = True), df[removed], added
+
+    def diff(self, state):
+        """
+        Returns removed and added features of the change file leading to given state, None if the previous state is not stored
+        state - number of change files applied
+        """
+        if state not in self.diffs:
+            if state > 1 and not store.exists(self.dataset, "osm", self.keys[state - 1]):
+                return None
+            previous = store.load(self.dataset, "osm", self.keys[state - 1])
+            if previous is None:
+                return None
+            _, removed, added = self.__apply_changes(previous, self.change_files[state - 1])
+            self.diffs[state] = (removed, added)
+        return self.diffs[state]
+
+    def __feature_row(self, feature):
+        """
+        Returns row with interesting properties and shapely shape of given geojson feature,
+        None for features with no interesting properties or unknown geometry type
+        """
+        properties = feature.get("properties") or {}
+        geometry = feature.get("geometry")
+        if not properties.keys() & self.PROPERTIES or not geometry or geometry["type"] not in self.GEOMETRY_TYPES:
+            return None
+
+        row = {prop: properties.get(prop) for prop in self.PROPERTIES}
+        row["id"] = feature.get("id")
+        row["type"] = geometry["type"]
+        row["name"] = properties.get("name")
+        row["shape"] = shape(geometry)
+        return row
+
+    def __chunk_frame(self, rows):
+        """
+        Returns data frame of feature rows without invalid shapes
+        """
+        df = pd.DataFrame.from_records(rows, columns = self.COLUMNS)
+        return df[shapely.is_valid(df["shape"].values)]
 
     def populate_ground(self, ground_df : pd.DataFrame):
         print(f"Populating scouting ground from OSM data")
 
-        streets_motorways = self.df[self.df["highway"].isin(["motorway"])].copy()
-        streets_major = self.df[self.df["highway"].isin(["trunk", "primary", "secondary"])].copy()
-        streets_minor = self.df[self.df["highway"].isin(["tertiary", "residential"])].copy()
-        streets_pedestrian = self.df[self.df["highway"].isin(["pedestrian", "footway", "living_street"])].copy()
-        public_transport_station = self.df[self.df["public_transport"].isin(["station"])].copy()
-        public_transport_stops = self.df[self.df["public_transport"].isin(["stop_position"])].copy()
-        public_buildings = self.df[self.df["building"].isin(["public"])].copy()
-        residential_buildings = self.df[self.df["building"].isin(["residential", "apartments", "house"])].copy()
-        schools = self.df[self.df["amenity"].isin(["school"])].copy()
-        universiies = self.df[self.df["amenity"].isin(["university", "college"])].copy()
-        parkings = self.df[self.df["amenity"].isin(["parking"])].copy()
-        hospitals = self.df[self.df["amenity"].isin(["hospital"])].copy()
-        entertainments = self.df[self.df["amenity"].isin(["arts_centre", "cinema", "theatre"])].copy()
-        leisures = self.df[self.df["leisure"].notna()].copy()
-        bars = self.df[self.df["amenity"].isin(["bar", "nightclub", "pub", "biergarten"])].copy()
-        foods = self.df[self.df["amenity"].isin(["restaurant", "cafe", "fast_food"])].copy()
-        supermarkets = self.df[self.df["shop"].isin(["supermarket"])].copy()
-        shops = self.df[self.df["shop"].notna()].copy()
-        tourisms = self.df[self.df["tourism"].notna()].copy()
-
-        ground_df["streets_motorways"] = ground_df["area"].apply(lambda area: streets_motorways["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["streets_major"] = ground_df["area"].apply(lambda area: streets_major["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["streets_minor"] = ground_df["area"].apply(lambda area: streets_minor["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["streets_pedestrian"] = ground_df["area"].apply(lambda area: streets_pedestrian["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["public_transport_station"] = ground_df["area"].apply(lambda area: public_transport_station["shape"].map(area.intersects)).sum(axis = 1)      
-        ground_df["public_transport_stops"] = ground_df["area"].apply(lambda area: public_transport_stops["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["public_buildings"] = ground_df["area"].apply(lambda area: public_buildings["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["residential_buildings"] = ground_df["area"].apply(lambda area: residential_buildings["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["schools"] = ground_df["area"].apply(lambda area: schools["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["universities"] = ground_df["area"].apply(lambda area: universiies["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["parkings"] = ground_df["area"].apply(lambda area: parkings["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["hospitals"] = ground_df["area"].apply(lambda area: hospitals["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["entertainments"] = ground_df["area"].apply(lambda area: entertainments["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["leisures"] = ground_df["area"].apply(lambda area: leisures["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["bars"] = ground_df["area"].apply(lambda area: bars["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["foods"] = ground_df["area"].apply(lambda area: foods["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["supermarkets"] = ground_df["area"].apply(lambda area: supermarkets["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["shops"] = ground_df["area"].apply(lambda area: shops["shape"].map(area.intersects)).sum(axis = 1)
-        ground_df["tourisms"] = ground_df["area"].apply(lambda area: tourisms["shape"].map(area.intersects)).sum(axis = 1)
+        start_time = time.time()
+        index = OSMCategoryIndex(self.df, self.CATEGORIES)
+        print(f"Labelled {len(index.shapes)} of {len(self.df)} OSM features with categories in {(time.time() - start_time)} seconds")
+
+        start_time = time.time()
+        counts = index.count(ground_df["area"].values)
+        print(f"Counted OSM features for {len(ground_df)} cells in {(time.time() - start_time)} seconds")
+
+        for i, category in enumerate(index.categories):
+            ground_df[category] = counts[:, i]
 
         return ground_df
 
+    def update_ground(self, ground_df, removed, added):
+        """
+        Recomputes category counts of the cells touched by removed and added features only
+        ground_df - populated scouting ground data frame ordered by cell id
+        removed, added - features as returned by diff
+
+        returns updated ground data frame and ids of the recomputed cells
+        """
+        start_time = time.time()
+        categories = [category for category, _, _ in self.CATEGORIES]
+        tree = STRtree(ground_df["area"].values)
+
+        delta = np.zeros((len(ground_df), len(categories)), dtype = np.int64)
+        touched = []
+        for sign, features in [(-1, removed), (1, added)]:
+            labels = category_labels(features, self.CATEGORIES)
+            shape_index, cell_index = tree.query(features["shape"].values, predicate = "intersects")
+            np.add.at(delta, cell_index, sign * labels[shape_index])
+            touched.append(cell_index[labels[shape_index].any(axis = 1)])
+        touched = np.unique(np.concatenate(touched))
+
+        ground_df = ground_df.copy()
+        for i, category in enumerate(categories):
+            counts = ground_df[category].values.copy()
+            counts[touched] += delta[touched, i]
+            ground_df[category] = counts
+
+        print(f"Recomputed OSM category counts of {len(touched)} cells in {(time.time() - start_time)} seconds")
+        return ground_df, touched
+
     def all_restaurants(self):
         # amenity:restaurant, cafe, fast_food
         restaurants = self.df[self.df["amenity"].isin(["restaurant", "cafe", "fast_food"])]
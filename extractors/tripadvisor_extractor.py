@@ -1,12 +1,14 @@
 import os.path
 from enum import Enum
-import requests
 import pandas as pd
 import numpy as np
 
+from shapely import STRtree
 from shapely.geometry import shape, Point, Polygon, MultiPolygon, LineString, MultiLineString
 
 from extractors.osm_extractor import OSMExtractor
+from extractors.tripadvisor_harvester import TripAdvisorHarvester
+from feature_store import store, fingerprint, STORE_DIRECTORY
 
 LOCATION_API_KEY = ""
 MAPPER_API_KEY = "-mapper"
@@ -18,71 +20,104 @@ class PriceLevel(Enum):
     FINE_DINING = "$$$$"
 
 class TripAdvisorExtractor:
-    def __init__(self, dataset, restaurants):
+    def __init__(self, dataset, osm_extractor):
         """
-        dataset - name of dataset to identify pickle file with
-        restaurants - pandas dataframe containing selected osm data to all restaurants
+        dataset - name of dataset to identify feature store entry with
+        osm_extractor - OSMExtractor providing all restaurants to scrape
         """
         
-        pickle_file = f"pickle/{dataset}.ta.df.pickle"
-
-        # read from pickle if exists
-        if os.path.exists(pickle_file):
-            print("Yeeh, found tripadvisor pickle - will be loading data from there")
-            self.df = pd.read_pickle(pickle_file)
-
-        else:
-            print("No pickle found for tripadvisor data - scraping details for {restaurants.shape[0]} restaurants from TripAdvisor API...")
-            print(f"")
-            # Get representative points for osm geometrical shapes representing restaurants
-            restaurants["representative_point"] = restaurants["shape"].apply(lambda s : s.representative_point())
-
-            # scrape for restaurant location id's from trip advisor
-            # using osm location and category restaurant
-            location_ids = set()
-            def ta_location_id(representative_point, name):
-                print(f"Mapping location id for restaurant {name}")
-                response = requests.get(
-                            f"{BASE_URL}/location_mapper/{representative_point.y},{representative_point.x}", 
-                            params = {"key" : MAPPER_API_KEY, "category" : "restaurants"}
-                            ).json()
-                if response["data"]:
-                    location_ids.update([r["location_id"] for r in response["data"]])
-            restaurants.apply(lambda row: ta_location_id(row["representative_point"], row["name"]), axis=1)
-            print(f"found location ids for {len(location_ids)} restaurants")
-
-            # scrape for location details using locations ids
-            self.df = pd.DataFrame(location_ids, columns = ["location_id"])
-            def ta_location_details(location_id):
-                print(f"Retrieving location details for restaurant {location_id}")
-                res = requests.get(f"{BASE_URL}/location/{location_id}", params = {"key" : LOCATION_API_KEY}).json()
-                return None if "error" in res else res
-            self.df["location_details"] = self.df["location_id"].apply(ta_location_details)
-
-            # flatten the location_details hierarchy
-            self.df = pd.json_normalize(list(self.df["location_details"]))
-
-            # coordinates as Point object
-            self.df["point"] = self.df.apply(lambda row : Point(float(row["longitude"]), float(row["latitude"])), axis = 1)
-
-            # ranking percentile - 799th out of 2164 restaurants in zurich - top 36%
-            self.df = self.df.drop(self.df[self.df["ranking_data.ranking"].isna()].index)
-            self.df = self.df.drop(self.df[self.df["ranking_data.ranking_out_of"].isna()].index)
-            self.df["ranking_percentile"] = self.df.apply(lambda row : 100 * (int(row["ranking_data.ranking"]) / int(row["ranking_data.ranking_out_of"])), axis = 1)
-
-            # pickle the data frame
-            self.df.to_pickle(pickle_file)
+        self.dataset = dataset
+        self.osm_extractor = osm_extractor
+        # restaurants are scraped for the base OSM data, incremental OSM changes keep the scraped data
+        self.key = fingerprint(osm_extractor.base_key)
+        self._df = None
+
+    @property
+    def df(self):
+        """TripAdvisor data frame - loaded on first access"""
+        if self._df is None:
+            self._df = self.__load()
+        return self._df
+
+    @df.setter
+    def df(self, df):
+        self._df = df
+
+    def __load(self):
+        # read from feature store if exists
+        # the legacy pickle holds the restaurants scraped for the OSM data of the same .geojson
+        df = store.load(self.dataset, "ta", self.key, legacy_key = self.key, legacy_inputs = [self.osm_extractor.geojson_file])
+        if df is not None:
+            print("Yeeh, found tripadvisor data in feature store - will be loading data from there")
+            return df
+
+        restaurants = self.osm_extractor.all_restaurants()
+        print(f"No tripadvisor data in feature store - scraping details for {restaurants.shape[0]} restaurants from TripAdvisor API...")
+        # Get representative points for osm geometrical shapes representing restaurants
+        points = [(p.x, p.y) for p in restaurants["shape"].map(lambda s : s.representative_point())]
+
+        harvester = TripAdvisorHarvester(BASE_URL, MAPPER_API_KEY, LOCATION_API_KEY,
+            checkpoint_file = os.path.join(STORE_DIRECTORY, f"{self.dataset}.ta.{self.key}.checkpoint.jsonl"))
+
+        # scrape for restaurant location id's from trip advisor
+        # using osm location and category restaurant
+        location_ids = harvester.location_ids(points)
+        print(f"found location ids for {len(location_ids)} restaurants")
+
+        # scrape for location details using locations ids
+        location_details = harvester.location_details(location_ids)
+
+        # flatten the location_details hierarchy
+        df = pd.json_normalize(location_details)
+
+        # coordinates as Point object
+        df["point"] = df.apply(lambda row : Point(float(row["longitude"]), float(row["latitude"])), axis = 1)
+
+        # ranking percentile - 799th out of 2164 restaurants in zurich - top 36%
+        df = df.drop(df[df["ranking_data.ranking"].isna()].index)
+        df = df.drop(df[df["ranking_data.ranking_out_of"].isna()].index)
+        df["ranking_percentile"] = df.apply(lambda row : 100 * (int(row["ranking_data.ranking"]) / int(row["ranking_data.ranking_out_of"])), axis = 1)
+
+        # store the data frame
+        store.save(self.dataset, "ta", self.key, df)
+        return df
 
     
+    def assign_cells(self, ground_df):
+        """
+        Assigns every restaurant to the id of the ground cell containing it, -1 if outside the ground
+        ground_df - scouting ground data frame with id and area columns
+        """
+        print(f"Assigning {len(self.df)} restaurants to {len(ground_df)} scouting ground cells")
+        tree = STRtree(ground_df["area"].values)
+        point_index, area_index = tree.query(self.df["point"].values, predicate = "within")
+
+        # a point within overlapping cell edges goes to the first of the cells
+        order = np.lexsort((area_index, point_index))
+        points, first = np.unique(point_index[order], return_index = True)
+        cell_ids = np.full(len(self.df), -1, dtype = np.int64)
+        cell_ids[points] = ground_df["id"].values[area_index[order][first]]
+        self.df["cell_id"] = cell_ids
+
     def populate_ground(self, ground_df):
         print(f"Populating scouting ground from tripadvisor data")
 
-        ground_df["restaurants"] = ground_df["area"].apply(lambda area: self.df["point"].map(area.contains)).sum(axis = 1)
-        ground_df["median_ranking_percentile"] = ground_df["area"].apply(lambda area: self.df.apply(lambda resto : resto["ranking_percentile"] if area.contains(resto["point"]) else np.NaN, axis = 1)).median(axis = 1)
+        self.assign_cells(ground_df)
+        return self.populate_cells(ground_df)
+
+    def populate_cells(self, ground_df):
+        """
+        Populates restaurant counts and rankings of ground cells, restaurants need to be assigned to cells first
+        """
+        in_ground = self.df[self.df["cell_id"] >= 0]
+        cells = in_ground.groupby("cell_id")
+
+        ground_df["restaurants"] = ground_df["id"].map(cells.size()).fillna(0).astype(np.int64)
+        ground_df["median_ranking_percentile"] = ground_df["id"].map(cells["ranking_percentile"].median())
 
         # successful restaurant - ranking in top 30 percentile
-        successful = self.df[(self.df["ranking_percentile"] < 30)].copy()
-        ground_df["successful_restaurants"] = ground_df["area"].apply(lambda area: successful["point"].map(area.contains)).sum(axis = 1)
+        successful = in_ground[(in_ground["ranking_percentile"] < 30)]
+        ground_df["successful_restaurants"] = ground_df["id"].map(successful.groupby("cell_id").size()).fillna(0).astype(np.int64)
         ground_df["successful_restaurants_any"] =  ground_df["successful_restaurants"].map(lambda count: 1 if count > 0 else 0)
 
         """
@@ -100,15 +135,10 @@ class TripAdvisorExtractor:
         return ground_df
 
     def get_ranked_restaurants_in_locations(self, locations):
-        "Return ranked list of restaurants in given area"
-
-        def contained_in_any(point, locs):
-            for l in locs:
-                if l.contains(point):
-                    return True
-            return False
+        "Return ranked list of restaurants in given area, restaurants need to be assigned to cells first"
 
-        restaurants = self.df[self.df.apply(lambda r: contained_in_any(r["point"], locations), axis = 1)].copy()
+        # locations are indexed by cell id
+        restaurants = self.df[self.df["cell_id"].isin(locations.index)].copy()
         return restaurants.sort_values(by = ["ranking_percentile"])
 
 
@@ -116,7 +146,7 @@ if __name__ == "__main__":
     geojson_file = "./data/zurich.geojson"
 
     osm_extractor = OSMExtractor(geojson_file)
-    tripadvisor_extractor = TripAdvisorExtractor(geojson_file, osm_extractor.all_restaurants())
+    tripadvisor_extractor = TripAdvisorExtractor(geojson_file, osm_extractor)
     tripadvisor_extractor.df.to_clipboard()
 
     
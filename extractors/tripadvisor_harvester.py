@@ -0,0 +1,165 @@
+import os
+import json
+import time
+import threading
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+WORKERS = 8 # concurrent requests
+RATE_LIMIT = 20 # requests per second and api key
+RETRIES = 5
+BACKOFF = 0.5 # seconds before first retry, doubled with every next retry
+TIMEOUT = 30 # seconds
+
+RETRY_STATUS = {429} # retried next to 5xx responses, other 4xx responses skip the record
+
+class RateLimiter:
+    """
+    Spaces out calls evenly to at most rate calls per second across all threads
+    """
+
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_call = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call = max(now, self.next_call)
+            self.next_call = call + self.interval
+        if call > now:
+            time.sleep(call - now)
+
+class Checkpoint:
+    """
+    Append only json lines file of finished requests, survives restarts of the harvest.
+    A line cut short by a crash is ignored on load.
+    """
+
+    def __init__(self, checkpoint_file):
+        self.checkpoint_file = checkpoint_file
+        self.results = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.results[record["request"]] = record["result"]
+            print(f"Resuming from checkpoint {checkpoint_file} with {len(self.results)} finished requests")
+        else:
+            os.makedirs(os.path.dirname(checkpoint_file) or ".", exist_ok = True)
+
+    def __contains__(self, request):
+        return request in self.results
+
+    def get(self, request):
+        return self.results[request]
+
+    def add(self, request, result):
+        with self.lock:
+            self.results[request] = result
+            with open(self.checkpoint_file, "a") as f:
+                f.write(json.dumps({"request": request, "result": result}) + "\n")
+
+class TripAdvisorHarvester:
+    """
+    Scrapes TripAdvisor location mapper and location details api with a pooled http session,
+    bounded number of concurrent requests and rate limit per api key.
+    Failed requests are retried with exponential backoff, finished ones checkpointed on disk.
+    """
+
+    def __init__(self, base_url, mapper_key, location_key, checkpoint_file,
+        workers = WORKERS, rate_limit = RATE_LIMIT, retries = RETRIES, backoff = BACKOFF):
+        """
+        base_url - TripAdvisor partner api url
+        mapper_key, location_key - api keys for location mapper and location details
+        checkpoint_file - path to checkpoint of finished requests
+        workers - number of concurrent requests
+        rate_limit - requests per second and api key
+        retries - attempts per request on connection errors, 429 and 5xx responses, one attempt at least
+        backoff - seconds before first retry, doubled with every next retry
+        """
+        self.base_url = base_url
+        self.mapper_key = mapper_key
+        self.location_key = location_key
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+
+        self.checkpoint = Checkpoint(checkpoint_file)
+        self.rate_limiters = {
+            mapper_key: RateLimiter(rate_limit),
+            location_key: RateLimiter(rate_limit)
+        }
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections = workers, pool_maxsize = workers)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def get(self, path, params):
+        """
+        Returns json response of GET request to given api path, retried with backoff on transient failures.
+        A 4xx response other than 429 is not retried - an error response is returned and the record left out like the api's own error responses
+        """
+        attempts = max(self.retries, 1)
+        for attempt in range(attempts):
+            self.rate_limiters[params["key"]].wait()
+            try:
+                response = self.session.get(f"{self.base_url}/{path}", params = params, timeout = TIMEOUT)
+                if response.status_code < 400:
+                    return response.json()
+                if response.status_code not in RETRY_STATUS and response.status_code < 500:
+                    print(f"Skipping {path} after {response.status_code} response")
+                    return {"error": {"status": response.status_code, "message": response.reason}}
+                error = requests.HTTPError(f"{response.status_code} response for {path}")
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+
+            if attempt + 1 < attempts:
+                print(f"Retrying {path} after {error}")
+                time.sleep(self.backoff * 2 ** attempt)
+        raise error
+
+    def map(self, paths, params):
+        """
+        Requests all api paths not in checkpoint concurrently and returns responses for all paths
+        paths - list of unique api paths
+        params - query parameters of the requests
+        """
+        pending = [path for path in paths if path not in self.checkpoint]
+        print(f"{len(paths) - len(pending)} of {len(paths)} requests found in checkpoint, requesting {len(pending)}")
+
+        def run(path):
+            self.checkpoint.add(path, self.get(path, params))
+
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            # consume results to raise the first failure once all requests ran
+            for _ in executor.map(run, pending):
+                pass
+
+        return [self.checkpoint.get(path) for path in paths]
+
+    def location_ids(self, points):
+        """
+        Returns set of TripAdvisor restaurant location ids mapped to given points
+        points - list of (longitude, latitude)
+        """
+        paths = sorted({f"location_mapper/{latitude},{longitude}" for longitude, latitude in points})
+        responses = self.map(paths, {"key": self.mapper_key, "category": "restaurants"})
+        return {r["location_id"] for response in responses if response.get("data") for r in response["data"]}
+
+    def location_details(self, location_ids):
+        """
+        Returns list of location details for given location ids, locations with an error response are left out
+        """
+        paths = [f"location/{location_id}" for location_id in sorted(location_ids)]
+        responses = self.map(paths, {"key": self.location_key})
+        return [response for response in responses if "error" not in response]
@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import numpy as np
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import shapely
+from shapely import STRtree
+from shapely.geometry import shape
+
+from extractors.geojson_reader import read_features
+from feature_store import STORE_DIRECTORY
+
+GEOCODE_URL = "http://dev.virtualearth.net/REST/v1/Locations"
+GEOCODE_API_KEY = ""
+
+ZIPCODE_PROPERTY = "postal_code" # OSM boundary=postal_code tag
+UNKNOWN_ZIPCODE = -1
+
+BATCH_SIZE = 100 # remote lookups between cache writes
+WORKERS = 8 # concurrent remote lookups
+
+def read_postal_areas(boundaries_file, zipcode_property = ZIPCODE_PROPERTY):
+    """
+    returns array of postal code area polygons and array of their zip codes
+    """
+    start_time = time.time()
+    areas = []
+    zipcodes = []
+    for feature in read_features(boundaries_file):
+        zipcode = (feature.get("properties") or {}).get(zipcode_property)
+        if zipcode is not None and feature.get("geometry"):
+            areas.append(shape(feature["geometry"]))
+            zipcodes.append(int(zipcode))
+    print(f"Loaded {len(areas)} postal code areas in {(time.time() - start_time)} seconds")
+    return np.array(areas, dtype = object), np.array(zipcodes, dtype = np.int64)
+
+class ZipcodeResolver:
+    """
+    Resolves zip codes of points offline from postal code boundaries.
+    Points not covered by the boundaries fall back to Bing reverse geocoding,
+    remote results are cached on disk per dataset and never requested again.
+    """
+
+    def __init__(self, dataset, boundaries_file = None, zipcode_property = ZIPCODE_PROPERTY, resolved_df = None):
+        """
+        dataset - name of the dataset to identify remote lookup cache
+        boundaries_file - path to .geojson file with postal code areas, None to resolve remotely only
+        zipcode_property - feature property holding the zip code
+        resolved_df - data frame of areas with zip codes resolved before, e.g. cells of a coarser ground,
+            points the boundaries do not cover take the zip code of the area containing them
+        """
+        self.cache_file = os.path.join(STORE_DIRECTORY, f"{dataset}.zipcode.cache.json")
+        self.cache = {}
+        if os.path.exists(self.cache_file):
+            with open(self.cache_file) as f:
+                self.cache = json.load(f)
+
+        areas = np.array([], dtype = object)
+        self.zipcodes = np.array([], dtype = np.int64)
+        if boundaries_file is not None and os.path.exists(boundaries_file):
+            areas, self.zipcodes = read_postal_areas(boundaries_file, zipcode_property)
+        elif boundaries_file is not None:
+            print(f"No postal code boundaries found at {boundaries_file} - zip codes will be resolved remotely")
+
+        self.tree = STRtree(areas)
+
+        self.resolved_tree = None
+        if resolved_df is not None:
+            resolved_df = resolved_df[resolved_df["zipcode"] != UNKNOWN_ZIPCODE]
+            self.resolved_tree = STRtree(resolved_df["area"].values)
+            self.resolved_zipcodes = resolved_df["zipcode"].values.astype(np.int64)
+            # grounds of other projections are shifted a little - points up to an area side away take the nearest area
+            bounds = shapely.bounds(resolved_df["area"].values)
+            self.resolved_distance = np.median(np.maximum(bounds[:, 2] - bounds[:, 0], bounds[:, 3] - bounds[:, 1]))
+            print(f"Using zip codes of {len(resolved_df)} areas resolved before")
+
+    def resolve(self, points):
+        """
+        points - array of shapely points
+
+        returns array of zip codes, UNKNOWN_ZIPCODE where neither the boundaries nor remote lookup know one
+        """
+        start_time = time.time()
+        point_index, area_index = self.tree.query(points, predicate = "intersects")
+
+        # points on a shared boundary take the first postal area
+        order = np.lexsort((area_index, point_index))
+        resolved, first = np.unique(point_index[order], return_index = True)
+        zipcodes = np.full(len(points), UNKNOWN_ZIPCODE, dtype = np.int64)
+        zipcodes[resolved] = self.zipcodes[area_index[order][first]]
+        print(f"Resolved {len(resolved)} of {len(points)} zip codes from postal code boundaries in {(time.time() - start_time)} seconds")
+
+        unresolved = np.flatnonzero(zipcodes == UNKNOWN_ZIPCODE)
+        if len(unresolved) and self.resolved_tree is not None:
+            point_index, area_index = self.resolved_tree.query_nearest(points[unresolved], max_distance = self.resolved_distance,
+                all_matches = False)
+            zipcodes[unresolved[point_index]] = self.resolved_zipcodes[area_index]
+            print(f"Resolved {len(point_index)} of {len(unresolved)} zip codes left from areas resolved before")
+            unresolved = np.flatnonzero(zipcodes == UNKNOWN_ZIPCODE)
+        if len(unresolved):
+            coordinates = [self.__cache_key(points[i]) for i in unresolved]
+            self.__lookup_remote([c for c in dict.fromkeys(coordinates) if c not in self.cache])
+            zipcodes[unresolved] = [self.cache[c] for c in coordinates]
+
+        return zipcodes
+
+    def __cache_key(self, point):
+        return f"{point.y:.6f},{point.x:.6f}"
+
+    def __lookup_remote(self, coordinates):
+        """
+        Reverse geocodes given "latitude,longitude" coordinates in batches of concurrent requests,
+        writing the cache after every batch
+        """
+        if not coordinates:
+            return
+        print(f"Resolving {len(coordinates)} zip codes remotely")
+
+        session = requests.Session()
+        session.mount("http://", HTTPAdapter(pool_connections = WORKERS, pool_maxsize = WORKERS))
+
+        def get_zipcode(coordinate):
+            response = session.get(f"{GEOCODE_URL}/{coordinate}", params = {"key" : GEOCODE_API_KEY})
+            response.raise_for_status()
+            resources = response.json()["resourceSets"][0]["resources"]
+            postal_code = resources[0]["address"].get("postalCode") if resources else None
+            return int(postal_code) if postal_code else UNKNOWN_ZIPCODE
+
+        with ThreadPoolExecutor(max_workers = WORKERS) as executor:
+            for start in range(0, len(coordinates), BATCH_SIZE):
+                batch = coordinates[start:start + BATCH_SIZE]
+                self.cache.update(zip(batch, executor.map(get_zipcode, batch)))
+                self.__save_cache()
+                print(f"Resolved {min(start + BATCH_SIZE, len(coordinates))} of {len(coordinates)} zip codes remotely")
+
+    def __save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok = True)
+        tmp_file = f"{self.cache_file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump(self.cache, f)
+        os.replace(tmp_file, self.cache_file)
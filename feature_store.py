@@ -0,0 +1,201 @@
+import os
+import json
+import shutil
+import hashlib
+import pickle
+import numpy as np
+import pandas as pd
+
+import shapely
+from shapely.geometry.base import BaseGeometry
+
+from metrics import metrics
+
+STORE_DIRECTORY = "store"
+LEGACY_PICKLE_DIRECTORY = "pickle"
+
+NUMERIC = "numeric"
+GEOMETRY = "geometry"
+OBJECT = "object"
+
+def fingerprint(*inputs):
+    """
+    Returns short hash of stage inputs and parameters
+    inputs - parameters, paths to input files (hashed by size and modification time) and data frames (hashed by content)
+    """
+    digest = hashlib.sha1()
+    for value in inputs:
+        if isinstance(value, (pd.DataFrame, pd.Series)):
+            frame = value.to_frame() if isinstance(value, pd.Series) else value
+            for column in frame.columns:
+                values = frame[column]
+                kind = _kind(values)
+                if kind == GEOMETRY:
+                    values = pd.Series(shapely.to_wkb(values.values, hex = True), index = values.index)
+                elif kind == OBJECT:
+                    values = values.map(repr)
+                digest.update(str(column).encode())
+                digest.update(pd.util.hash_pandas_object(values).values.tobytes())
+        elif isinstance(value, str) and os.path.isfile(value):
+            stat = os.stat(value)
+            digest.update(f"{os.path.basename(value)}:{stat.st_size}:{stat.st_mtime_ns}".encode())
+        else:
+            digest.update(repr(value).encode())
+    return digest.hexdigest()[:16]
+
+def _kind(values):
+    if values.dtype.kind in "biuf":
+        return NUMERIC
+    first_valid = values.first_valid_index()
+    if first_valid is not None and isinstance(values[first_valid], BaseGeometry):
+        return GEOMETRY
+    return OBJECT
+
+class FeatureStore:
+    """
+    Columnar on disk cache for data frames of the pipeline stages.
+    Entries are keyed by dataset, stage and a fingerprint of the stage inputs and parameters.
+    Numeric columns are stored as .npy files which are memory-mapped on load, geometries as WKB
+    and any other column pickled on its own, so single columns can be loaded without the rest.
+    """
+
+    def __init__(self, directory = STORE_DIRECTORY, legacy_directory = LEGACY_PICKLE_DIRECTORY):
+        """
+        directory - root directory of the store
+        legacy_directory - directory with {dataset}.{stage}.df.pickle files of the pipeline before the store,
+            adopted only for the key of the parameters and inputs they were built with
+        """
+        self.directory = directory
+        self.legacy_directory = legacy_directory
+        # serving processes only read - a missing entry raises instead of triggering a rebuild
+        self.read_only = False
+
+    def path(self, dataset, stage, key):
+        return os.path.join(self.directory, f"{dataset}.{stage}.{key}")
+
+    def exists(self, dataset, stage, key):
+        return os.path.exists(os.path.join(self.path(dataset, stage, key), "meta.json"))
+
+    def meta(self, dataset, stage, key):
+        with open(os.path.join(self.path(dataset, stage, key), "meta.json")) as f:
+            return json.load(f)
+
+    def save(self, dataset, stage, key, df):
+        """
+        Saves data frame as entry of given stage, replacing an existing entry atomically
+        """
+        if self.read_only:
+            raise RuntimeError(f"Feature store is read only, can not save {stage} of {dataset}")
+        path = self.path(dataset, stage, key)
+        tmp_path = f"{path}.tmp{os.getpid()}"
+        shutil.rmtree(tmp_path, ignore_errors = True)
+        os.makedirs(tmp_path)
+
+        columns = []
+        for i, column in enumerate(df.columns):
+            kind = _kind(df[column])
+            self.__save_values(tmp_path, f"c{i}", kind, df[column].values)
+            columns.append({"name": column, "kind": kind, "file": f"c{i}"})
+        index_kind = NUMERIC if df.index.dtype.kind in "biuf" else OBJECT
+        self.__save_values(tmp_path, "index", index_kind, df.index.values)
+
+        with open(os.path.join(tmp_path, "meta.json"), "w") as f:
+            json.dump({"rows": len(df), "columns": columns, "index": index_kind}, f)
+
+        shutil.rmtree(path, ignore_errors = True)
+        os.replace(tmp_path, path)
+
+    def load(self, dataset, stage, key, columns = None, legacy_key = None, legacy_inputs = ()):
+        """
+        Returns data frame of given stage entry, None if there is no entry
+        columns - names of the columns to load, all columns if None
+        legacy_key - key of the parameters and inputs the legacy pickle of the stage was built with, no legacy pickle is adopted if None
+        legacy_inputs - input files of the legacy pickle, it is not adopted once one of them changed after it was written
+        """
+        if not self.exists(dataset, stage, key):
+            if self.read_only:
+                metrics.cache_access(stage, "miss")
+                raise RuntimeError(f"No {stage} of {dataset} with key {key} in read only feature store")
+            df = self.__adopt_legacy_pickle(dataset, stage, key, legacy_inputs) if key == legacy_key else None
+            metrics.cache_access(stage, "miss" if df is None else "legacy")
+            return df if df is None or columns is None else df[[c for c in df.columns if c in columns]]
+
+        metrics.cache_access(stage, "hit")
+        meta = self.meta(dataset, stage, key)
+        path = self.path(dataset, stage, key)
+        index = self.__load_values(path, "index", meta["index"])
+        data = {
+            c["name"]: self.__load_values(path, c["file"], c["kind"])
+            for c in meta["columns"] if columns is None or c["name"] in columns
+        }
+        return pd.DataFrame(data, index = index, columns = list(data))
+
+    def load_arrays(self, dataset, stage, key, columns = None):
+        """
+        Returns dictionary of read-only memory-mapped arrays of numeric columns of given stage entry, None if there is no entry -
+        no data frame is built, so nothing is copied and only the pages used are read
+        columns - names of the numeric columns to load, all numeric columns if None
+        """
+        if not self.exists(dataset, stage, key):
+            metrics.cache_access(stage, "miss")
+            if self.read_only:
+                raise RuntimeError(f"No {stage} of {dataset} with key {key} in read only feature store")
+            return None
+
+        metrics.cache_access(stage, "hit")
+        meta = self.meta(dataset, stage, key)
+        path = self.path(dataset, stage, key)
+        files = {c["name"]: c["file"] for c in meta["columns"] if c["kind"] == NUMERIC}
+        names = list(files) if columns is None else columns
+        # plain arrays viewing the maps, numpy scalars and slices of them are no memmaps
+        return {name: self.__load_values(path, files[name], NUMERIC).view(np.ndarray) for name in names}
+
+    def __save_values(self, path, name, kind, values):
+        if kind == NUMERIC:
+            np.save(os.path.join(path, f"{name}.npy"), values)
+        elif kind == GEOMETRY:
+            # WKB of all geometries concatenated with offsets, empty slice for missing geometries
+            geometries = np.array([g if isinstance(g, BaseGeometry) else None for g in values], dtype = object)
+            wkb = [b"" if b is None else b for b in shapely.to_wkb(geometries)]
+            offsets = np.cumsum([0] + [len(b) for b in wkb], dtype = np.int64)
+            np.save(os.path.join(path, f"{name}.offsets.npy"), offsets)
+            with open(os.path.join(path, f"{name}.wkb"), "wb") as f:
+                f.write(b"".join(wkb))
+        else:
+            with open(os.path.join(path, f"{name}.pickle"), "wb") as f:
+                pickle.dump(values, f, protocol = pickle.HIGHEST_PROTOCOL)
+
+    def __load_values(self, path, name, kind):
+        if kind == NUMERIC:
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode = "r")
+        elif kind == GEOMETRY:
+            offsets = np.load(os.path.join(path, f"{name}.offsets.npy"))
+            with open(os.path.join(path, f"{name}.wkb"), "rb") as f:
+                wkb = f.read()
+            return shapely.from_wkb(np.array(
+                [wkb[start:end] if end > start else None for start, end in zip(offsets[:-1], offsets[1:])],
+                dtype = object
+            ))
+        else:
+            with open(os.path.join(path, f"{name}.pickle"), "rb") as f:
+                return pickle.load(f)
+
+    def __adopt_legacy_pickle(self, dataset, stage, key, legacy_inputs):
+        """
+        Pickles written before the store are keyed by dataset only - they are adopted for the key of the parameters
+        they were built with, as long as their input files are not newer than them
+        """
+        legacy_pickle = os.path.join(self.legacy_directory, f"{dataset}.{stage}.df.pickle")
+        if not os.path.exists(legacy_pickle):
+            return None
+        changed = [f for f in legacy_inputs if os.path.exists(f) and os.path.getmtime(f) > os.path.getmtime(legacy_pickle)]
+        if changed:
+            print(f"Not adopting {legacy_pickle} - {changed} changed after it was written")
+            return None
+
+        print(f"Adopting {legacy_pickle} into feature store for {stage} key {key} - delete it to rebuild")
+        df = pd.read_pickle(legacy_pickle)
+        self.save(dataset, stage, key, df)
+        return df
+
+store = FeatureStore()
@@ -0,0 +1,151 @@
+"""
+In process metrics of the pipeline and the API, exposed in Prometheus text format by /metrics of api.py.
+
+Build stages record wall time, CPU time and peak memory, feature store entries and models their cache hits and misses,
+requests their latency per phase. Request console output is switched off with REQUEST_LOGGING=0.
+"""
+import os
+import time
+import logging
+import threading
+import contextlib
+from bisect import bisect_left
+
+PREFIX = "location_ai"
+
+# seconds - requests served from pre-rendered responses take well below a millisecond
+REQUEST_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+class PeakMemory:
+    """
+    Samples resident memory of the process in a background thread, GEOS and numpy allocations included
+    """
+
+    INTERVAL = 0.005 # seconds
+
+    def __init__(self):
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+    def rss(self):
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            # peak of the whole process where /proc is not available
+            import resource
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def __enter__(self):
+        self.peak = self.rss()
+        self.running = True
+        self.thread = threading.Thread(target = self.__sample, daemon = True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.rss())
+
+    def __sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.rss())
+            time.sleep(self.INTERVAL)
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class Metrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stages = {} # stage name to wall seconds, cpu seconds and peak memory of its last run
+        self.cache = {} # (artifact, result) to number of lookups
+        self.phases = {} # (endpoint, phase) to latency histogram
+        self.request_logging = os.environ.get("REQUEST_LOGGING", "1") != "0"
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Records wall time, CPU time and peak resident memory of a build stage
+        """
+        with PeakMemory() as memory:
+            wall_start, cpu_start = time.perf_counter(), time.process_time()
+            yield
+            wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        with self.lock:
+            self.stages[name] = {"wall_seconds": wall, "cpu_seconds": cpu, "peak_memory_bytes": memory.peak}
+
+    def cache_access(self, artifact, result):
+        """
+        artifact - feature store stage or model
+        result - hit, miss or legacy for adopted pickles
+        """
+        with self.lock:
+            self.cache[(artifact, result)] = self.cache.get((artifact, result), 0) + 1
+
+    @contextlib.contextmanager
+    def phase(self, endpoint, phase):
+        """
+        Records latency of a request phase - cell_lookup, restaurant_filtering or serialization
+        """
+        start_time = time.perf_counter()
+        yield
+        seconds = time.perf_counter() - start_time
+        with self.lock:
+            if (endpoint, phase) not in self.phases:
+                self.phases[(endpoint, phase)] = Histogram(REQUEST_BUCKETS)
+            self.phases[(endpoint, phase)].observe(seconds)
+
+    def set_request_logging(self, enabled):
+        """
+        Switches console output of every request on or off, werkzeug access log included
+        """
+        self.request_logging = enabled
+        logging.getLogger("werkzeug").setLevel(logging.INFO if enabled else logging.ERROR)
+
+    def log_request(self, *args):
+        if self.request_logging:
+            print(*args)
+
+    def render(self):
+        """
+        returns all metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            lines = []
+            for metric, field, help in [
+                ("stage_wall_seconds", "wall_seconds", "Wall time of the last run of a build stage"),
+                ("stage_cpu_seconds", "cpu_seconds", "CPU time of the last run of a build stage"),
+                ("stage_peak_memory_bytes", "peak_memory_bytes", "Peak resident memory during the last run of a build stage")
+            ]:
+                lines += [f"# HELP {PREFIX}_{metric} {help}", f"# TYPE {PREFIX}_{metric} gauge"]
+                lines += [f'{PREFIX}_{metric}{{stage="{name}"}} {values[field]}' for name, values in sorted(self.stages.items())]
+
+            lines += [f"# HELP {PREFIX}_cache_lookups_total Feature store entry and model lookups by result",
+                f"# TYPE {PREFIX}_cache_lookups_total counter"]
+            lines += [f'{PREFIX}_cache_lookups_total{{artifact="{artifact}",result="{result}"}} {count}'
+                for (artifact, result), count in sorted(self.cache.items())]
+
+            lines += [f"# HELP {PREFIX}_request_phase_seconds Request latency by endpoint and phase",
+                f"# TYPE {PREFIX}_request_phase_seconds histogram"]
+            for (endpoint, phase), histogram in sorted(self.phases.items()):
+                labels = f'endpoint="{endpoint}",phase="{phase}"'
+                cumulative = 0
+                for bucket, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+                    cumulative += count
+                    lines.append(f'{PREFIX}_request_phase_seconds_bucket{{{labels},le="{bucket}"}} {cumulative}')
+                lines.append(f"{PREFIX}_request_phase_seconds_sum{{{labels}}} {histogram.sum}")
+                lines.append(f"{PREFIX}_request_phase_seconds_count{{{labels}}} {histogram.count}")
+
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
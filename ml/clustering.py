@@ -0,0 +1,141 @@
+import copy
+import numpy as np
+
+WARD = "ward"
+WARD_GRID = "ward_grid"
+MINIBATCH_KMEANS = "minibatch_kmeans"
+BACKENDS = (WARD, WARD_GRID, MINIBATCH_KMEANS)
+
+def grid_connectivity(cell_ids, columns):
+    """
+    Returns sparse adjacency matrix of given cells on a grid - cells sharing an edge or a corner are connected
+    cell_ids - ids of the cells numbered row by row
+    columns - number of columns of the grid
+    """
+    from scipy import sparse
+
+    cell_ids = np.asarray(cell_ids)
+    order = np.argsort(cell_ids)
+    sorted_ids = cell_ids[order]
+    rows, cols = np.divmod(cell_ids, columns)
+
+    sources = []
+    targets = []
+    for dr in (-1, 0, 1):
+        for dc in (-1, 0, 1):
+            if dr == 0 and dc == 0:
+                continue
+            neighbour_cols = cols + dc
+            neighbour_ids = (rows + dr) * columns + neighbour_cols
+            position = np.minimum(np.searchsorted(sorted_ids, neighbour_ids), len(sorted_ids) - 1)
+            found = (neighbour_cols >= 0) & (neighbour_cols < columns) & (sorted_ids[position] == neighbour_ids)
+            sources.append(np.flatnonzero(found))
+            targets.append(order[position[found]])
+
+    sources = np.concatenate(sources)
+    targets = np.concatenate(targets)
+    return sparse.csr_matrix((np.ones(len(sources)), (sources, targets)), shape = (len(cell_ids), len(cell_ids)))
+
+def linkage_matrix(children):
+    """
+    Returns scipy linkage matrix of a merge tree, heights are the merge order so a cut at any number of clusters
+    undoes the last merges
+    children - merged nodes of every merge in merge order, leaves first then merges numbered from the number of leaves
+    """
+    n = len(children) + 1
+    sizes = np.ones(2 * n - 1)
+    for i, (a, b) in enumerate(children):
+        sizes[n + i] = sizes[a] + sizes[b]
+    return np.column_stack([children, np.arange(1, n), sizes[n:]]).astype(float)
+
+def centroids(X, labels, n_clusters):
+    counts = np.bincount(labels, minlength = n_clusters)
+    centers = np.zeros((n_clusters, X.shape[1]))
+    np.add.at(centers, labels, X)
+    return centers / np.maximum(counts, 1)[:, None]
+
+class ClusterModel:
+    """
+    Clusters normalized cell feature vectors with a pluggable backend:
+    ward - Ward linkage agglomerative clustering, quadratic in the number of cells
+    ward_grid - Ward linkage constrained to neighbouring grid cells, sparse connectivity keeps it tractable for large grounds
+    minibatch_kmeans - mini-batch k-means, linear in the number of cells
+
+    Unseen feature vectors are assigned to the nearest cluster centroid without refitting.
+    Ward backends keep the full linkage tree, a clustering of any number of clusters is a cut of it.
+    Only labels, centroids and the linkage tree are kept after fitting, so loading a fitted model needs no scikit-learn.
+    """
+
+    def __init__(self, n_clusters, backend = WARD, seed = 0):
+        """
+        n_clusters - number of clusters
+        backend - one of BACKENDS
+        seed - random state of randomized backends
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Unknown clustering backend {backend}, expected one of {BACKENDS}")
+        self.n_clusters = n_clusters
+        self.backend = backend
+        self.seed = seed
+
+    def fit_predict(self, X, cell_ids = None, columns = None):
+        """
+        X - normalized feature vectors
+        cell_ids, columns - ids of the cells and number of grid columns, required by the ward_grid backend
+
+        returns cluster label of every feature vector
+        """
+        if self.backend == MINIBATCH_KMEANS:
+            from sklearn.cluster import MiniBatchKMeans
+            model = MiniBatchKMeans(n_clusters = self.n_clusters, random_state = self.seed, n_init = 3)
+            self.linkage_ = None
+            self.labels_ = model.fit_predict(X)
+        else:
+            from sklearn.cluster import ward_tree
+            connectivity = grid_connectivity(cell_ids, columns) if self.backend == WARD_GRID else None
+            # the full tree, as agglomerative clustering builds it, cut at the number of clusters
+            children = ward_tree(X, connectivity = connectivity)[0]
+            self.linkage_ = linkage_matrix(children)
+            self.labels_ = self.cut(self.n_clusters)
+
+        # centroid of every cluster for assignment of unseen vectors
+        self.centroids_ = centroids(X, self.labels_, self.n_clusters)
+        return self.labels_
+
+    def cut(self, n_clusters):
+        """
+        returns cluster label of every fitted feature vector with the linkage tree cut into n_clusters clusters
+        """
+        if getattr(self, "linkage_", None) is None:
+            raise ValueError(f"{self.backend} clustering has no linkage tree, it has {self.n_clusters} clusters only")
+        if not 1 <= n_clusters <= len(self.linkage_) + 1:
+            raise ValueError(f"Number of clusters must be between 1 and {len(self.linkage_) + 1}")
+        from scipy.cluster.hierarchy import fcluster
+        return fcluster(self.linkage_, n_clusters, criterion = "maxclust") - 1
+
+    def at(self, n_clusters, X):
+        """
+        n_clusters - number of clusters
+        X - fitted feature vectors
+
+        returns model of the same linkage tree with n_clusters clusters, without refitting
+        """
+        model = copy.copy(self)
+        model.n_clusters = n_clusters
+        model.labels_ = self.cut(n_clusters)
+        model.centroids_ = centroids(np.asarray(X, dtype = float), model.labels_, n_clusters)
+        return model
+
+    def predict(self, X):
+        """
+        X - normalized feature vectors
+
+        returns label of the nearest cluster centroid for every feature vector
+        """
+        X = np.asarray(X, dtype = float)
+        distances = (
+            (X ** 2).sum(axis = 1)[:, None]
+            - 2 * X @ self.centroids_.T
+            + (self.centroids_ ** 2).sum(axis = 1)[None, :]
+        )
+        return distances.argmin(axis = 1)
@@ -1,27 +1,49 @@
 import os.path
+import time
 import pandas as pd   
 import numpy as np
 
-from sklearn import metrics
-from sklearn import preprocessing
-from sklearn.feature_selection import RFECV, RFE
-from sklearn.model_selection import cross_val_score, StratifiedKFold
-from sklearn.svm import SVC
-from sklearn.linear_model import LogisticRegression, LogisticRegressionCV
-from sklearn.cluster import AgglomerativeClustering
+# scikit-learn is imported where models are built - serving loads persisted models and cluster labels only
+
+from feature_store import store, fingerprint, STORE_DIRECTORY
+from ml.clustering import ClusterModel, WARD
+from metrics import metrics
 
 SEED = 0
+N_CLUSTERS = 20
+CLUSTER_BACKEND = WARD
+MODEL_VERSION = 4 # bump when model building changes to invalidate persisted models
 
 class ModelBuilder:
-    def __init__(self, dataset, df_raw, id_feature, model_features, target):
-        pickle_reg = f"pickle/{dataset}.model.reg.df.pickle"
-        pickle_cluster = f"pickle/{dataset}.model.cluster.df.pickle"
+    def __init__(self, dataset, df_raw, id_feature, model_features, target, cluster_backend = CLUSTER_BACKEND, grid_columns = None):
+        """
+        dataset - name of the dataset to identify feature store entries
+        df_raw - populated scouting ground data frame
+        id_feature, model_features, target - cell id, candidate feature and target columns
+        cluster_backend - clustering backend, one of ml.clustering.BACKENDS
+        grid_columns - number of ground grid columns, required by the ward_grid backend
+        """
+        self.dataset = dataset
+        self.key = fingerprint(df_raw[[id_feature] + model_features + [target]], id_feature, model_features, target, MODEL_VERSION)
+        self.id_feature = id_feature
+        self.model_features = model_features
+        self.cluster_backend = cluster_backend
+        self._reg_model = None
+        self._cluster_model = None
+
+        # log1p and min max scaling of the cluster data - kept to assign clusters to unseen cells
+        df_complete = df_raw[[id_feature] + model_features + [target]].dropna()
+        X = np.log1p(df_complete[model_features].values.astype(float))
+        self.feature_min = X.min(axis = 0)
+        self.feature_range = X.max(axis = 0) - self.feature_min
+        self.feature_range[self.feature_range == 0] = 1
 
-        # read from pickle if exists
-        if os.path.exists(pickle_reg) and os.path.exists(pickle_cluster):
-            print("Yeeh, found model dataframe pickles - will be loading data from there")
-            self.df_reg = pd.read_pickle(pickle_reg)
-            self.df_cluster = pd.read_pickle(pickle_cluster)
+        # read from feature store if exists - legacy pickles were built before MODEL_VERSION and are never adopted
+        self.df_reg = store.load(dataset, "model.reg", self.key)
+        self.df_cluster = store.load(dataset, "model.cluster", self.key)
+
+        if self.df_reg is not None and self.df_cluster is not None:
+            print("Yeeh, found model data frames in feature store - will be loading data from there")
 
         else:
             # Keep only features and target, drop NA
@@ -32,18 +54,20 @@ class ModelBuilder:
             df = df_raw[[id_feature] + model_features + [target]].dropna().copy()
             print(f"After dropping NA {len(df)} rows left")
 
-            # Class count
-            count_class_0, count_class_1 = df[target].value_counts()
+            # Class count - coarse levels can have more successful cells than not or no cell of one class at all
+            counts = df[target].value_counts()
+            count_class_0, count_class_1 = counts.get(0, 0), counts.get(1, 0)
             print(f"Target variable value balance: 0: {count_class_0}, 1: {count_class_1}")
             # Divide by class
-            df_class_0 = df[df[target] == 0]
-            df_class_1 = df[df[target] == 1]
+            df_classes = {0: df[df[target] == 0], 1: df[df[target] == 1]}
 
-            print("Combatting imbalanced data by random oversampling")
-            df_class_1_over = df_class_1.sample(count_class_0, replace=True, random_state = SEED)
-            df_reg = pd.concat([df_class_0, df_class_1_over], axis=0).copy()
-            count_class_0, count_class_1 = df_reg[target].value_counts()
-            print(f"After oversampling: 0: {count_class_0}, 1: {count_class_1}")
+            if count_class_0 and count_class_1:
+                print("Combatting imbalanced data by random oversampling")
+                minority = 0 if count_class_0 < count_class_1 else 1
+                df_classes[minority] = df_classes[minority].sample(max(count_class_0, count_class_1), replace=True, random_state = SEED)
+            df_reg = pd.concat([df_classes[0], df_classes[1]], axis=0).copy()
+            counts = df_reg[target].value_counts()
+            print(f"After oversampling: 0: {counts.get(0, 0)}, 1: {counts.get(1, 0)}")
 
             # Features and target array
             X_reg = df_reg.loc[:,model_features].values
@@ -54,32 +78,166 @@ class ModelBuilder:
             X_reg = self.transform_normalize(X_reg)
             X_cluster = self.transform_normalize(X_cluster)
 
-            # select features
-            selected_features = self.__select_features(model_features, X_reg, y_reg)
+            # select features - features can not be ranked by how they separate a single class
+            if count_class_0 and count_class_1:
+                selected_features = self.__select_features(model_features, X_reg, y_reg)
+            else:
+                print(f"Only class {1 if count_class_1 else 0} in the target variable - keeping all features")
+                selected_features = model_features
             print(f"Selected the following {len(selected_features)} features: {selected_features}")
 
             # keep only selected features in the df
             self.df_reg = pd.DataFrame(X_reg, columns = model_features)
             self.df_cluster = pd.DataFrame(X_cluster, columns = model_features)
-            self.df_cluster[id_feature] = df_raw[id_feature].copy()
+            self.df_cluster[id_feature] = df[id_feature].values
             
             self.df_reg = self.df_reg[selected_features]
             self.df_cluster = self.df_cluster[[id_feature] + selected_features]
             self.df_reg[target] = y_reg
 
-            # pickle the data frames
-            self.df_reg.to_pickle(pickle_reg)
-            self.df_cluster.to_pickle(pickle_cluster)
+            # store the data frames
+            store.save(dataset, "model.reg", self.key, self.df_reg)
+            store.save(dataset, "model.cluster", self.key, self.df_cluster)
+
+        self.cluster_features = [c for c in self.df_cluster.columns if c not in [id_feature, "cluster"]]
+        self.reg_features = [c for c in self.df_reg.columns if c != target]
+        # a regression of a single class predicts nothing, no model is fitted
+        self.regression = self.df_reg[target].nunique() > 1
+
+        # fitted models are persisted - fit only the missing ones
+        if not self.regression:
+            print("No regression model of a single class target - success probabilities are unknown")
+        elif os.path.exists(self.model_file("reg")):
+            print("Yeeh, found fitted regression model in feature store - will be loading it on first use")
+            metrics.cache_access("model.reg", "hit")
+        else:
+            metrics.cache_access("model.reg", "miss")
+            self.__check_writable("reg")
+            X_reg = self.df_reg.loc[:,self.df_reg.columns != target].values
+            y_reg = self.df_reg.loc[:,[target]].values
+            self._reg_model = self.__build_reg_model(X_reg, y_reg)
+            self.__save_model("reg", self._reg_model)
+
+        if os.path.exists(self.model_file(f"cluster.{cluster_backend}")):
+            print(f"Yeeh, found fitted {cluster_backend} cluster model in feature store - will be loading it from there")
+            metrics.cache_access(f"model.cluster.{cluster_backend}", "hit")
+        else:
+            metrics.cache_access(f"model.cluster.{cluster_backend}", "miss")
+            self.__check_writable(f"cluster.{cluster_backend}")
+            X_cluster = self.df_cluster[self.cluster_features].values
+            self._cluster_model = self.__build_cluster_model(X_cluster, N_CLUSTERS, grid_columns)
+            self.__save_model(f"cluster.{cluster_backend}", self._cluster_model)
+
+        self.df_cluster["cluster"] = self.cluster_model.labels_
+
+    @classmethod
+    def load(cls, dataset, key, id_feature, cluster_backend = CLUSTER_BACKEND):
+        """
+        Fitted models of given key as serving processes use them - the cluster data and the fitted cluster model
+        loaded on first use, nothing is scaled or fitted, so cells can not be assigned to clusters or scored
+        dataset - name of the dataset to identify feature store entries
+        key - key of the models, ModelBuilder.key of the build
+        id_feature - cell id column
+        cluster_backend - clustering backend the models were built with
+
+        returns ModelBuilder of the stored models
+        """
+        model_builder = cls.__new__(cls)
+        model_builder.dataset = dataset
+        model_builder.key = key
+        model_builder.id_feature = id_feature
+        model_builder.cluster_backend = cluster_backend
+        model_builder._reg_model = None
+        model_builder._cluster_model = None
+        model_builder.df_cluster = store.load(dataset, "model.cluster", key)
+        model_builder.cluster_features = [c for c in model_builder.df_cluster.columns if c not in [id_feature, "cluster"]]
+        return model_builder
+
+    def model_file(self, name):
+        return os.path.join(STORE_DIRECTORY, f"{self.dataset}.model.{self.key}.{name}.joblib")
+
+    def __check_writable(self, name):
+        # serving processes only read - a missing model raises instead of being fitted
+        if store.read_only:
+            raise RuntimeError(f"No fitted {name} model of {self.dataset} with key {self.key} in read only feature store")
+
+    def __save_model(self, name, model):
+        import joblib
+        import sklearn
+        joblib.dump({"model": model, "model_version": MODEL_VERSION, "sklearn_version": sklearn.__version__}, self.model_file(name))
+
+    def __load_model(self, name):
+        import joblib
+        return joblib.load(self.model_file(name))
+
+    @property
+    def reg_model(self):
+        """Fitted logistic regression model - loaded on first access"""
+        if self._reg_model is None:
+            import sklearn
+            artifact = self.__load_model("reg")
+            if artifact["sklearn_version"] != sklearn.__version__:
+                print(f"Warning: regression model was built with scikit-learn {artifact['sklearn_version']}, running {sklearn.__version__}")
+            self._reg_model = artifact["model"]
+        return self._reg_model
 
-        X_reg = self.df_reg.loc[:,self.df_reg.columns != target].values
-        y_reg = self.df_reg.loc[:,[target]].values
+    @property
+    def cluster_model(self):
+        """Fitted ClusterModel of the selected backend - loaded on first access"""
+        if self._cluster_model is None:
+            self._cluster_model = self.__load_model(f"cluster.{self.cluster_backend}")["model"]
+        return self._cluster_model
 
-        X_cluster = self.df_cluster.loc[:,(self.df_cluster.columns != target) & (self.df_cluster.columns != id_feature)].values
+    def cluster_model_at(self, n_clusters):
+        """
+        returns cluster model with n_clusters clusters - a cut of the linkage tree of the fitted model, no refitting
+        """
+        if n_clusters == self.cluster_model.n_clusters:
+            return self.cluster_model
+        return self.cluster_model.at(n_clusters, self.df_cluster[self.cluster_features].values)
 
-        self.reg_model = self.__build_reg_model(X_reg, y_reg)
-        self.cluster_model = self.__build_cluster_model(X_cluster, 20)
+    def assign_clusters(self, df, n_clusters = None):
+        """
+        Assigns cells to the nearest fitted cluster without refitting - e.g. new or changed cells
+        df - data frame with raw model features
+        n_clusters - number of clusters, the fitted ones if None
+
+        returns array of cluster labels
+        """
+        cluster_model = self.cluster_model if n_clusters is None else self.cluster_model_at(n_clusters)
+        return cluster_model.predict(self.cluster_vectors(df))
+
+    def cluster_vectors(self, df):
+        """
+        df - data frame with raw model features
+
+        returns normalized vectors of the selected features as clustered, one row per cell
+        """
+        return self.__vectors(df, self.cluster_features)
+
+    def success_probabilities(self, df):
+        """
+        Runs the regression model over all cells at once
+        df - data frame with raw model features
+
+        returns probability of a successful restaurant in every cell, NaN for cells with missing features
+        and for all cells if there is no regression model
+        """
+        X = self.__vectors(df, self.reg_features)
+        complete = ~np.isnan(X).any(axis = 1)
+        probabilities = np.full(len(X), np.nan)
+        if self.regression and complete.any():
+            positive = list(self.reg_model.classes_).index(1)
+            probabilities[complete] = self.reg_model.predict_proba(X[complete])[:, positive]
+        return probabilities
+
+    def __vectors(self, df, features):
+        X = (np.log1p(df[self.model_features].values.astype(float)) - self.feature_min) / self.feature_range
+        return X[:, [self.model_features.index(f) for f in features]]
 
     def transform_normalize(self, X):
+        from sklearn import preprocessing
+
         print("Transforming with log1p and scaling with MinMaxScaler")
         # transform data with log1p function - data is right skewed
         transformer = preprocessing.FunctionTransformer(np.log1p, validate=True)
@@ -89,16 +247,49 @@ class ModelBuilder:
         return X
 
     def __select_features(self, features, X, y):
-        print("Selecting features with RFE - recursive feature elimination with SVM")
-        rfe = RFE(SVC(kernel="linear"), 1)
-        rfe = rfe.fit(X, y.ravel())
+        # rankings are kept by candidate features and data - experiments with the same candidates rank them once
+        key = fingerprint(pd.DataFrame(X, columns = features), pd.Series(y.ravel()), "rfe_svc_linear")
+        ranking = store.load(self.dataset, "model.features", key)
+        if ranking is not None:
+            print("Yeeh, found feature ranking in feature store - will be loading data from there")
+        else:
+            start_time = time.time()
+            ranking = pd.DataFrame({"feature": features, "rank": self.__rank_features(X, y.ravel())})
+            store.save(self.dataset, "model.features", key, ranking)
+            print(f"{len(features)} features ranked in {(time.time() - start_time)} seconds")
 
-        feature_ranks = {z[0]: z[1] for z in zip(features, rfe.ranking_)}
+        feature_ranks = dict(zip(ranking["feature"], ranking["rank"].tolist()))
         sorted_feature_ranks = sorted(feature_ranks.items(), key=lambda kv: kv[1])
         print(f"Feature Ranking: {sorted_feature_ranks}")
         return [f[0] for f in sorted_feature_ranks if f[1] < len(features)//2]
 
+    def __rank_features(self, X, y):
+        """
+        RFE - recursive feature elimination with SVM, the feature with the smallest weight is eliminated at every step
+
+        returns rank of every feature, 1 for the last one left
+        """
+        from sklearn.svm import SVC
+
+        print("Selecting features with RFE - recursive feature elimination with SVM")
+        # oversampled rows repeat - every distinct row is fitted once weighted by its count, the fitted SVM is the same
+        rows, counts = np.unique(np.column_stack([X, y]), axis = 0, return_counts = True)
+        X, y = rows[:, :-1], rows[:, -1]
+        print(f"{len(X)} distinct of {counts.sum()} rows")
+
+        remaining = np.arange(X.shape[1])
+        ranks = np.ones(X.shape[1], dtype = np.int64)
+        while len(remaining) > 1:
+            svc = SVC(kernel="linear").fit(X[:, remaining], y, sample_weight = counts)
+            weakest = np.argsort((svc.coef_ ** 2).sum(axis = 0))[0]
+            ranks[remaining[weakest]] = len(remaining)
+            remaining = np.delete(remaining, weakest)
+        return ranks
+
     def __build_reg_model(self, X, y):
+        from sklearn.model_selection import StratifiedKFold
+        from sklearn.linear_model import LogisticRegressionCV
+
         print(f"Building logistic regression model with {X.shape} features")
         # build logistic regression model and do 10 fold cross validation
         skf = StratifiedKFold(n_splits = 10, shuffle = True, random_state = SEED)
@@ -113,14 +304,13 @@ class ModelBuilder:
         print(f"Regression with Cross Validation mean f1 score: {mean_score}")
         return reg_model
 
-    def __build_cluster_model(self, X, n_clusters):
-        print(f"Building {n_clusters} clusters model with {X.shape} features")
-        cluster = AgglomerativeClustering(n_clusters=n_clusters, affinity='euclidean', linkage='ward')
-        cluster.fit_predict(X)
+    def __build_cluster_model(self, X, n_clusters, grid_columns):
+        print(f"Building {n_clusters} clusters {self.cluster_backend} model with {X.shape} features")
+        cluster = ClusterModel(n_clusters, self.cluster_backend, seed = SEED)
+        cluster.fit_predict(X, self.df_cluster[self.id_feature].values, grid_columns)
         unique, counts = np.unique(cluster.labels_, return_counts=True)
         print(f"Clusters and members count {dict(zip(unique, counts))}")
 
-        self.df_cluster["cluster"] = cluster.labels_
         return cluster
 
     def populate_ground(self, ground_df, id_feature):
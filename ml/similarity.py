@@ -0,0 +1,66 @@
+import numpy as np
+
+# scipy is imported where the index is built, like scikit-learn where models are built
+
+class SimilarityIndex:
+    """
+    Nearest neighbour search over normalized cell feature vectors.
+    Cells are compared by euclidean distance of their feature vectors in a KD-tree,
+    a second KD-tree over the projected cell centers restricts the search to a radius around a location.
+    """
+
+    def __init__(self, cell_ids, vectors, x, y):
+        """
+        cell_ids - ids of the indexed cells
+        vectors - normalized feature vectors of the cells, one row per cell
+        x, y - cell centers projected to meters
+        """
+        from scipy.spatial import cKDTree
+
+        self.cell_ids = np.asarray(cell_ids, dtype = np.int64)
+        self.vectors = np.ascontiguousarray(vectors, dtype = float)
+        self.tree = cKDTree(self.vectors)
+        self.geo_tree = cKDTree(np.column_stack([x, y]))
+
+        # position of every cell id in the index, -1 for cells not indexed
+        self.positions = np.full(self.cell_ids.max(initial = -1) + 1, -1, dtype = np.int64)
+        self.positions[self.cell_ids] = np.arange(len(self.cell_ids))
+
+    def __len__(self):
+        return len(self.cell_ids)
+
+    def __contains__(self, cell_id):
+        return 0 <= cell_id < len(self.positions) and self.positions[cell_id] >= 0
+
+    def query(self, cell_id, k, center = None, radius = None, exclude = (), include_self = False):
+        """
+        cell_id - indexed cell to find similar cells to
+        k - number of similar cells
+        center, radius - (x, y) in meters and radius in meters the similar cells are restricted to, no restriction if None
+        exclude - ids of cells left out
+        include_self - whether the cell itself is one of the similar cells
+
+        returns ids and feature distances of the k most similar cells, most similar first
+        """
+        vector = self.vectors[self.positions[cell_id]]
+        excluded = set(int(c) for c in exclude)
+        if not include_self:
+            excluded.add(int(cell_id))
+        excluded_positions = np.array([self.positions[c] for c in excluded if c in self], dtype = np.int64)
+
+        if radius is not None:
+            # cells around the location are few - exact distances of all of them
+            candidates = np.array(self.geo_tree.query_ball_point(center, radius), dtype = np.int64)
+            candidates = np.setdiff1d(candidates, excluded_positions)
+            distances = np.sqrt(((self.vectors[candidates] - vector) ** 2).sum(axis = 1))
+            nearest = np.argsort(distances, kind = "stable")[:k]
+            return self.cell_ids[candidates[nearest]], distances[nearest]
+
+        # excluded cells are among the nearest at most, asking for that many more keeps k left after filtering
+        n = min(k + len(excluded_positions), len(self.cell_ids))
+        if n == 0:
+            return self.cell_ids[:0], np.zeros(0)
+        distances, positions = self.tree.query(vector, k = n)
+        distances, positions = np.atleast_1d(distances), np.atleast_1d(positions)
+        kept = ~np.isin(positions, excluded_positions)
+        return self.cell_ids[positions[kept][:k]], distances[kept][:k]
@@ -0,0 +1,64 @@
+import json
+import hashlib
+from functools import lru_cache
+
+RENDERED_PAGES = 1024 # pages and column subsets kept rendered
+
+class PeersCache:
+    """
+    Ranked restaurants of every cluster rendered to json once at load time.
+    Full lists are kept as ready to send bytes for the lifetime of the cache, pages and column subsets are rendered
+    on first request and kept in a bounded cache apart from them, so repeated requests are a dictionary lookup.
+    """
+
+    def __init__(self, ranked_restaurants):
+        """
+        ranked_restaurants - dictionary of cluster to data frame of its ranked restaurants
+        """
+        # records as to_json renders them, restaurant point is left out
+        self.records = {
+            cluster: json.loads(restaurants.loc[:, restaurants.columns != "point"].to_json(orient = "records"))
+            for cluster, restaurants in ranked_restaurants.items()
+        }
+        self.columns = {
+            column for restaurants in ranked_restaurants.values() for column in restaurants.columns if column != "point"
+        }
+        # records of every cell in ranking order, for peers of similar cells
+        self.cell_records = {}
+        for records in self.records.values():
+            for record in records:
+                self.cell_records.setdefault(record.get("cell_id"), []).append(record)
+        # full lists are never evicted by pages
+        self.rendered = {cluster: self.__render(cluster) for cluster in self.records}
+        self.pages = lru_cache(maxsize = RENDERED_PAGES)(self.__render)
+
+    def render(self, cluster, offset = 0, limit = None, columns = None):
+        """
+        cluster - cluster of the restaurants
+        offset, limit - page of the ranked list, whole list if limit is None
+        columns - tuple of columns to keep, all columns if None
+
+        returns json bytes and ETag of the response
+        """
+        if offset == 0 and limit is None and columns is None:
+            return self.rendered[cluster]
+        return self.pages(cluster, offset, limit, columns)
+
+    def __render(self, cluster, offset = 0, limit = None, columns = None):
+        if columns is not None:
+            unknown = set(columns) - self.columns
+            if unknown:
+                raise ValueError(f"Unknown columns {sorted(unknown)}")
+
+        records = self.records[cluster][offset:None if limit is None else offset + limit]
+        if columns is not None:
+            records = [{column: record[column] for column in columns if column in record} for record in records]
+
+        body = json.dumps(records).encode()
+        return body, hashlib.sha1(body).hexdigest()[:16]
+
+    def __contains__(self, cluster):
+        return cluster in self.records
+
+    def total(self, cluster):
+        return len(self.records[cluster])
@@ -0,0 +1,154 @@
+"""
+Registry of the cities served by one API process.
+
+Every city is a Dataset with its own input files and ground. A city's Scouter - ground, restaurant index and models -
+is loaded on the first request inside its bounding box and kept while it fits the memory budget,
+the least recently used cities are evicted beyond it and loaded again on their next request.
+Cities are listed in ./data/datasets.json, Zurich of scouter.py is served if there is no such file:
+
+    [{"name": "zurich", "geojson_file": "./data/zurich.geojson", "demographics_file": "./data/zurich_demographics.csv",
+      "zipcode_file": "./data/zurich_zipcodes.geojson", "longitude": 8.5402515, "latitude": 47.3777873,
+      "ground_side": 10000, "osm_changes_directory": "./data/osm_changes"}]
+"""
+import os
+import gc
+import json
+import time
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import shapely
+from shapely import STRtree
+
+from scouter import Scouter, Dataset, ZURICH
+from metrics import metrics, PeakMemory
+
+DATASETS_FILE = "./data/datasets.json"
+MEMORY_BUDGET = 4 * 1024 ** 3 # bytes of loaded cities before the least recently used ones are evicted
+
+def load_datasets(datasets_file = DATASETS_FILE):
+    """
+    returns datasets of datasets_file by name in file order, only Zurich if there is no such file
+    """
+    if not os.path.exists(datasets_file):
+        return {ZURICH.name: ZURICH}
+    with open(datasets_file) as f:
+        datasets = [Dataset(**entry) for entry in json.load(f)]
+    return {dataset.name: dataset for dataset in datasets}
+
+class ScouterRegistry:
+    """
+    Loads Scouters of the cities lazily and routes locations to the city whose ground contains them
+    """
+
+    def __init__(self, datasets, memory_budget = MEMORY_BUDGET):
+        """
+        datasets - dictionary of dataset name to Dataset
+        memory_budget - bytes of loaded cities kept, the city loaded last is kept however large it is
+        """
+        self.datasets = datasets
+        self.names = list(datasets)
+        self.memory_budget = memory_budget
+
+        # bounding boxes of the grounds, a location inside several grounds goes to the smallest one
+        bounds = np.array([datasets[name].bounds() for name in self.names], dtype = float).reshape(-1, 4)
+        boxes = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+        self.box_areas = shapely.area(boxes)
+        self.tree = STRtree(boxes)
+        print(f"Serving {len(self.names)} cities {self.names}, loaded on first request")
+
+        self.loaded = OrderedDict() # dataset name to Scouter, least recently used first
+        self.sizes = {} # dataset name to bytes its Scouter added to the process
+        self.lock = threading.Lock()
+        self.load_locks = {name: threading.Lock() for name in self.names}
+
+    def route_many(self, lon, lat):
+        """
+        lon, lat - arrays of locations
+
+        returns array of dataset names, None for locations outside every ground
+        """
+        points = shapely.points(np.asarray(lon, dtype = float), np.asarray(lat, dtype = float))
+        point_index, box_index = self.tree.query(points, predicate = "intersects")
+
+        # smallest ground first for every point
+        order = np.lexsort((self.box_areas[box_index], point_index))
+        routed, first = np.unique(point_index[order], return_index = True)
+        names = np.full(len(points), None, dtype = object)
+        names[routed] = np.array(self.names, dtype = object)[box_index[order][first]]
+        return names
+
+    def route(self, lon, lat):
+        """
+        returns name of the dataset whose ground contains the location, None outside every ground
+        """
+        return self.route_many([lon], [lat])[0]
+
+    def group(self, lon, lat):
+        """
+        lon, lat - arrays of locations
+
+        returns positions of the locations by dataset name, locations outside every ground left out
+        """
+        names = self.route_many(lon, lat)
+        return {name: np.flatnonzero(names == name).tolist() for name in dict.fromkeys(n for n in names if n is not None)}
+
+    def get(self, name):
+        """
+        returns Scouter of the dataset, loaded on first use
+        """
+        with self.lock:
+            scouter = self.loaded.get(name)
+            if scouter is not None:
+                self.loaded.move_to_end(name)
+                metrics.cache_access(f"dataset.{name}", "hit")
+                return scouter
+
+        # cities load one at a time each, requests for loaded cities are not held up meanwhile
+        with self.load_locks[name]:
+            with self.lock:
+                if name in self.loaded:
+                    self.loaded.move_to_end(name)
+                    metrics.cache_access(f"dataset.{name}", "hit")
+                    return self.loaded[name]
+
+            metrics.cache_access(f"dataset.{name}", "miss")
+            start_time = time.time()
+            memory = PeakMemory()
+            rss_before = memory.rss()
+            with metrics.stage(f"load_{name}"):
+                scouter = Scouter(self.datasets[name])
+            size = max(memory.rss() - rss_before, 0)
+            print(f"Loaded {name} with {size / 1024 ** 2:.1f} MB in {(time.time() - start_time)} seconds")
+
+            with self.lock:
+                self.loaded[name] = scouter
+                self.sizes[name] = size
+                self.__evict()
+            return scouter
+
+    def scouter_at(self, lon, lat):
+        """
+        returns Scouter of the city at the location, None outside every ground
+        """
+        name = self.route(lon, lat)
+        return None if name is None else self.get(name)
+
+    def preload(self, names = None):
+        """
+        names - datasets to load now, the first dataset if None
+        """
+        for name in (self.names[:1] if names is None else names):
+            self.get(name)
+
+    def __evict(self):
+        evicted = []
+        while len(self.loaded) > 1 and sum(self.sizes[name] for name in self.loaded) > self.memory_budget:
+            name, _ = self.loaded.popitem(last = False)
+            metrics.cache_access(f"dataset.{name}", "evicted")
+            evicted.append(name)
+        if evicted:
+            # requests still running on an evicted city keep their Scouter until they finish
+            gc.collect()
+            print(f"Evicted {evicted} to stay within memory budget of {self.memory_budget / 1024 ** 2:.0f} MB")
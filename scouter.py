@@ -1,23 +1,38 @@
-from json import loads
-
-from shapely.geometry import Polygon, Point, MultiPolygon
+import os
+import time
+import threading
+import numpy as np
+import pandas as pd
+from collections import OrderedDict
 
 from extractors.osm_extractor import OSMExtractor
 from extractors.tripadvisor_extractor import TripAdvisorExtractor, PriceLevel
 from extractors.demographic_extractor import DemographicsExtractor
-from ml.model_builder import ModelBuilder
+from extractors.neighbourhood_extractor import NeighbourhoodExtractor
+from ml.model_builder import ModelBuilder, N_CLUSTERS, MODEL_VERSION
 
-from scouting_ground import ScoutingGround
+from scouting_ground import ScoutingGround, meters_per_degree, ground_key, populated_keys
+from peers_cache import PeersCache
+from feature_store import store, fingerprint
+from metrics import metrics
 
 GEOJSON_FILE = "./data/zurich.geojson"
 DEMOGRAPHICS_FILE = "./data/zurich_demographics.csv"
+ZIPCODE_FILE = "./data/zurich_zipcodes.geojson"
+OSM_CHANGES_DIRECTORY = "./data/osm_changes" # nightly OSM change files, applied in file name order
 DATASET = "zurich"
+INPUT_FILES = [GEOJSON_FILE, DEMOGRAPHICS_FILE, ZIPCODE_FILE, OSM_CHANGES_DIRECTORY]
 
 ZURICH_LONGITUDE = 8.5402515 # Zurich HB
 ZURICH_LATITUDE = 47.3777873 # Zurich HB
 
 GROUND_SIDE = 10000 # 10km square map around point above
-CELL_SIDE = 200 # typical Wiedikon block is 70m long. 200m is 3 blocks
+CELL_SIDE = 100 # finest resolution the ground is built at, typical Wiedikon block is 70m long
+RESOLUTIONS = [100, 200, 800] # cell sides served, multiples of CELL_SIDE rolled up from the finest cells
+RESOLUTION = 200 # default resolution, 200m is 3 blocks
+
+BUILD_WORKERS = os.cpu_count() # processes populating the ground, 1 builds in a single process
+SHARD_SIZE = 25 # cells per tile side of the sharded ground build
 
 ID_FEATURE = "id"
 MODEL_FEATURES = ["proportion_of_foreigners", "population", "employee", "workplaces",
@@ -27,28 +42,316 @@ MODEL_FEATURES = ["proportion_of_foreigners", "population", "employee", "workpla
 "schools", "universities", "parkings", "hospitals", "entertainments",
 "leisures", "supermarkets", "bars", "shops", "tourisms"]
 TARGET_FEATURE = "successful_restaurants_any"
+# surroundings of a cell offered to the feature selection next to MODEL_FEATURES - sums and densities within the radii
+NEIGHBOURHOOD_FEATURES = ["population", "workplaces", "public_transport_stops", "entertainments", "bars", "shops", "tourisms"]
+NEIGHBOURHOOD_RADII = [400, 1000] # meters
+NOT_FOUND = {"result": "0 similar location was found"}
+CLUSTER_BACKEND = "ward" # ward, ward_grid or minibatch_kmeans - see ml/clustering.py
+# backends of resolutions not clustered with CLUSTER_BACKEND - ward needs quadratic memory in the 10000 cells of 100m
+CLUSTER_BACKENDS = {100: "minibatch_kmeans"}
+SIMILAR_CELLS = 10 # similar cells of the ranked peers by default
+MAX_SIMILAR_CELLS = 1000
+GRANULARITY = N_CLUSTERS # clusters per resolution by default, any other number is cut from the linkage tree on request
+GRANULARITY_VIEWS = 16 # clusterings of other granularities kept per city, least recently used dropped
+
+def osm_change_files(directory = OSM_CHANGES_DIRECTORY):
+    """
+    Returns OSM change files in the order to apply them
+    """
+    if not directory or not os.path.isdir(directory):
+        return []
+    return [os.path.join(directory, f) for f in sorted(os.listdir(directory))
+        if f.endswith((".geojson", ".geojsonl", ".geojsons", ".geojsonseq", ".ndjson", ".jsonl"))]
+
+class Dataset:
+    """
+    Input data and ground of a city
+    """
+
+    def __init__(self, name, geojson_file, demographics_file, zipcode_file, longitude, latitude,
+        ground_side = GROUND_SIDE, osm_changes_directory = None):
+        """
+        name - name of the dataset to identify feature store entries
+        geojson_file, demographics_file, zipcode_file - OSM, demographics and postal code boundaries of the city
+        longitude, latitude - center point of the ground
+        ground_side - ground side in meters
+        osm_changes_directory - directory of OSM change files, no changes if None
+        """
+        self.name = name
+        self.geojson_file = geojson_file
+        self.demographics_file = demographics_file
+        self.zipcode_file = zipcode_file
+        self.longitude = longitude
+        self.latitude = latitude
+        self.ground_side = ground_side
+        self.osm_changes_directory = osm_changes_directory
+
+    @property
+    def input_files(self):
+        return [f for f in [self.geojson_file, self.demographics_file, self.zipcode_file, self.osm_changes_directory] if f]
+
+    def bounds(self):
+        """
+        returns west, south, east and north edge of the ground
+        """
+        lon_meters, lat_meters = meters_per_degree(self.latitude)
+        half_lon = self.ground_side / 2 / lon_meters
+        half_lat = self.ground_side / 2 / lat_meters
+        return self.longitude - half_lon, self.latitude - half_lat, self.longitude + half_lon, self.latitude + half_lat
+
+ZURICH = Dataset(DATASET, GEOJSON_FILE, DEMOGRAPHICS_FILE, ZIPCODE_FILE, ZURICH_LONGITUDE, ZURICH_LATITUDE,
+    GROUND_SIDE, OSM_CHANGES_DIRECTORY)
 
 class Scouter:
-    def __init__(self):
-        self.ground = ScoutingGround(DATASET, ZURICH_LONGITUDE, ZURICH_LATITUDE, GROUND_SIDE, CELL_SIDE)
+    def __init__(self, dataset = ZURICH):
+        """
+        dataset - Dataset of the city to serve
+        """
+        self.dataset = dataset
+        name = dataset.name
+        # extractors load their data on first use only
+        self.demographics_extractor = DemographicsExtractor(name, dataset.demographics_file, dataset.zipcode_file)
+        self.osm_extractor = OSMExtractor(name, dataset.geojson_file, change_files = osm_change_files(dataset.osm_changes_directory))
+        self.tripadvisor_extractor = TripAdvisorExtractor(name, self.osm_extractor)
+        self.neighbourhood_extractor = NeighbourhoodExtractor(NEIGHBOURHOOD_FEATURES, NEIGHBOURHOOD_RADII)
+
+        # inputs and parameters of the served grounds and models - a build stores the keys of its serving arrays under it
+        key = ground_key(dataset.longitude, dataset.latitude, dataset.ground_side, CELL_SIDE, dataset.zipcode_file)
+        self.key = fingerprint(populated_keys(key, self.demographics_extractor, self.osm_extractor, self.tripadvisor_extractor),
+            RESOLUTIONS, ID_FEATURE, MODEL_FEATURES, TARGET_FEATURE, NEIGHBOURHOOD_FEATURES, NEIGHBOURHOOD_RADII,
+            CLUSTER_BACKEND, CLUSTER_BACKENDS, N_CLUSTERS, MODEL_VERSION)
+        if store.exists(name, "scouter", self.key):
+            self.__load_serving()
+        else:
+            self.__build()
+
+        self.ground = self.grounds[RESOLUTION]
+        self.model_builder = self.model_builders[RESOLUTION]
+
+        # grounds and peers of other granularities by resolution and number of clusters, built on first request
+        self.granularities = OrderedDict()
+        self.lock = threading.Lock()
+
+    def __build(self):
+        """
+        Builds grounds, models and peers of all resolutions from the pipeline stages, rebuilding the stages missing in the feature store
+        """
+        dataset = self.dataset
+        name = dataset.name
+        ground = ScoutingGround(name, dataset.longitude, dataset.latitude, dataset.ground_side, CELL_SIDE, dataset.zipcode_file)
+        ground.populate_ground(name, self.demographics_extractor, self.osm_extractor, self.tripadvisor_extractor,
+            BUILD_WORKERS, SHARD_SIZE)
+        if "cell_id" not in self.tripadvisor_extractor.df.columns:
+            self.tripadvisor_extractor.assign_cells(ground.df)
+
+        # coarser resolutions aggregate the finest cells, every resolution is clustered on its own
+        self.grounds = {
+            resolution: ground if resolution == CELL_SIDE else
+                ground.roll_up(resolution // CELL_SIDE, self.demographics_extractor, self.osm_extractor, self.tripadvisor_extractor)
+            for resolution in RESOLUTIONS
+        }
+        self.model_builders = {}
+        self.peers = {}
+        for resolution, level in self.grounds.items():
+            with metrics.stage(f"neighbourhood_{resolution}"):
+                neighbourhood_features = level.populate_neighbourhood(self.neighbourhood_extractor)
+            with metrics.stage(f"model_{resolution}"):
+                model_builder = ModelBuilder(name, level.base_df, ID_FEATURE, MODEL_FEATURES + neighbourhood_features, TARGET_FEATURE,
+                    CLUSTER_BACKENDS.get(resolution, CLUSTER_BACKEND), level.grid.columns)
+            level.populate_ground_from_model(model_builder, ID_FEATURE)
+            with metrics.stage(f"peers_cache_{resolution}"):
+                self.peers[resolution] = self.__peers_cache(level, resolution)
+            self.model_builders[resolution] = model_builder
+
+        # requests run on the serving arrays of the grounds only
+        for level in self.grounds.values():
+            level.release_frames()
+
+        if not store.read_only:
+            store.save(name, "scouter", self.key, pd.DataFrame({
+                "resolution": list(self.grounds),
+                "key": [level.key for level in self.grounds.values()],
+                "serving_key": [level.serving_key for level in self.grounds.values()],
+                "model_key": [model_builder.key for model_builder in self.model_builders.values()]
+            }))
+
+    def __load_serving(self):
+        """
+        Loads the serving arrays and models of all resolutions stored by a build - memory-mapped, no ground data frame
+        is read and no pipeline stage is loaded but the restaurants
+        """
+        start_time = time.time()
+        name = self.dataset.name
+        levels = store.load(name, "scouter", self.key).sort_values("resolution")
+        self.grounds = {}
+        self.model_builders = {}
+        self.peers = {}
+        finest = None
+        for resolution, key, serving_key, model_key in levels.itertuples(index = False):
+            resolution = int(resolution)
+            if finest is None:
+                level = finest = ScoutingGround.load_serving(name, key, serving_key, resolution)
+                # restaurants are assigned to the finest cells as the build assigns them
+                self.tripadvisor_extractor.assign_cells(pd.DataFrame({"id": finest.arrays.ids, "area": finest.arrays.areas()}))
+            else:
+                factor = resolution // finest.cell_side
+                level = ScoutingGround.load_serving(name, key, serving_key, resolution, finest.grid.coarsen(factor),
+                    finest.grid.parents(factor))
+            self.grounds[resolution] = level
+            self.model_builders[resolution] = ModelBuilder.load(name, model_key, ID_FEATURE,
+                CLUSTER_BACKENDS.get(resolution, CLUSTER_BACKEND))
+            with metrics.stage(f"peers_cache_{resolution}"):
+                self.peers[resolution] = self.__peers_cache(level, resolution)
+        print(f"Yeeh, found serving grounds of {list(self.grounds)}m cells in feature store - loaded in {(time.time() - start_time)} seconds")
 
-        self.demographics_extractor = DemographicsExtractor(DATASET, DEMOGRAPHICS_FILE)
-        self.osm_extractor = OSMExtractor(DATASET, GEOJSON_FILE)
-        self.tripadvisor_extractor = TripAdvisorExtractor(DATASET, self.osm_extractor.all_restaurants())
-        self.ground.populate_ground(DATASET, self.demographics_extractor, self.osm_extractor, self.tripadvisor_extractor)
+    def __peers_cache(self, level, resolution):
+        # restaurants of every cluster ranked and rendered once, requests only look them up
+        start_time = time.time()
+        level_restaurants = level.level_restaurants(self.tripadvisor_extractor)
+        peers = PeersCache({
+            cluster: level_restaurants.get_ranked_restaurants_in_locations(level.get_cluster_locations(cluster))
+            for cluster in level.cluster_cells
+        })
+        print(f"Restaurants of {len(level.cluster_cells)} clusters of {resolution}m cells rendered in {(time.time() - start_time)} seconds")
+        return peers
 
-        self.model_builder = ModelBuilder(DATASET, self.ground.df, ID_FEATURE, MODEL_FEATURES, TARGET_FEATURE)
-        self.ground.populate_ground_from_model(self.model_builder, ID_FEATURE)
+    def __level(self, resolution, granularity = None):
+        """
+        returns ground and peers of the resolution and number of clusters,
+        raises ValueError for resolutions not served and numbers of clusters the linkage tree can not be cut at
+        """
+        resolution = RESOLUTION if resolution is None else resolution
+        if resolution not in self.grounds:
+            raise ValueError(f"Unknown resolution {resolution}, one of {RESOLUTIONS}")
+        if granularity is None or granularity == GRANULARITY:
+            return self.grounds[resolution], self.peers[resolution]
 
-    def similarly_located_restaurants(self, lon, lat):
-        similar_locations = self.ground.get_similar_locations(lon, lat)
+        key = (resolution, granularity)
+        with self.lock:
+            if key in self.granularities:
+                self.granularities.move_to_end(key)
+                return self.granularities[key]
 
-        if len(similar_locations):
-            restaurants = self.tripadvisor_extractor.get_ranked_restaurants_in_locations(similar_locations)
-            json_str = restaurants.loc[:, restaurants.columns != 'point'].to_json(orient = "records")
-            return loads(json_str)
+        start_time = time.time()
+        level = self.grounds[resolution].at_granularity(self.model_builders[resolution], granularity)
+        view = level, self.__peers_cache(level, resolution)
+        print(f"Clusters of {resolution}m cells cut at {granularity} clusters in {(time.time() - start_time)} seconds")
+        with self.lock:
+            self.granularities[key] = view
+            while len(self.granularities) > GRANULARITY_VIEWS:
+                self.granularities.popitem(last = False)
+        return view
+
+    def similarly_located_restaurants(self, lon, lat, resolution = None, granularity = None):
+        ground, peers = self.__level(resolution, granularity)
+        cluster = ground.get_cluster(lon, lat)
+
+        if cluster in peers:
+            return peers.records[cluster]
+        else:
+            return NOT_FOUND
+
+    def similarly_located_restaurants_rendered(self, lon, lat, offset = 0, limit = None, columns = None, resolution = None,
+        granularity = None):
+        """
+        lon, lat - location
+        offset, limit - page of the ranked restaurants, all restaurants if limit is None
+        columns - tuple of restaurant columns to return, all columns if None
+        resolution - cell side in meters, one of RESOLUTIONS, RESOLUTION if None
+        granularity - number of clusters, GRANULARITY if None
+
+        returns json bytes, ETag and total number of restaurants - None if no similar location was found
+        """
+        ground, peers = self.__level(resolution, granularity)
+        with metrics.phase("peers", "cell_lookup"):
+            cluster = ground.get_cluster(lon, lat)
+
+        if cluster in peers:
+            with metrics.phase("peers", "restaurant_filtering"):
+                body, etag = peers.render(cluster, offset, limit, columns)
+            return body, etag, peers.total(cluster)
         else:
-            return {"result": "0 similar location was found"}
+            return None
+
+    def similarly_located_restaurants_batch(self, points, resolution = None, granularity = None):
+        """
+        points - list of (longitude, latitude)
+        resolution - cell side in meters, one of RESOLUTIONS, RESOLUTION if None
+        granularity - number of clusters, GRANULARITY if None
+
+        returns cluster of every point and ranked restaurants of every cluster found,
+        the ranking is computed once per cluster however many points share it
+        """
+        ground, level_peers = self.__level(resolution, granularity)
+        start_time = time.time()
+        with metrics.phase("peers_batch", "cell_lookup"):
+            lon, lat = np.asarray(points, dtype = float).reshape(-1, 2).T
+            clusters = ground.get_clusters(lon, lat)
+
+        with metrics.phase("peers_batch", "restaurant_filtering"):
+            peers = {}
+            for cluster in np.unique(clusters[~np.isnan(clusters)]):
+                peers[str(int(cluster))] = level_peers.records[cluster]
+
+        metrics.log_request(f"{len(points)} locations in {len(peers)} clusters looked up in {(time.time() - start_time)} seconds")
+        return {
+            "points": [
+                {"lon": x, "lat": y, "cluster": None if np.isnan(c) else str(int(c))}
+                for x, y, c in zip(lon.tolist(), lat.tolist(), clusters)
+            ],
+            "peers": peers
+        }
+
+    def success_probabilities(self, points, resolution = None):
+        """
+        points - list of (longitude, latitude)
+        resolution - cell side in meters, one of RESOLUTIONS, RESOLUTION if None
+
+        returns cell and probability of a successful restaurant at every point from the precomputed surface,
+        None for both outside the ground or in cells without features
+        """
+        ground, _ = self.__level(resolution)
+        with metrics.phase("score", "cell_lookup"):
+            lon, lat = np.asarray(points, dtype = float).reshape(-1, 2).T
+            cell_ids, probabilities = ground.get_probabilities(lon, lat)
+        return [
+            {"lon": x, "lat": y, "cell_id": None if c < 0 else c, "probability": None if np.isnan(p) else p}
+            for x, y, c, p in zip(lon.tolist(), lat.tolist(), cell_ids.tolist(), probabilities.tolist())
+        ]
+
+    def similar_locations_ranked(self, lon, lat, k = SIMILAR_CELLS, radius = None, exclude = (), resolution = None):
+        """
+        lon, lat - location
+        k - number of similar cells
+        radius - meters around the location the similar cells are restricted to, no restriction if None
+        exclude - ids of cells left out, the cell at the location is always left out
+        resolution - cell side in meters, one of RESOLUTIONS, RESOLUTION if None
+
+        returns cell at the location, the k most similar cells with their feature distance and center
+        and the restaurants in them ranked - None if there is no clustered cell at the location
+        """
+        ground, peers = self.__level(resolution)
+        with metrics.phase("peers_ranked", "similarity_search"):
+            similar = ground.get_similar_cells(lon, lat, k, radius, exclude)
+        if similar is None:
+            return None
+
+        cell_id, cell_ids, distances = similar
+        with metrics.phase("peers_ranked", "restaurant_filtering"):
+            restaurants = sorted(
+                (record for similar_cell in cell_ids for record in peers.cell_records.get(similar_cell, [])),
+                key = lambda record: record["ranking_percentile"]
+            )
+
+        west, south, east, north = ground.arrays.bounds()
+        return {
+            "cell_id": int(cell_id),
+            "similar": [
+                {"cell_id": int(c), "distance": float(d), "lon": float((west[c] + east[c]) / 2), "lat": float((south[c] + north[c]) / 2)}
+                for c, d in zip(cell_ids, distances)
+            ],
+            "peers": restaurants
+        }
 
 if __name__ == "__main__":
     scouter = Scouter()
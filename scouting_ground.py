@@ -1,171 +1,848 @@
 import os.path
+import copy
 import time
 import numpy as np
 import pandas as pd
 
-import requests
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 
-import geopy
-from geopy.distance import GeodesicDistance
-from shapely.geometry import Polygon, Point
+from extractors.zipcode_resolver import ZipcodeResolver
+from feature_store import store, fingerprint
+from metrics import metrics
+from ml.similarity import SimilarityIndex
 
-BEARING_NORTH = 0
-BEARING_NORTH_EAST = 315
-BEARING_EAST = 90
-BEARING_SOUTH_EAST = 225
-BEARING_SOUTH = 180
-BEARING_SOUTH_WEST = 135
-BEARING_WEST = 90
-BEARING_NORTH_WEST = 45
+import shapely
+from shapely import STRtree
+from shapely.geometry.base import BaseGeometry
 
-GEOCODE_URL = "http://dev.virtualearth.net/REST/v1/Locations"
-GEOCODE_API_KEY = ""
+# WGS84 ellipsoid
+EARTH_SEMI_MAJOR_AXIS = 6378137.0
+EARTH_ECCENTRICITY_SQUARED = 6.69437999014e-3
 
-def walk(longitude, latitude, bearing, distance):
+def meters_per_degree(latitude):
     """
-    longitude, latitude - point to walk from
-    bearing - direction of the walk in bearing degrees
-    distance_proj - distance to walk in meters
+    latitude - latitude of the local projection origin
 
-    returns  longitude, latitude of arrival point
+    returns meters per degree longitude and per degree latitude around given latitude
     """
 
-    origin = geopy.Point(longitude = longitude, latitude = latitude)
-    destination = GeodesicDistance(meters=distance).destination(origin, bearing)
-    return destination.longitude, destination.latitude
+    phi = np.radians(latitude)
+    w = 1 - EARTH_ECCENTRICITY_SQUARED * np.sin(phi) ** 2
+    # radius of curvature in the prime vertical and in the meridian
+    prime_vertical = EARTH_SEMI_MAJOR_AXIS / np.sqrt(w)
+    meridian = EARTH_SEMI_MAJOR_AXIS * (1 - EARTH_ECCENTRICITY_SQUARED) / w ** 1.5
+    return np.radians(prime_vertical * np.cos(phi)), np.radians(meridian)
 
-class ScoutingGroundCell:
-    """ Single cell within ScoutingGround
-    contains all characteristics scraped from various data sources
+class GridGeometry:
+    """ Row and column layout of ScoutingGround cells
+    maps coordinates to cell ids by arithmetic, cells are numbered row by row from the north west
     """
 
-    def __init__(self, longitude, latitude, cell_radius):
-
-        self.longitude = longitude
-        self.latitude = latitude
-        self.area = Polygon(
-            [
-                walk(longitude, latitude, bearing = BEARING_NORTH_EAST, distance = cell_radius),
-                walk(longitude, latitude, bearing = BEARING_SOUTH_EAST, distance = cell_radius),
-                walk(longitude, latitude, bearing = BEARING_SOUTH_WEST, distance = cell_radius),
-                walk(longitude, latitude, bearing = BEARING_NORTH_WEST, distance = cell_radius)
-            ]
+    # share of the cell side along the cell edges where cell polygons are checked
+    EDGE_MARGIN = 0.01
+
+    def __init__(self, rows, columns, north, south, west, width):
+        """
+        rows, columns - grid layout
+        north, south - northern and southern edge latitude of each row
+        west - western edge longitude of the first cell in each row
+        width - cell width in degrees longitude in each row
+        """
+        self.rows = rows
+        self.columns = columns
+        self.north = np.asarray(north, dtype = float)
+        self.south = np.asarray(south, dtype = float)
+        self.west = np.asarray(west, dtype = float)
+        self.width = np.asarray(width, dtype = float)
+
+    @classmethod
+    def square(cls, longitude, latitude, area_side, cell_side):
+        """
+        Square grid in a local metric projection, origin in the north western corner
+        longitude, latitude - center point of the area
+        area_side, cell_side - area and cell side in meters
+        """
+        dimension = area_side // cell_side
+        lon_meters, lat_meters = meters_per_degree(latitude)
+        # row edges from north to south
+        edges = latitude + (area_side / 2 - cell_side * np.arange(dimension + 1)) / lat_meters
+        return cls(
+            rows = dimension,
+            columns = dimension,
+            north = edges[:-1],
+            south = edges[1:],
+            west = np.full(dimension, longitude - (area_side / 2) / lon_meters),
+            width = np.full(dimension, cell_side / lon_meters)
         )
 
-    def __str__(self):
-        return str(self.__class__) + ": " + str(self.__dict__)
+    @classmethod
+    def from_areas(cls, areas):
+        """
+        areas - cell polygons of a square grid ordered by cell id
+        """
+        return cls.from_bounds(*shapely.bounds(areas).T)
 
-    def to_dict(self):
-        return {
-            "center": Point(self.longitude, self.latitude),
-            "area": self.area,
-        }
+    @classmethod
+    def from_bounds(cls, west, south, east, north):
+        """
+        west, south, east, north - edges of the cells of a square grid ordered by cell id
+        """
+        dimension = int(round(len(west) ** 0.5))
+        bounds = np.column_stack([west, south, east, north]).reshape(dimension, dimension, 4)
+        return cls(
+            rows = dimension,
+            columns = dimension,
+            north = bounds[:, :, 3].mean(axis = 1),
+            south = bounds[:, :, 1].mean(axis = 1),
+            west = bounds[:, 0, 0],
+            width = (bounds[:, -1, 2] - bounds[:, 0, 0]) / dimension
+        )
+
+    def coarsen(self, factor):
+        """
+        Grid of blocks of factor x factor cells, blocks on the southern and eastern edges hold the cells left
+        """
+        rows = -(-self.rows // factor)
+        last_rows = np.minimum(np.arange(rows) * factor + factor - 1, self.rows - 1)
+        return GridGeometry(
+            rows = rows,
+            columns = -(-self.columns // factor),
+            north = self.north[::factor],
+            south = self.south[last_rows],
+            west = self.west[::factor],
+            width = self.width[::factor] * factor
+        )
+
+    def parents(self, factor):
+        """
+        returns id of the block of factor x factor cells of the coarsened grid containing every cell
+        """
+        rows, columns = np.divmod(np.arange(self.rows * self.columns), self.columns)
+        return (rows // factor) * -(-self.columns // factor) + columns // factor
+
+    def bounds(self):
+        """
+        returns west, south, east and north edges of all cells ordered by cell id
+        """
+        columns = np.arange(self.columns)
+        west = (self.west[:, None] + columns * self.width[:, None]).ravel()
+        east = (self.west[:, None] + (columns + 1) * self.width[:, None]).ravel()
+        south = np.repeat(self.south, self.columns)
+        north = np.repeat(self.north, self.columns)
+        return west, south, east, north
+
+    def to_frame(self):
+        """
+        returns data frame with center point and area polygon of all cells ordered by cell id
+        """
+        west, south, east, north = self.bounds()
+        return pd.DataFrame({
+            "center": shapely.points((west + east) / 2, (south + north) / 2),
+            "area": shapely.box(west, south, east, north)
+        })
+
+    def locate_many(self, lon, lat, cell_bounds):
+        """
+        lon, lat - arrays of points to locate
+        cell_bounds - west, south, east and north edges of the cells ordered by cell id,
+            checked only for points close to the cell edges
+
+        returns (points x 9) array with sorted ids of all cells intersecting each point, padded with -1
+        """
+        lon = np.asarray(lon, dtype = float)
+        lat = np.asarray(lat, dtype = float)
+        row = np.clip(np.searchsorted(-self.north, -lat, side = "right") - 1, 0, self.rows - 1)
+        column = np.floor((lon - self.west[row]) / self.width[row]).astype(np.int64)
+
+        # position within the cell as a share of the cell side
+        x = (lon - self.west[row]) / self.width[row] - column
+        y = (self.north[row] - lat) / (self.north[row] - self.south[row])
+
+        margin = self.EDGE_MARGIN
+        interior = (column >= 0) & (column < self.columns) & (margin < x) & (x < 1 - margin) & (margin < y) & (y < 1 - margin)
+        cell_ids = np.full((len(lon), 9), -1, dtype = np.int64)
+        # blocks on the eastern edge of coarser grids are narrower than the grid width
+        inside = np.flatnonzero(interior)
+        interior[inside] = lon[inside] <= cell_bounds[2][row[inside] * self.columns + column[inside]]
+        cell_ids[interior, 0] = row[interior] * self.columns + column[interior]
+
+        # close to the edges - check bounds of the cell and its neighbours, edges belong to both cells
+        edge = np.flatnonzero(~interior)
+        if len(edge):
+            dr, dc = np.divmod(np.arange(9), 3)
+            r = row[edge, None] + dr - 1
+            c = column[edge, None] + dc - 1
+            valid = (r >= 0) & (r < self.rows) & (c >= 0) & (c < self.columns)
+            neighbours = np.where(valid, r * self.columns + c, 0)
+            west, south, east, north = cell_bounds
+            x = lon[edge, None]
+            y = lat[edge, None]
+            hit = valid & (west[neighbours] <= x) & (x <= east[neighbours]) & (south[neighbours] <= y) & (y <= north[neighbours])
+            # neighbours are in ascending id order, move misses to the end
+            cell_ids[edge] = np.where(hit, neighbours, np.iinfo(np.int64).max)
+            cell_ids[edge] = np.sort(cell_ids[edge], axis = 1)
+            cell_ids[cell_ids == np.iinfo(np.int64).max] = -1
+        return cell_ids
+
+class GroundArrays:
+    """ Struct of arrays serving representation of a populated ground
+    cell bounds as contiguous float arrays, normalized feature vectors of the clustering as one array per feature
+    and cluster labels as small integers, shapely geometries are created only for the cells a caller asks for.
+    Stored in the feature store as they are and memory-mapped on load, no data frame involved
+    """
+
+    NO_CLUSTER = -1
+    VECTOR_PREFIX = "vector."
+
+    def __init__(self, df, vectors, vector_names):
+        """
+        df - populated ground with cluster column, ordered by cell id
+        vectors - normalized feature vectors of the cells as clustered, one row per cell
+        vector_names - features of the vectors
+        """
+        bounds = shapely.bounds(df["area"].values)
+        self.west, self.south, self.east, self.north = (np.ascontiguousarray(bounds[:, i]) for i in range(4))
+        self.ids = df["id"].values.astype(np.int32)
+        vectors = np.asarray(vectors, dtype = float)
+        self.vectors = {name: np.ascontiguousarray(vectors[:, i]) for i, name in enumerate(vector_names)}
+
+        clusters = df["cluster"].values.astype(float)
+        clustered = ~np.isnan(clusters)
+        dtype = np.int16 if clusters[clustered].max(initial = 0) < np.iinfo(np.int16).max else np.int32
+        self.clusters = np.where(clustered, clusters, self.NO_CLUSTER).astype(dtype)
+        # probability of a successful restaurant in every cell, set with the probability surface
+        self.probabilities = None
+
+    @classmethod
+    def load(cls, dataset, key):
+        """
+        returns serving arrays of a stored ground memory-mapped and positions of its cells changed since the models were built
+        """
+        columns = store.load_arrays(dataset, "ground.serving", key)
+        arrays = cls.__new__(cls)
+        arrays.west, arrays.south, arrays.east, arrays.north = (columns[c] for c in ["west", "south", "east", "north"])
+        arrays.ids = columns["id"]
+        arrays.clusters = columns["cluster"]
+        arrays.probabilities = columns["probability"]
+        arrays.vectors = {c[len(cls.VECTOR_PREFIX):]: v for c, v in columns.items() if c.startswith(cls.VECTOR_PREFIX)}
+        return arrays, np.flatnonzero(columns["changed"])
+
+    def save(self, dataset, key, changed_cells):
+        """
+        Stores the serving arrays as columns of a feature store entry
+        changed_cells - positions of the cells changed since the models were built
+        """
+        changed = np.zeros(len(self), dtype = bool)
+        changed[changed_cells] = True
+        df = pd.DataFrame({"id": self.ids, "west": self.west, "south": self.south, "east": self.east, "north": self.north,
+            "cluster": self.clusters, "probability": self.probabilities, "changed": changed})
+        for name, vector in self.vectors.items():
+            df[f"{self.VECTOR_PREFIX}{name}"] = vector
+        store.save(dataset, "ground.serving", key, df)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def vectors_at(self, cells):
+        """
+        returns normalized feature vectors of the cells at given positions, one row per cell
+        """
+        return np.column_stack([vector[cells] for vector in self.vectors.values()])
+
+    def bounds(self):
+        return self.west, self.south, self.east, self.north
+
+    def areas(self, cells = None):
+        """
+        cells - cell positions, all cells if None
+
+        returns polygons of the cells
+        """
+        cells = slice(None) if cells is None else cells
+        return shapely.box(self.west[cells], self.south[cells], self.east[cells], self.north[cells])
+
+    def centers(self, cells = None):
+        cells = slice(None) if cells is None else cells
+        return shapely.points((self.west[cells] + self.east[cells]) / 2, (self.south[cells] + self.north[cells]) / 2)
+
+    def cluster_cells(self):
+        """
+        returns cell positions of every cluster
+        """
+        labels = np.unique(self.clusters[self.clusters != self.NO_CLUSTER])
+        return {float(label): np.flatnonzero(self.clusters == label) for label in labels}
+
+    def nbytes(self):
+        arrays = [self.west, self.south, self.east, self.north, self.ids, self.clusters, self.probabilities, *self.vectors.values()]
+        return sum(a.nbytes for a in arrays if a is not None)
+
+SHARD_SIZE = 50 # cells per tile side in sharded builds
+
+# ground the legacy pickles were built for - 10km square around Zurich HB with 200m cells, zip codes resolved online
+LEGACY_GROUND_KEY = fingerprint(8.5402515, 47.3777873, 10000, 200, None)
+
+def ground_key(longitude, latitude, area_side, cell_side, zipcode_file = None):
+    """
+    returns feature store key of the ground of given parameters
+    """
+    # without boundaries zip codes are resolved online as the legacy ground was, whatever the missing path
+    zipcode_file = zipcode_file if zipcode_file is not None and os.path.exists(zipcode_file) else None
+    return fingerprint(longitude, latitude, area_side, cell_side, zipcode_file)
+
+def populated_keys(key, demo_extractor, osm_extractor, ta_extractor):
+    """
+    returns feature store keys of the ground of given key populated from the base OSM data and after every OSM change file
+    """
+    return [
+        fingerprint(key, demo_extractor.key, osm_key, osm_extractor.CATEGORIES, ta_extractor.key)
+        for osm_key in osm_extractor.keys
+    ]
+
+def populate_tile(ground_df, osm_extractor, ta_extractor):
+    """
+    Populates cells of one ground tile in a pool worker, returns the populated columns only
+    extractors hold only the records the tile needs, restaurants are assigned to cells already
+    cell areas and OSM shapes come as WKB - sent to workers much faster than pickled geometries
+    """
+    columns = list(ground_df.columns)
+    index = ground_df.index
+    ground_df["area"] = shapely.from_wkb(ground_df["area"].values)
+    osm_extractor.df["shape"] = shapely.from_wkb(osm_extractor.df["shape"].values)
+
+    ground_df = osm_extractor.populate_ground(ground_df)
+    ground_df = ta_extractor.populate_cells(ground_df)
+    ground_df.index = index
+    return ground_df.drop(columns = columns)
 
 class ScoutingGround:
 
-    def __init__(self, dataset, longitude, latitude, area_side, cell_side):
+    def __init__(self, dataset, longitude, latitude, area_side, cell_side, zipcode_file = None):
         """
             dataset: - Name of the dataset to identify picke files
             longitude, latitude: Center point of the area
             area_radius - Area radius size in meters
             cell_size: Cell size to raster the map in meters
+            zipcode_file - .geojson file with postal code boundaries to resolve cell zip codes offline
         """
 
-        # read from pickle if exists
-        pickle_file = f"pickle/{dataset}.ground.df.pickle"
-        if os.path.exists(pickle_file):
-            print("Yeeh, found scouting ground pickle - will be loading data from there")
-            self.df = pd.read_pickle(pickle_file)
+        self.dataset = dataset
+        self.key = ground_key(longitude, latitude, area_side, cell_side, zipcode_file)
+        self.cell_side = cell_side
+        self.dimension = area_side // cell_side
+        # cell of this ground containing every cell of the finest ground, None for the finest ground itself
+        self.parent = None
+        # feature store keys of the populated ground and of the ground of the base OSM data, set by populate_ground
+        self.populated_key = self.base_populated_key = None
+
+        # read from feature store if exists
+        self.df = store.load(dataset, "ground", self.key, legacy_key = LEGACY_GROUND_KEY)
+        if self.df is not None:
+            print("Yeeh, found scouting ground in feature store - will be loading data from there")
 
         else:
             self.longitude = longitude
             self.latitude = latitude
 
-            self.dimension = area_side // cell_side
-            self.area_radius = (2 * (area_side / 2) ** 2) ** 0.5
-            self.cell_radius = (2 * (cell_side / 2) ** 2) ** 0.5
-
-            print(f"No pickle found for scouting ground data populating ground with {self.dimension}x{self.dimension} cells...")
+            print(f"No scouting ground data in feature store populating ground with {self.dimension}x{self.dimension} cells...")
+            start_time = time.time()
+            with metrics.stage("grid"):
+                self.df = GridGeometry.square(longitude, latitude, area_side, cell_side).to_frame()
+            print(f"Scouting ground with {len(self.df)} cells built in {(time.time() - start_time)} seconds")
+
+            zipcode_df = store.load(dataset, "zipcode", self.key, legacy_key = LEGACY_GROUND_KEY)
+            if zipcode_df is not None:
+                print("Yeeh, found zipcode ground in feature store - will be loading data from there")
+                self.df = zipcode_df
+            else:
+                print(f"Resolving zip code for {len(self.df)} location")
+                # zip codes of the legacy ground were resolved online - cells within its cells take them over
+                legacy_zipcode_df = None
+                if not (zipcode_file and os.path.exists(zipcode_file)) and self.key != LEGACY_GROUND_KEY:
+                    legacy_zipcode_df = store.load(dataset, "zipcode", LEGACY_GROUND_KEY, legacy_key = LEGACY_GROUND_KEY)
+                with metrics.stage("zipcode"):
+                    resolver = ZipcodeResolver(dataset, zipcode_file, resolved_df = legacy_zipcode_df)
+                    self.df["zipcode"] = resolver.resolve(self.df["center"].values)
+                store.save(dataset, "zipcode", self.key, self.df)
 
-            # walk to the north eastern most point
-            groundzero_long, groundzero_lat = walk(self.longitude, self.latitude, bearing = BEARING_NORTH_EAST, distance = self.area_radius)
+            self.df.insert(0, "id", range(len(self.df)))
 
-            # walk to the center of first cell
-            whereami_long, whereami_lat = walk(groundzero_long, groundzero_lat, bearing = BEARING_SOUTH_WEST, distance = self.cell_radius)
+            # store the data frame
+            store.save(dataset, "ground", self.key, self.df)
 
-            # 2d array of cells
-            self.cells = np.empty((self.dimension, self.dimension), dtype=np.object)
-            for i in range(self.dimension):
-                for j in range(self.dimension):
-                    self.cells[i,j] = ScoutingGroundCell(whereami_long, whereami_lat, self.cell_radius)
-                    # next column cell - walk west
-                    whereami_long, whereami_lat = walk(whereami_long, whereami_lat, bearing = BEARING_WEST, distance = cell_side)
-                # next row of cells - walk south
-                whereami_long, whereami_lat = walk(groundzero_long, whereami_lat, bearing = BEARING_SOUTH, distance = cell_side)
+        self.grid = GridGeometry.from_areas(self.df["area"].values)
+        self.base_df = self.df
+        self.arrays = None
+        self.cluster_cells = {}
+        self.similarity = None
+        # positions of the cells whose features changed since the models were built
+        self.changed_cells = np.zeros(0, dtype = np.int64)
 
-            # flatten to 1d array
-            self.cells = self.cells.flatten()
-            self.df = pd.DataFrame.from_records([c.to_dict() for c in self.cells])
+    def populate_ground(self, dataset, demo_extractor, osm_extractor, ta_extractor, workers = 1, shard_size = SHARD_SIZE):
+        """
+        dataset - name of the dataset to identify feature store entries
+        demo_extractor, osm_extractor, ta_extractor - extractors populating the cells
+        workers - number of processes populating ground tiles, 1 populates the whole ground in this process
+        shard_size - number of cells per tile side
+        """
+        keys = populated_keys(self.key, demo_extractor, osm_extractor, ta_extractor)
+        # the legacy pickle is the ground of the legacy parameters populated from the base OSM data and demographics by zip code
+        legacy = {
+            "legacy_key": fingerprint(LEGACY_GROUND_KEY, fingerprint(demo_extractor.demographics_file), osm_extractor.base_key,
+                osm_extractor.CATEGORIES, ta_extractor.key),
+            "legacy_inputs": [demo_extractor.demographics_file, osm_extractor.geojson_file]
+        }
+        populated_df = store.load(dataset, "ground.populated", keys[-1], **legacy)
+        if populated_df is not None:
+            print("Yeeh, found populated scouting ground in feature store - will be loading data from there")
+            self.df = populated_df
 
-            zipcode_pickle = f"pickle/{dataset}.zipcode.df.pickle"
-            if os.path.exists(zipcode_pickle):
-                print("Yeeh, found zipcode ground pickle - will be loading data from there")
-                self.df = pd.read_pickle(zipcode_pickle)
+        else:
+            with metrics.stage("ground_refresh"):
+                populated_df = self.__refresh_ground(dataset, osm_extractor, keys, legacy)
+            if populated_df is not None:
+                self.df = populated_df
             else:
-                print(f"Resolving zip code for {len(self.df)} location")
-                # resolve zip codes
-                def get_zipcode(longitude, latitude):
-                    print(f"Resolving zip code for {longitude},{latitude}")
-                    response = requests.get(
-                        f"{GEOCODE_URL}/{latitude},{longitude}", 
-                        params = {"key" : GEOCODE_API_KEY}
-                        ).json()["resourceSets"][0]["resources"][0]["address"]["postalCode"]
-                    return response
-
-                self.df["zipcode"] = self.df["center"].apply(lambda center: int(get_zipcode(center.x, center.y)))
-                self.df.to_pickle(zipcode_pickle)
+                tiles = self.__tiles(shard_size)
+                if workers > 1 and len(tiles) > 1:
+                    with metrics.stage("ground_sharded"):
+                        self.__build_ground_sharded(demo_extractor, osm_extractor, ta_extractor, tiles, workers)
+                else:
+                    self.__build_ground(demo_extractor, osm_extractor, ta_extractor)
+                store.save(dataset, "ground.populated", keys[-1], self.df)
+
+        # ground of the base OSM data the models are built on
+        self.base_df = self.df
+        self.populated_key = self.base_populated_key = keys[-1]
+        if len(keys) > 1:
+            base_df = store.load(dataset, "ground.populated", keys[0], **legacy)
+            if base_df is not None:
+                self.base_df = base_df
+                self.base_populated_key = keys[0]
+            else:
+                # ground built from scratch with the changes applied - the models are fitted on it, no cell is reassigned
+                print("No populated ground of the base OSM data in feature store - models are built on the changed ground")
 
-            self.df.insert(0, "id", range(len(self.df)))
+    def __build_ground(self, demo_extractor, osm_extractor, ta_extractor):
+        start_time = time.time()
+        with metrics.stage("demographics"):
+            self.df = demo_extractor.populate_ground(self.df)
+        print(f"Demographics data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
 
-            # pickle the data frame
-            self.df.to_pickle(pickle_file)
+        start_time = time.time()
+        with metrics.stage("osm"):
+            self.df = osm_extractor.populate_ground(self.df)
+        print(f"OSM data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
 
-    def populate_ground(self, dataset, demo_extractor, osm_extractor, ta_extractor):
+        start_time = time.time()
+        with metrics.stage("tripadvisor"):
+            self.df = ta_extractor.populate_ground(self.df)
+        print(f"TripAdvisor data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
 
-        pickle_file = f"pickle/{dataset}.ground.populated.df.pickle"
-        if os.path.exists(pickle_file):
-            print("Yeeh, found populated scouting ground pickle - will be loading data from there")
-            self.df = pd.read_pickle(pickle_file)
+    def __tiles(self, shard_size):
+        """
+        returns list of cell positions of square tiles with shard_size cells per side
+        """
+        rows, columns = np.divmod(np.arange(len(self.df)), self.grid.columns)
+        tile_ids = (rows // shard_size) * -(-self.grid.columns // shard_size) + columns // shard_size
+        order = np.argsort(tile_ids, kind = "stable")
+        return np.split(order, np.flatnonzero(np.diff(tile_ids[order])) + 1)
 
-        else:
-            start_time = time.time()
+    def __build_ground_sharded(self, demo_extractor, osm_extractor, ta_extractor, tiles, workers):
+        """
+        Populates ground tiles in a process pool and merges them in cell order,
+        every tile gets only the OSM features intersecting its bounds widened by a margin and the restaurants in its cells
+        """
+        start_time = time.time()
+        print(f"Populating {len(self.df)} cells in {len(tiles)} tiles with {workers} workers")
+
+        # demographics are apportioned to the cells from the postal areas they overlap, once for the whole ground
+        with metrics.stage("demographics"):
             self.df = demo_extractor.populate_ground(self.df)
-            print(f"Demographics data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
 
-            start_time = time.time()
-            self.df = osm_extractor.populate_ground(self.df)
-            print(f"OSM data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
+        # restaurants are assigned to cells once for the whole ground, as the single process build does
+        ta_extractor.assign_cells(self.df)
+        osm_tree = STRtree(osm_extractor.df["shape"].values)
+        west, south, east, north = self.grid.bounds()
+        margin = GridGeometry.EDGE_MARGIN * np.median(east - west)
+
+        # geometries other than the cell areas are not needed to populate the cells
+        geometry_columns = [c for c in self.df.columns if isinstance(self.df[c].iloc[0], BaseGeometry)]
+        ground_df = self.df.drop(columns = [c for c in geometry_columns if c != "area"])
+        ground_df["area"] = shapely.to_wkb(ground_df["area"].values)
+        osm_df = osm_extractor.df.copy()
+        osm_df["shape"] = shapely.to_wkb(osm_df["shape"].values)
+        ta_df = ta_extractor.df.drop(columns = "point")
+
+        def tile_task(cells):
+            tile_box = shapely.box(west[cells].min() - margin, south[cells].min() - margin,
+                east[cells].max() + margin, north[cells].max() + margin)
+            tile_df = ground_df.iloc[cells]
+
+            tile_osm = copy.copy(osm_extractor)
+            tile_osm.diffs = {}
+            tile_osm.df = osm_df.iloc[np.sort(osm_tree.query(tile_box, predicate = "intersects"))]
+            tile_ta = copy.copy(ta_extractor)
+            tile_ta.osm_extractor = tile_osm
+            tile_ta.df = ta_df[ta_df["cell_id"].isin(tile_df["id"])]
+            return tile_df, tile_osm, tile_ta
+
+        # at most two tiles per worker in flight keeps memory bounded
+        populated = []
+        with ProcessPoolExecutor(max_workers = workers) as executor:
+            pending = set()
+            for cells in tiles:
+                if len(pending) >= 2 * workers:
+                    done, pending = wait(pending, return_when = FIRST_COMPLETED)
+                    populated.extend(future.result() for future in done)
+                pending.add(executor.submit(populate_tile, *tile_task(cells)))
+            populated.extend(future.result() for future in wait(pending)[0])
+
+        # tiles come back indexed by cell position
+        self.df = pd.concat([self.df, pd.concat(populated).sort_index()], axis = 1)
+        print(f"Ground of {len(self.df)} cells populated from {len(tiles)} tiles in {(time.time() - start_time)} seconds")
+
+    def __refresh_ground(self, dataset, osm_extractor, populated_keys, legacy):
+        """
+        Applies OSM change files incrementally on the latest stored populated ground,
+        returns None if there is no stored ground to start from or a change can not be replayed
+        """
+        latest = [i for i in range(1, len(populated_keys) - 1) if store.exists(dataset, "ground.populated", populated_keys[i])]
+        state = latest[-1] if latest else 0
+        df = store.load(dataset, "ground.populated", populated_keys[state], **legacy)
+        if df is None:
+            return None
 
+        start_time = time.time()
+        print(f"Refreshing scouting ground with {len(populated_keys) - 1 - state} OSM change files")
+        recomputed = set()
+        for i in range(state + 1, len(populated_keys)):
+            diff = osm_extractor.diff(i)
+            if diff is None:
+                print(f"No OSM data stored before change file {osm_extractor.change_files[i - 1]} - populating ground from scratch")
+                return None
+            df, touched = osm_extractor.update_ground(df, *diff)
+            recomputed.update(touched.tolist())
+            store.save(dataset, "ground.populated", populated_keys[i], df)
+
+        print(f"Scouting ground refreshed, {len(recomputed)} of {len(df)} cells recomputed in {(time.time() - start_time)} seconds")
+        return df
+
+    def roll_up(self, factor, demo_extractor, osm_extractor, ta_extractor):
+        """
+        Coarser level of the populated ground, every cell aggregates a block of factor x factor cells:
+        zip code is the most common one of the block, demographics are apportioned to the block, restaurant counts and rankings
+        are recomputed from the restaurants of the block, so zip codes are not resolved and restaurants not located again.
+        OSM features crossing cells would be counted in several cells of a block, they are counted once per block
+        with a query of the block areas against the loaded OSM features.
+        factor - cells per block side, blocks on the southern and eastern edges hold the cells left
+        demo_extractor, osm_extractor, ta_extractor - extractors of the populated ground, restaurants assigned to its cells
+
+        returns ScoutingGround of the coarser level
+        """
+        level = copy.copy(self)
+        level.grid = self.grid.coarsen(factor)
+        parent = self.grid.parents(factor)
+        level.parent = parent if self.parent is None else parent[self.parent]
+        level.key = fingerprint(self.key, factor)
+        level.cell_side = self.cell_side * factor
+        level.dimension = level.grid.rows
+        level.populated_key = fingerprint(self.populated_key, factor)
+        level.base_populated_key = fingerprint(self.base_populated_key, factor)
+        level.arrays = None
+        level.cluster_cells = {}
+        level.similarity = None
+        level.changed_cells = np.zeros(0, dtype = np.int64)
+
+        level.df = store.load(self.dataset, "ground.level", level.populated_key)
+        if level.df is not None:
+            print(f"Yeeh, found scouting ground of {level.cell_side}m cells in feature store - will be loading data from there")
+        else:
             start_time = time.time()
-            self.df = ta_extractor.populate_ground(self.df)
-            print(f"TripAdvisor data for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
+            with metrics.stage(f"roll_up_{level.cell_side}"):
+                level.df = level.__roll_up_frame(self.df, parent, demo_extractor, osm_extractor, ta_extractor)
+            store.save(self.dataset, "ground.level", level.populated_key, level.df)
+            print(f"Scouting ground of {len(level.df)} cells of {level.cell_side}m rolled up in {(time.time() - start_time)} seconds")
+
+        level.base_df = level.df
+        if self.base_df is not self.df:
+            level.base_df = store.load(self.dataset, "ground.level", level.base_populated_key)
+            if level.base_df is None:
+                # counts of the base OSM data, before the change files
+                base_osm = copy.copy(osm_extractor)
+                base_osm.df = store.load(osm_extractor.dataset, "osm", osm_extractor.base_key,
+                    legacy_key = osm_extractor.base_key, legacy_inputs = [osm_extractor.geojson_file])
+                level.base_df = level.__roll_up_frame(self.base_df, parent, demo_extractor, base_osm, ta_extractor)
+                store.save(self.dataset, "ground.level", level.base_populated_key, level.base_df)
+        return level
+
+    def __roll_up_frame(self, df, parent, demo_extractor, osm_extractor, ta_extractor):
+        bounds = pd.DataFrame(shapely.bounds(df["area"].values), columns = ["west", "south", "east", "north"])
+        bounds = bounds.groupby(parent).agg({"west": "min", "south": "min", "east": "max", "north": "max"})
+        level_df = pd.DataFrame({
+            "id": np.arange(len(bounds), dtype = df["id"].dtype),
+            "center": shapely.points((bounds["west"].values + bounds["east"].values) / 2,
+                (bounds["south"].values + bounds["north"].values) / 2),
+            "area": shapely.box(bounds["west"].values, bounds["south"].values, bounds["east"].values, bounds["north"].values)
+        })
+
+        # most common zip code of the block, the smallest one of equally common ones
+        zipcodes = pd.DataFrame({"id": parent, "zipcode": df["zipcode"].values}).dropna()
+        zipcodes = zipcodes.groupby(["id", "zipcode"]).size().rename("cells").reset_index()
+        zipcodes = zipcodes.sort_values(["id", "cells", "zipcode"], ascending = [True, False, True]).drop_duplicates("id")
+        level_df["zipcode"] = level_df["id"].map(zipcodes.set_index("id")["zipcode"])
+        if not level_df["zipcode"].isna().any():
+            level_df["zipcode"] = level_df["zipcode"].astype(df["zipcode"].dtype)
+
+        level_df = demo_extractor.populate_ground(level_df)
+        level_df = osm_extractor.populate_ground(level_df)
+        level_df = self.level_restaurants(ta_extractor).populate_cells(level_df)
+        return level_df[[c for c in df.columns if c in level_df.columns]]
+
+    def populate_neighbourhood(self, neighbourhood_extractor):
+        """
+        Adds the spatial lag columns of the populated cells, computed on the grid - no geometry involved
+        neighbourhood_extractor - NeighbourhoodExtractor of the features and radii
+
+        returns names of the added columns
+        """
+        start_time = time.time()
+        refreshed = self.base_df is not self.df
+        self.df = neighbourhood_extractor.populate_ground(self.df, self.grid.rows, self.grid.columns, self.cell_side)
+        if refreshed:
+            self.base_df = neighbourhood_extractor.populate_ground(self.base_df, self.grid.rows, self.grid.columns, self.cell_side)
+        else:
+            self.base_df = self.df
+        columns = neighbourhood_extractor.columns(self.cell_side)
+        print(f"{len(columns)} neighbourhood features of {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
+        return columns
 
-            self.df.to_pickle(pickle_file)
+    def level_restaurants(self, ta_extractor):
+        """
+        ta_extractor - extractor with restaurants assigned to cells of the finest ground
+
+        returns copy of the extractor with restaurants assigned to cells of this ground
+        """
+        if self.parent is None:
+            return ta_extractor
+        level_ta = copy.copy(ta_extractor)
+        cell_ids = ta_extractor.df["cell_id"].values
+        level_ta.df = ta_extractor.df.assign(cell_id = np.where(cell_ids >= 0, self.parent[np.maximum(cell_ids, 0)], -1))
+        return level_ta
 
     def populate_ground_from_model(self, model_builder, id_feature):
         start_time = time.time()
-        self.df = model_builder.populate_ground(self.df, id_feature)
+        refreshed = self.base_df is not self.df
+        with metrics.stage("model_populate"):
+            self.df = model_builder.populate_ground(self.df, id_feature)
         print(f"Data from machine learning models for {len(self.df)} cells populated in {(time.time() - start_time)} seconds")
 
-    def get_similar_locations(self, lon, lat):
-        point = Point(lon, lat) 
-        clusters = self.df.apply(lambda row: row["cluster"] if row["area"].intersects(point) else None, axis = 1)
-        first_valid_cluster_index = clusters.first_valid_index()
-        print("first valid index: ", first_valid_cluster_index)
-        if first_valid_cluster_index:
-            cluster = clusters[first_valid_cluster_index]
-            return self.df[self.df["cluster"] == cluster]["area"]
+        # models are built on the base ground, cells changed since are assigned to the nearest cluster
+        if refreshed:
+            self.__reassign_changed_cells(model_builder, self.base_df)
+
+        self.build_arrays(model_builder.cluster_vectors(self.df), model_builder.cluster_features)
+        self.build_similarity_index()
+        self.build_probability_surface(model_builder)
+
+        # serving processes load the arrays only, see load_serving
+        self.serving_key = fingerprint(self.populated_key, model_builder.key)
+        if not store.read_only and not store.exists(self.dataset, "ground.serving", self.serving_key):
+            self.arrays.save(self.dataset, self.serving_key, self.changed_cells)
+
+    @classmethod
+    def load_serving(cls, dataset, key, serving_key, cell_side, grid = None, parent = None):
+        """
+        Clustered ground of the serving arrays stored by populate_ground_from_model - memory-mapped, no data frame is loaded
+        dataset - name of the dataset to identify feature store entries
+        key, serving_key - feature store keys of the ground and of its serving arrays
+        cell_side - cell side in meters
+        grid - GridGeometry of the cells, read from the cell bounds if None
+        parent - cell of this ground containing every cell of the finest ground, None for the finest ground itself
+
+        returns ScoutingGround serving queries only
+        """
+        ground = cls.__new__(cls)
+        ground.dataset = dataset
+        ground.key = key
+        ground.serving_key = serving_key
+        ground.cell_side = cell_side
+        ground.parent = parent
+        ground.df = ground.base_df = None
+        ground.arrays, ground.changed_cells = GroundArrays.load(dataset, serving_key)
+        ground.grid = GridGeometry.from_bounds(*ground.arrays.bounds()) if grid is None else grid
+        ground.dimension = ground.grid.rows
+        ground.cluster_cells = ground.arrays.cluster_cells()
+        ground.build_similarity_index()
+        return ground
+
+    def build_arrays(self, vectors, vector_names):
+        """
+        Builds the serving arrays of the clustered ground, queries run on them only
+        vectors - normalized feature vectors of the cells as clustered, one row per cell
+        vector_names - features of the vectors
+        """
+        self.arrays = GroundArrays(self.df, vectors, vector_names)
+        # cell positions of every cluster for the similar locations lookup
+        self.cluster_cells = self.arrays.cluster_cells()
+
+    def at_granularity(self, model_builder, n_clusters):
+        """
+        Copy of the clustered ground with the cells in n_clusters clusters - a cut of the linkage tree of the models,
+        cells changed since the models were built are assigned to the nearest cluster. Serving arrays other than
+        the cluster labels are shared.
+        model_builder - models the ground is populated from
+        n_clusters - number of clusters
+
+        returns ScoutingGround with the cluster labels of n_clusters clusters
+        """
+        cluster_model = model_builder.cluster_model_at(n_clusters)
+        clusters = np.full(len(self.arrays), GroundArrays.NO_CLUSTER, dtype = np.int16 if n_clusters < np.iinfo(np.int16).max else np.int32)
+        clusters[np.searchsorted(self.arrays.ids, model_builder.df_cluster[model_builder.id_feature].values)] = cluster_model.labels_
+        if len(self.changed_cells):
+            clusters[self.changed_cells] = cluster_model.predict(self.arrays.vectors_at(self.changed_cells))
+
+        level = copy.copy(self)
+        level.arrays = copy.copy(self.arrays)
+        level.arrays.clusters = clusters
+        level.cluster_cells = level.arrays.cluster_cells()
+        return level
+
+    def build_similarity_index(self):
+        """
+        Indexes normalized feature vectors of the clustered cells for the similar cells search,
+        cells changed since the models were built are indexed with their current features
+        """
+        start_time = time.time()
+        with metrics.stage("similarity_index"):
+            cells = np.flatnonzero(self.arrays.clusters != GroundArrays.NO_CLUSTER)
+            vectors = self.arrays.vectors_at(cells)
+            complete = ~np.isnan(vectors).any(axis = 1)
+            cells, vectors = cells[complete], vectors[complete]
+
+            west, south, east, north = self.arrays.bounds()
+            self.origin = (west.min() + east.max()) / 2, (south.min() + north.max()) / 2
+            x, y = self.project((west[cells] + east[cells]) / 2, (south[cells] + north[cells]) / 2)
+            self.similarity = SimilarityIndex(self.arrays.ids[cells], vectors, x, y)
+        print(f"Feature vectors of {len(cells)} cells indexed for similarity search in {(time.time() - start_time)} seconds")
+
+    def build_probability_surface(self, model_builder):
+        """
+        Success probability of every cell from the regression model, computed once per populated ground and model
+        and stored with the ground - scoring a location looks up its cell only
+        """
+        key = fingerprint(self.populated_key, model_builder.key)
+        df = store.load(self.dataset, "ground.probability", key, columns = ["probability"])
+        if df is not None:
+            print("Yeeh, found success probability surface in feature store - will be loading data from there")
+            probabilities = df["probability"].values
         else:
+            start_time = time.time()
+            with metrics.stage("probability_surface"):
+                probabilities = model_builder.success_probabilities(self.df)
+            store.save(self.dataset, "ground.probability", key, pd.DataFrame({"id": self.arrays.ids, "probability": probabilities}))
+            print(f"Success probability of {len(probabilities)} cells predicted in {(time.time() - start_time)} seconds")
+        self.arrays.probabilities = np.ascontiguousarray(probabilities, dtype = np.float32)
+
+    def project(self, lon, lat):
+        """
+        returns x and y in meters from the center of the ground
+        """
+        lon_meters, lat_meters = meters_per_degree(self.origin[1])
+        return (np.asarray(lon) - self.origin[0]) * lon_meters, (np.asarray(lat) - self.origin[1]) * lat_meters
+
+    def release_frames(self):
+        """
+        Drops the data frames of the build, keeps the serving arrays
+        """
+        frames_size = self.df.memory_usage(deep = True).sum()
+        self.df = None
+        self.base_df = None
+        print(f"Serving ground of {len(self.arrays)} cells holds {self.arrays.nbytes() / 2 ** 20:.1f} MB, build frames held {frames_size / 2 ** 20:.1f} MB")
+
+    def __reassign_changed_cells(self, model_builder, base_df):
+        """
+        Assigns cells whose cluster features differ from the base ground to the nearest cluster,
+        changes of features the clustering does not use keep the cluster of the cell
+        """
+        features = model_builder.cluster_features
+        current = self.df[features].values.astype(float)
+        base = base_df[features].values.astype(float)
+        changed = ((current != base) & ~(np.isnan(current) & np.isnan(base))).any(axis = 1)
+        changed = np.flatnonzero(changed & self.df["cluster"].notna().values)
+        if not len(changed):
+            return
+
+        clusters = self.df["cluster"].values.astype(float)
+        assigned = model_builder.assign_clusters(self.df.iloc[changed])
+        moved = (clusters[changed] != assigned).sum()
+        clusters[changed] = assigned
+        self.df["cluster"] = clusters
+        self.changed_cells = changed
+        print(f"Reassigned clusters of {len(changed)} cells with changed cluster features, {moved} moved to another cluster")
+
+    def get_similar_locations(self, lon, lat):
+        return self.get_cluster_locations(self.get_cluster(lon, lat))
+
+    def get_cluster(self, lon, lat):
+        """
+        returns cluster of the first clustered cell at the location, NaN if there is none
+        """
+        cell_ids = self.grid.locate_many([lon], [lat], self.arrays.bounds())
+        metrics.log_request("cells at location: ", cell_ids[cell_ids >= 0].tolist())
+        return self.__first_cluster(cell_ids)[0]
+
+    def get_clusters(self, lon, lat):
+        """
+        lon, lat - arrays of points
+
+        returns cluster of the first clustered cell at each point, NaN where there is none
+        """
+        return self.__first_cluster(self.grid.locate_many(lon, lat, self.arrays.bounds()))
+
+    def get_probabilities(self, lon, lat):
+        """
+        lon, lat - arrays of points
+
+        returns ids of the first scored cell at each point and its success probability, -1 and NaN where there is none
+        """
+        cell_ids = self.grid.locate_many(lon, lat, self.arrays.bounds())
+        probabilities = np.where(cell_ids >= 0, self.arrays.probabilities[np.maximum(cell_ids, 0)], np.nan)
+        scored = ~np.isnan(probabilities)
+        first = scored.argmax(axis = 1)
+        rows = np.arange(len(cell_ids))
+        found = scored.any(axis = 1)
+        return np.where(found, cell_ids[rows, first], -1), np.where(found, probabilities[rows, first], np.nan)
+
+    def get_similar_cells(self, lon, lat, k, radius = None, exclude = ()):
+        """
+        lon, lat - location
+        k - number of similar cells
+        radius - meters around the location the similar cells are restricted to, no restriction if None
+        exclude - ids of cells left out, the cell at the location is always left out
+
+        returns id of the cell at the location, ids and feature distances of the k most similar cells -
+        None if there is no indexed cell at the location
+        """
+        cell_ids = self.grid.locate_many([lon], [lat], self.arrays.bounds())[0]
+        indexed = [cell_id for cell_id in cell_ids if cell_id >= 0 and cell_id in self.similarity]
+        if not indexed:
             return None
+        center = self.project(lon, lat) if radius is not None else None
+        similar, distances = self.similarity.query(indexed[0], k, center, radius, exclude)
+        return indexed[0], similar, distances
 
-        
+    def get_cluster_locations(self, cluster):
+        """
+        returns areas of all cells in given cluster indexed by cell id, None for NaN cluster
+        """
+        if np.isnan(cluster):
+            return None
+        cells = self.cluster_cells[cluster]
+        return pd.Series(self.arrays.areas(cells), index = self.arrays.ids[cells])
+
+    def __first_cluster(self, cell_ids):
+        # clusters of located cells, first clustered one in each row
+        clusters = np.where(cell_ids >= 0, self.arrays.clusters[np.maximum(cell_ids, 0)], GroundArrays.NO_CLUSTER)
+        clustered = clusters != GroundArrays.NO_CLUSTER
+        first = clustered.argmax(axis = 1)
+        return np.where(clustered.any(axis = 1), clusters[np.arange(len(clusters)), first], np.nan)
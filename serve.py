@@ -0,0 +1,218 @@
+"""
+Production serving of the location intelligence API with pre-forked workers.
+
+The parent process loads the Scouters of the preloaded cities once and forks workers sharing its memory copy-on-write -
+the loaded objects are frozen out of garbage collection before forking so their pages stay shared.
+Workers only read - the feature store is switched to read only after fork, so a request can never rebuild the pipeline.
+The parent watches input data files and the feature store and reloads gracefully when new artifacts appear:
+the preloaded cities are loaded again next to the old ones, new workers are forked and old workers finish their requests before exiting.
+
+    python serve.py --port 5000 --workers 4 --preload zurich,basel --memory-budget 4096
+    kill -HUP <parent pid> # reload now
+
+Cities not preloaded are loaded by every worker on its first request for them, within the worker's memory budget.
+Metrics of /metrics are per worker: build stages are inherited from the parent, request latencies are the worker's own.
+"""
+import os
+import gc
+import time
+import socket
+import signal
+import argparse
+import threading
+
+from werkzeug.serving import make_server
+
+from feature_store import store, STORE_DIRECTORY, LEGACY_PICKLE_DIRECTORY
+from registry import ScouterRegistry, load_datasets, DATASETS_FILE, MEMORY_BUDGET
+from metrics import metrics
+
+HOST = "0.0.0.0"
+PORT = 5000
+WORKERS = 4
+RELOAD_INTERVAL = 10 # seconds between checks for new data artifacts
+BACKLOG = 128
+
+def artifacts_signature():
+    """
+    Returns signature of input data files and feature store entries, changes when new data artifacts appear
+    """
+    signature = []
+    for file in [DATASETS_FILE] + [f for dataset in load_datasets().values() for f in dataset.input_files]:
+        if os.path.exists(file):
+            stat = os.stat(file)
+            signature.append((file, stat.st_size, stat.st_mtime_ns))
+    for directory in [STORE_DIRECTORY, LEGACY_PICKLE_DIRECTORY]:
+        if os.path.isdir(directory):
+            signature.extend(sorted(name for name in os.listdir(directory) if ".tmp" not in name))
+    return signature
+
+class Server:
+    """
+    Pre-fork server: owns the listening socket and the registry of loaded cities, keeps a generation of workers running
+    """
+
+    def __init__(self, host, port, workers, reload_interval, preload = None, memory_budget = MEMORY_BUDGET):
+        """
+        host, port - address to listen on
+        workers - number of worker processes
+        reload_interval - seconds between checks for new data artifacts
+        preload - names of the cities loaded before forking, the first dataset if None
+        memory_budget - bytes of loaded cities per process
+        """
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.reload_interval = reload_interval
+        self.preload = preload
+        self.memory_budget = memory_budget
+
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(BACKLOG)
+
+        self.current = set() # pids of workers serving the current data
+        self.draining = set() # pids of workers finishing requests on replaced data
+        self.stopping = False
+        self.reload_requested = False
+
+        # building api loads the first city, once, in the parent
+        import api
+        self.api = api
+        self.api.registry.memory_budget = memory_budget
+        self.api.registry.preload(preload)
+        self.signature = artifacts_signature()
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.__stop)
+        signal.signal(signal.SIGINT, self.__stop)
+        signal.signal(signal.SIGHUP, self.__request_reload)
+
+        self.__spawn_workers()
+        print(f"Serving on {self.host}:{self.port} with {self.workers} workers, parent pid {os.getpid()}")
+
+        last_check = time.time()
+        while not self.stopping:
+            time.sleep(0.2)
+            self.__reap_workers()
+            if self.reload_requested or time.time() - last_check > self.reload_interval:
+                last_check = time.time()
+                self.__reload_on_change()
+
+        print(f"Stopping {len(self.current | self.draining)} workers")
+        self.__terminate(self.current | self.draining)
+        while self.current or self.draining:
+            self.__reap_workers(block = True)
+
+    def __stop(self, signum, frame):
+        self.stopping = True
+
+    def __request_reload(self, signum, frame):
+        self.reload_requested = True
+
+    def __reload_on_change(self):
+        signature = artifacts_signature()
+        if signature == self.signature and not self.reload_requested:
+            return
+        self.reload_requested = False
+
+        print("New data artifacts found - reloading")
+        start_time = time.time()
+        gc.unfreeze()
+        try:
+            registry = self.__load_registry()
+        except Exception as e:
+            # keep serving the loaded data
+            print(f"Reload failed, serving previous data: {e!r}")
+            self.signature = signature
+            gc.freeze()
+            return
+
+        self.api.registry = registry
+        # artifacts written by the reload itself are part of the new state
+        self.signature = artifacts_signature()
+        previous = self.current
+        self.current = set()
+        self.__spawn_workers()
+        self.__terminate(previous)
+        self.draining |= previous
+        print(f"Reloaded in {(time.time() - start_time)} seconds, draining {len(previous)} previous workers")
+
+    def __load_registry(self):
+        registry = ScouterRegistry(load_datasets(), self.memory_budget)
+        registry.preload(self.preload)
+        return registry
+
+    def __spawn_workers(self):
+        # objects loaded so far are left out of garbage collection to keep their pages shared
+        gc.collect()
+        gc.freeze()
+        while len(self.current) < self.workers:
+            pid = os.fork()
+            if pid == 0:
+                self.__serve_worker()
+            self.current.add(pid)
+
+    def __serve_worker(self):
+        try:
+            store.read_only = True
+            signal.signal(signal.SIGINT, signal.SIG_IGN)
+            signal.signal(signal.SIGHUP, signal.SIG_IGN)
+
+            server = make_server(self.host, self.port, self.api.app, fd = self.listener.fileno())
+            # workers race for connections on the shared socket, the losers return to waiting
+            server.socket.setblocking(False)
+
+            def drain(signum, frame):
+                self.api.ready = False
+                threading.Thread(target = server.shutdown).start()
+            signal.signal(signal.SIGTERM, drain)
+
+            server.serve_forever()
+        finally:
+            os._exit(0)
+
+    def __terminate(self, pids):
+        for pid in pids:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def __reap_workers(self, block = False):
+        while self.current or self.draining:
+            try:
+                pid, status = os.waitpid(-1, 0 if block else os.WNOHANG)
+            except ChildProcessError:
+                self.current.clear()
+                self.draining.clear()
+                return
+            if pid == 0:
+                return
+            self.draining.discard(pid)
+            if pid in self.current:
+                self.current.discard(pid)
+                if not self.stopping:
+                    print(f"Worker {pid} exited with status {status}, starting a new one")
+                    self.__spawn_workers()
+            if block:
+                return
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description = "Serve location intelligence API with pre-forked workers")
+    parser.add_argument("--host", default = HOST)
+    parser.add_argument("--port", type = int, default = PORT)
+    parser.add_argument("--workers", type = int, default = WORKERS)
+    parser.add_argument("--reload-interval", type = float, default = RELOAD_INTERVAL)
+    parser.add_argument("--no-request-logging", action = "store_true", help = "no console output per request")
+    parser.add_argument("--preload", help = "comma separated cities loaded before forking, the first dataset if not set")
+    parser.add_argument("--memory-budget", type = float, default = MEMORY_BUDGET / 1024 ** 2,
+        help = "megabytes of loaded cities per process, least recently used cities are evicted beyond it")
+    args = parser.parse_args()
+
+    if args.no_request_logging:
+        metrics.set_request_logging(False)
+
+    preload = args.preload.split(",") if args.preload else None
+    Server(args.host, args.port, args.workers, args.reload_interval, preload, int(args.memory_budget * 1024 ** 2)).run()
@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from benchmark import synthetic_data
+from extractors.demographic_extractor import DemographicsExtractor
+from scouting_ground import GridGeometry
+
+LONGITUDE = 8.5402515
+LATITUDE = 47.3777873
+AREA_SIDE = 2000
+CELL_SIDE = 200
+
+# postal areas inside the ground in fractions of its bounds, 8003 has no demographics
+POSTAL_AREAS = {
+    8001: [(0.1, 0.1), (0.6, 0.15), (0.45, 0.7), (0.1, 0.5)],
+    8002: [(0.6, 0.2), (0.9, 0.2), (0.9, 0.8), (0.6, 0.8)],
+    8003: [(0.1, 0.8), (0.4, 0.8), (0.4, 0.95), (0.1, 0.95)]
+}
+DEMOGRAPHICS = pd.DataFrame({
+    "zipcode": [8001, 8002, 8999],
+    "proportion_of_foreigners": [20.0, 40.0, 30.0],
+    "population": [12000, 3000, 5000],
+    "employee": [800, 9000, 100],
+    "workplaces": [70, 400, 10]
+})
+
+def write_inputs(directory):
+    west, south, east, north = synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE)
+    features = [{
+        "type": "Feature",
+        "properties": {"postal_code": str(zipcode)},
+        "geometry": {"type": "Polygon", "coordinates": [[
+            [west + x * (east - west), south + y * (north - south)] for x, y in corners + corners[:1]
+        ]]}
+    } for zipcode, corners in POSTAL_AREAS.items()]
+    zipcode_file = str(directory / "zipcodes.geojson")
+    with open(zipcode_file, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+    demographics_file = str(directory / "demographics.csv")
+    DEMOGRAPHICS.to_csv(demographics_file, index = False)
+    return zipcode_file, demographics_file, [shape(feature["geometry"]) for feature in features]
+
+def test_apportioned_counts_add_up_to_postal_totals(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    zipcode_file, demographics_file, areas = write_inputs(tmp_path)
+    ground_df = GridGeometry.square(LONGITUDE, LATITUDE, AREA_SIDE, CELL_SIDE).to_frame()
+    ground_df.insert(0, "id", range(len(ground_df)))
+
+    populated = DemographicsExtractor("test", demographics_file, zipcode_file).populate_ground(ground_df)
+
+    # postal areas are inside the ground - their counts are apportioned to the cells completely
+    known = DEMOGRAPHICS[DEMOGRAPHICS["zipcode"].isin([8001, 8002])]
+    for column in ["population", "employee", "workplaces"]:
+        np.testing.assert_allclose(populated[column].sum(), known[column].sum(), rtol = 1e-9)
+
+    # cells outside the postal areas with demographics get none
+    cells = ground_df["area"].values
+    with_demographics = shapely.area(shapely.intersection(cells, shapely.union(areas[0], areas[1]))) > 0
+    assert populated["population"].notna().values.tolist() == with_demographics.tolist()
+    assert populated["population"][shapely.within(cells, areas[2])].isna().all()
+
+    # rates are area weighted means of the postal areas a cell overlaps
+    inside = shapely.within(cells, areas[1])
+    assert inside.any()
+    np.testing.assert_allclose(populated["proportion_of_foreigners"][inside], 40.0)
+    overlaps = shapely.area(shapely.intersection(cells, areas[0])), shapely.area(shapely.intersection(cells, areas[1]))
+    both = (overlaps[0] > 0) & (overlaps[1] > 0)
+    assert both.any()
+    expected = (20.0 * overlaps[0][both] + 40.0 * overlaps[1][both]) / (overlaps[0][both] + overlaps[1][both])
+    np.testing.assert_allclose(populated["proportion_of_foreigners"][both], expected)
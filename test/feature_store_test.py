@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+import pytest
+import shapely
+
+from feature_store import FeatureStore
+
+def frame():
+    return pd.DataFrame({
+        "id": np.arange(5),
+        "population": np.linspace(0, 1, 5),
+        "area": shapely.box(np.arange(5), 0, np.arange(5) + 1, 1),
+        "name": list("abcde")
+    })
+
+def test_partial_load_reads_given_columns(tmp_path):
+    store = FeatureStore(str(tmp_path / "store"), str(tmp_path / "pickle"))
+    store.save("test", "ground", "key", frame())
+
+    df = store.load("test", "ground", "key", columns = ["population", "id"])
+
+    # columns come in stored order
+    pd.testing.assert_frame_equal(df, frame()[["id", "population"]])
+    assert store.load("test", "ground", "other") is None
+
+def test_arrays_are_memory_mapped_without_copy(tmp_path):
+    store = FeatureStore(str(tmp_path / "store"), str(tmp_path / "pickle"))
+    store.save("test", "ground", "key", frame())
+
+    arrays = store.load_arrays("test", "ground", "key")
+
+    assert list(arrays) == ["id", "population"]
+    assert isinstance(arrays["population"].base, np.memmap) and not arrays["population"].flags.writeable
+    np.testing.assert_array_equal(arrays["population"], frame()["population"].values)
+
+    store.read_only = True
+    with pytest.raises(RuntimeError):
+        store.load_arrays("test", "ground", "other")
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+from ml.model_builder import ModelBuilder
+
+FEATURES = ["population", "workplaces", "bars", "shops"]
+TARGET = "successful_restaurants_any"
+SEED = 0
+
+def ground(successful, unsuccessful):
+    random = np.random.default_rng(SEED)
+    cells = successful + unsuccessful
+    df = pd.DataFrame(random.integers(0, 100, (cells, len(FEATURES))), columns = FEATURES)
+    df.insert(0, "id", range(cells))
+    df[TARGET] = [1] * successful + [0] * unsuccessful
+    return df
+
+def test_minority_class_is_oversampled(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # more successful cells than not, as on coarse levels
+    model_builder = ModelBuilder("test", ground(50, 30), "id", FEATURES, TARGET)
+
+    assert model_builder.df_reg[TARGET].value_counts().to_dict() == {0: 50, 1: 50}
+    probabilities = model_builder.success_probabilities(ground(50, 30))
+    assert not np.isnan(probabilities).any()
+
+def test_single_class_target_builds_clusters_without_regression(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    df = ground(0, 40)
+    model_builder = ModelBuilder("test", df, "id", FEATURES, TARGET)
+
+    assert model_builder.cluster_features == FEATURES
+    assert len(model_builder.df_cluster["cluster"].dropna()) == len(df)
+    assert np.isnan(model_builder.success_probabilities(df)).all()
+
+    # loaded from the feature store the same way
+    model_builder = ModelBuilder("test", df, "id", FEATURES, TARGET)
+    assert not model_builder.regression
@@ -0,0 +1,73 @@
+import json
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from benchmark import synthetic_data
+from extractors.osm_extractor import OSMExtractor
+from scouting_ground import GridGeometry
+
+LONGITUDE = 8.5402515
+LATITUDE = 47.3777873
+AREA_SIDE = 1600
+CELL_SIDE = 200
+SEED = 0
+
+def test_category_counts_equal_per_category_scan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    geojson_file = str(tmp_path / "osm.geojsonl")
+    synthetic_data.write_osm(geojson_file, 400, synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE), SEED)
+    osm_extractor = OSMExtractor("test", geojson_file)
+    ground_df = GridGeometry.square(LONGITUDE, LATITUDE, AREA_SIDE, CELL_SIDE).to_frame()
+
+    populated = osm_extractor.populate_ground(ground_df.copy())
+
+    # every category scanned on its own against every cell, as the ground was populated before the index
+    df = osm_extractor.df
+    for category, prop, values in OSMExtractor.CATEGORIES:
+        shapes = df[df[prop].notna() if values is None else df[prop].isin(values)]["shape"].values
+        expected = [int(shapely.intersects(area, shapes).sum()) for area in ground_df["area"]]
+        assert populated[category].tolist() == expected, category
+    assert np.asarray(populated[[c for c, _, _ in OSMExtractor.CATEGORIES]].values).sum() > 0
+
+def normalized_frame(features):
+    """
+    OSM data frame as the whole .geojson was loaded before streaming - json_normalize of the interesting features
+    """
+    features = [
+        feature for feature in features
+        if set(feature["properties"]) & OSMExtractor.PROPERTIES and feature["geometry"]["type"] in OSMExtractor.GEOMETRY_TYPES
+    ]
+    df = pd.json_normalize(features)
+    df = df[["id", "geometry.type", "geometry.coordinates"] + [c for c in df.columns if c.startswith("properties.")]]
+    df.columns = df.columns.str.split(".").str[-1]
+    df["shape"] = [shape({"type": t, "coordinates": c}) for t, c in zip(df["type"], df["coordinates"])]
+    df = df[[c for c in OSMExtractor.COLUMNS if c in df.columns]]
+    return df[shapely.is_valid(df["shape"].values)].reset_index(drop = True)
+
+def test_streamed_frame_equals_normalized_frame(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    sequence_file = str(tmp_path / "osm.geojsonl")
+    synthetic_data.write_osm(sequence_file, 200, synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE), SEED)
+    with open(sequence_file) as f:
+        features = [json.loads(line) for line in f]
+    # an invalid bowtie polygon and a feature without interesting properties are left out
+    features.append({"type": "Feature", "id": "way/bowtie", "properties": {"building": "house"},
+        "geometry": {"type": "Polygon", "coordinates": [[[8.54, 47.37], [8.55, 47.38], [8.55, 47.37], [8.54, 47.38], [8.54, 47.37]]]}})
+    features.append({"type": "Feature", "id": "node/bench", "properties": {"name": "bench"},
+        "geometry": {"type": "Point", "coordinates": [8.54, 47.37]}})
+    geojson_file = str(tmp_path / "osm.geojson")
+    with open(geojson_file, "w") as f:
+        json.dump({"type": "FeatureCollection", "features": features}, f)
+
+    streamed = OSMExtractor("test", geojson_file, chunk_size = 16).df
+    expected = normalized_frame(features)
+
+    assert list(streamed.columns) == OSMExtractor.COLUMNS
+    assert len(streamed) == len(expected) == len(features) - 2 - sum(
+        not set(feature["properties"]) & OSMExtractor.PROPERTIES for feature in features[:-2])
+    assert shapely.equals(streamed["shape"].values, expected["shape"].values).all()
+    others = [c for c in OSMExtractor.COLUMNS if c != "shape"]
+    pd.testing.assert_frame_equal(streamed[others].fillna(np.nan), expected.reindex(columns = others).fillna(np.nan),
+        check_dtype = False)
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+
+from benchmark import synthetic_data
+from extractors.demographic_extractor import DemographicsExtractor
+from extractors.osm_extractor import OSMExtractor
+from extractors.tripadvisor_extractor import TripAdvisorExtractor
+from ml.clustering import MINIBATCH_KMEANS
+from ml.model_builder import ModelBuilder
+from scouter import MODEL_FEATURES, TARGET_FEATURE
+from scouting_ground import ScoutingGround
+
+LONGITUDE = 8.5402515
+LATITUDE = 47.3777873
+AREA_SIDE = 2000
+CELL_SIDE = 200
+SEED = 0
+
+def populated_ground(dataset, files, restaurants, workers, shard_size):
+    geojson_file, zipcode_file, demographics_file = files
+    ground = ScoutingGround(dataset, LONGITUDE, LATITUDE, AREA_SIDE, CELL_SIDE, zipcode_file)
+    osm_extractor = OSMExtractor(dataset, geojson_file)
+    ta_extractor = TripAdvisorExtractor(dataset, osm_extractor)
+    ta_extractor.df = restaurants.copy()
+    ground.populate_ground(dataset, DemographicsExtractor(dataset, demographics_file, zipcode_file), osm_extractor, ta_extractor,
+        workers, shard_size)
+    return ground
+
+def write_inputs(directory):
+    area_bounds = synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE)
+    files = [str(directory / name) for name in ["osm.geojsonl", "zipcodes.geojson", "demographics.csv"]]
+    synthetic_data.write_osm(files[0], 1000, area_bounds, SEED)
+    synthetic_data.write_demographics(files[2], synthetic_data.write_postal_codes(files[1], area_bounds), SEED)
+    return files, synthetic_data.tripadvisor_frame(200, area_bounds, SEED)
+
+def test_sharded_build_equals_single_process_build(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files, restaurants = write_inputs(tmp_path)
+
+    single = populated_ground("single", files, restaurants, 1, 3).df
+    # 4x4 tiles of 3x3 cells, the last ones narrower - features crossing tiles are counted in every cell they intersect
+    sharded = populated_ground("sharded", files, restaurants, 2, 3).df
+
+    pd.testing.assert_frame_equal(single.drop(columns = ["center", "area"]), sharded.drop(columns = ["center", "area"]))
+    assert single["restaurants"].sum() > 0 and single["streets_minor"].sum() > 0
+
+def test_serving_ground_answers_as_built_ground(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    files, restaurants = write_inputs(tmp_path)
+    ground = populated_ground("test", files, restaurants, 1, 3)
+    model_builder = ModelBuilder("test", ground.df, "id", MODEL_FEATURES, TARGET_FEATURE, MINIBATCH_KMEANS)
+    ground.populate_ground_from_model(model_builder, "id")
+
+    served = ScoutingGround.load_serving("test", ground.key, ground.serving_key, CELL_SIDE)
+
+    assert isinstance(served.arrays.west.base, np.memmap) and served.df is None
+    lon, lat = synthetic_data.query_points(200, synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE), SEED)
+    np.testing.assert_array_equal(served.get_clusters(lon, lat), ground.get_clusters(lon, lat))
+    np.testing.assert_array_equal(served.get_probabilities(lon, lat), ground.get_probabilities(lon, lat))
+    for x, y in zip(lon[:20], lat[:20]):
+        expected = ground.get_similar_cells(x, y, 5)
+        similar = served.get_similar_cells(x, y, 5)
+        assert (similar is None) == (expected is None)
+        if expected is not None:
+            assert similar[0] == expected[0] and similar[1].tolist() == expected[1].tolist()
@@ -0,0 +1,59 @@
+import numpy as np
+import shapely
+
+from benchmark import synthetic_data
+from extractors.osm_extractor import OSMExtractor
+from extractors.tripadvisor_extractor import TripAdvisorExtractor
+from scouting_ground import GridGeometry
+
+LONGITUDE = 8.5402515
+LATITUDE = 47.3777873
+AREA_SIDE = 1600
+CELL_SIDE = 200
+SEED = 0
+
+def extractor(restaurants):
+    # restaurants are given, the OSM data they would be scraped for is never loaded
+    ta_extractor = TripAdvisorExtractor("test", OSMExtractor("test", "osm.geojsonl"))
+    ta_extractor.df = restaurants
+    return ta_extractor
+
+def test_restaurant_aggregation_equals_per_cell_scan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # the ground is wider than the cells, some restaurants are outside of it
+    restaurants = synthetic_data.tripadvisor_frame(300, synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE + 400), SEED)
+    ground_df = GridGeometry.square(LONGITUDE, LATITUDE, AREA_SIDE, CELL_SIDE).to_frame()
+    ground_df.insert(0, "id", range(len(ground_df)))
+
+    populated = extractor(restaurants.copy()).populate_ground(ground_df.copy())
+
+    # every cell scanned against every restaurant, as the ground was populated before the spatial join
+    points = restaurants["point"].values
+    percentiles = restaurants["ranking_percentile"].values
+    for cell, area in zip(populated.itertuples(), ground_df["area"]):
+        contained = shapely.contains(area, points)
+        assert cell.restaurants == contained.sum()
+        expected_median = np.median(percentiles[contained]) if contained.any() else np.nan
+        np.testing.assert_equal(cell.median_ranking_percentile, expected_median)
+        assert cell.successful_restaurants == (contained & (percentiles < 30)).sum()
+        assert cell.successful_restaurants_any == int((contained & (percentiles < 30)).any())
+    assert populated["restaurants"].sum() < len(restaurants)
+
+def test_ranked_restaurants_in_locations_equal_containment_scan(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    restaurants = synthetic_data.tripadvisor_frame(300, synthetic_data.bounds(LONGITUDE, LATITUDE, AREA_SIDE), SEED)
+    ground_df = GridGeometry.square(LONGITUDE, LATITUDE, AREA_SIDE, CELL_SIDE).to_frame()
+    ground_df.insert(0, "id", range(len(ground_df)))
+    ta_extractor = extractor(restaurants.copy())
+    ta_extractor.populate_ground(ground_df.copy())
+
+    # locations are cell areas indexed by cell id
+    locations = ground_df.set_index("id")["area"].iloc[[9, 27, 28, 36]]
+    ranked = ta_extractor.get_ranked_restaurants_in_locations(locations)
+
+    contained = np.zeros(len(restaurants), dtype = bool)
+    for area in locations:
+        contained |= shapely.contains(area, restaurants["point"].values)
+    expected = restaurants[contained].sort_values(by = ["ranking_percentile"])
+    assert ranked["location_id"].tolist() == expected["location_id"].tolist()
+    assert len(ranked) > 0
@@ -0,0 +1,117 @@
+import json
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse
+
+import pytest
+import requests
+
+from extractors.tripadvisor_harvester import TripAdvisorHarvester
+
+MAPPER_API_KEY = "test-mapper"
+LOCATION_API_KEY = "test-location"
+
+class StandInTripAdvisor(BaseHTTPRequestHandler):
+    """
+    Mimics TripAdvisor location_mapper and location endpoints,
+    fails requests listed in server.failing with 503, refuses requests in server.refused with 403 and counts all requests
+    """
+
+    def do_GET(self):
+        path = urlparse(self.path).path.split("/api/partner/2.0/")[1]
+        with self.server.lock:
+            self.server.hits[path] = self.server.hits.get(path, 0) + 1
+            fail = self.server.failing.get(path, 0)
+            if fail:
+                self.server.failing[path] = fail - 1
+
+        if fail or path in self.server.refused:
+            self.send_response(503 if fail else 403)
+            self.end_headers()
+            return
+
+        endpoint, argument = path.split("/")
+        if endpoint == "location_mapper":
+            latitude, longitude = argument.split(",")
+            body = {"data": [{"location_id": f"{latitude[-1]}{longitude[-1]}"}]}
+        elif argument == "404":
+            body = {"error": {"message": "not found"}}
+        else:
+            body = {"location_id": argument, "latitude": "47.37", "longitude": "8.54",
+                "ranking_data": {"ranking": "1", "ranking_out_of": "10"}}
+
+        payload = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInTripAdvisor)
+    server.lock = threading.Lock()
+    server.hits = {}
+    server.failing = {}
+    server.refused = set()
+    thread = threading.Thread(target = server.serve_forever, daemon = True)
+    thread.start()
+    yield server
+    server.shutdown()
+
+def harvester(server, checkpoint_file, retries = 3):
+    return TripAdvisorHarvester(
+        f"http://127.0.0.1:{server.server_address[1]}/api/partner/2.0",
+        MAPPER_API_KEY, LOCATION_API_KEY, str(checkpoint_file),
+        workers = 4, rate_limit = 1000, retries = retries, backoff = 0.01)
+
+def test_harvest_retries_transient_failures(server, tmp_path):
+    server.failing["location_mapper/47.1,8.2"] = 2
+    points = [(8.2, 47.1), (8.3, 47.1), (8.2, 47.1)]
+
+    location_ids = harvester(server, tmp_path / "checkpoint.jsonl").location_ids(points)
+
+    assert location_ids == {"12", "13"}
+    assert server.hits["location_mapper/47.1,8.2"] == 3
+
+def test_harvest_leaves_out_error_responses(server, tmp_path):
+    details = harvester(server, tmp_path / "checkpoint.jsonl").location_details(["7", "404"])
+
+    assert [d["location_id"] for d in details] == ["7"]
+
+def test_harvest_resumes_from_checkpoint(server, tmp_path):
+    checkpoint_file = tmp_path / "checkpoint.jsonl"
+    server.failing["location/3"] = 10
+
+    with pytest.raises(requests.HTTPError):
+        harvester(server, checkpoint_file, retries = 2).location_details(["1", "2", "3", "4"])
+
+    server.failing.clear()
+    details = harvester(server, checkpoint_file).location_details(["1", "2", "3", "4"])
+
+    assert [d["location_id"] for d in details] == ["1", "2", "3", "4"]
+    assert all(server.hits[f"location/{i}"] == 1 for i in ["1", "2", "4"])
+
+def test_harvest_skips_refused_requests(server, tmp_path):
+    server.refused.update({"location_mapper/47.1,8.3", "location/2"})
+    checkpoint_file = tmp_path / "checkpoint.jsonl"
+
+    location_ids = harvester(server, checkpoint_file).location_ids([(8.2, 47.1), (8.3, 47.1)])
+    details = harvester(server, checkpoint_file).location_details(["1", "2"])
+
+    assert location_ids == {"12"}
+    assert [d["location_id"] for d in details] == ["1"]
+    assert server.hits["location_mapper/47.1,8.3"] == 1 and server.hits["location/2"] == 1
+
+def test_harvest_without_retries_attempts_once(server, tmp_path):
+    server.failing["location/1"] = 1
+
+    with pytest.raises(requests.HTTPError):
+        harvester(server, tmp_path / "checkpoint.jsonl", retries = 0).location_details(["1"])
+    assert server.hits["location/1"] == 1
+
+    details = harvester(server, tmp_path / "checkpoint.jsonl", retries = 0).location_details(["1"])
+    assert [d["location_id"] for d in details] == ["1"]
@@ -0,0 +1,17 @@
+import pandas as pd
+import shapely
+
+from extractors.zipcode_resolver import ZipcodeResolver, UNKNOWN_ZIPCODE
+
+def test_points_take_zip_codes_of_areas_resolved_before(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    # two cells of a coarser ground, the second one resolved to no zip code
+    resolved_df = pd.DataFrame({
+        "area": shapely.box([8.50, 8.51], [47.30, 47.30], [8.51, 8.52], [47.31, 47.31]),
+        "zipcode": [8001, UNKNOWN_ZIPCODE]
+    })
+    resolver = ZipcodeResolver("test", None, resolved_df = resolved_df)
+
+    # within the first cell, within the cell without zip code next to it and a little west of the first cell
+    zipcodes = resolver.resolve(shapely.points([8.505, 8.515, 8.498], [47.305, 47.305, 47.305]))
+    assert zipcodes.tolist() == [8001, 8001, 8001]